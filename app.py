@@ -1,14 +1,27 @@
 import os
 import logging
-import requests
-import json
-import psycopg2
 import re
 import time
+import asyncio
+import functools
 from datetime import datetime
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler
 from dotenv import load_dotenv
+from common import WAREHOUSE_NAMES, CATEGORY_BUTTONS, clean_number, get_db_connection, db_call, close_pool, post_webhook
+from tariff_matrix import get_matrix
+from quotes import Quote, quote_cart
+from volume_parser import parse_volume
+from shipment_events import append_event
+from notifier import run_status_notifier, subscribe
+import outbox
+import rate_limit
+import idempotency
+import funnel
+import sender
+import executors
+import contract_pdf
+from transit_model import get_eta, format_eta
 
 # --- НАСТРОЙКИ ---
 load_dotenv()
@@ -25,28 +38,7 @@ MANAGER_TG_LINK = "https://t.me/PostProLogistics"
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# --- КОНФИГУРАЦИЯ ---
-try:
-    with open('config.json', 'r', encoding='utf-8') as f:
-        CONFIG = json.load(f)
-    EXCHANGE_RATE = CONFIG.get('EXCHANGE_RATE', {}).get('rate', 500)
-    T2_RATES = CONFIG.get('T2_RATES_DETAILED', {}).get('large_parcel', {})
-except Exception as e:
-    logger.error(f"Config Error: {e}")
-    CONFIG = {}
-    EXCHANGE_RATE = 500
-    T2_RATES = {}
-
-WAREHOUSE_NAMES = {"GZ": "Гуанчжоу", "FS": "Фошань", "IW": "Иу"}
-
-# --- КАТЕГОРИИ ---
-CATEGORY_BUTTONS = {
-    "odezhda": "👕 Одежда", "obuv": "👟 Обувь", "sumki": "👜 Сумки",
-    "tovary_dlja_doma": "🏠 Хозтовары", "igrushki": "🧸 Игрушки", "mebel": "🛋 Мебель",
-    "elektronika": "💻 Электроника", "telefony": "📱 Телефоны", "avtozapchasti": "🚗 Автозапчасти",
-    "santehnika": "🚿 Сантехника", "oborudovanie": "⚙️ Оборудование", "strojmaterialy": "🧱 Строймат.",
-    "tovary_dlja_zhivotnyh": "🐾 Зоотовары", "obshhie": "📦 Прочее"
-}
+# Тарифы из config.json загружает tariff_matrix (лениво, с кэшем config.cache)
 
 # --- СОСТОЯНИЯ (ИСПРАВЛЕНО) ---
 (CLIENT_CITY, CLIENT_WAREHOUSE, CLIENT_PRODUCT, CLIENT_WEIGHT, 
@@ -67,82 +59,20 @@ MAIN_MENU = ReplyKeyboardMarkup(
 
 # ================= ФУНКЦИИ =================
 
-def get_db_connection():
-    try: return psycopg2.connect(DATABASE_URL)
-    except: return None
-
-def clean_number(text):
-    if not text: return 0.0
-    try: return float(text.replace(',', '.').strip())
-    except: return 0.0
-
-def parse_volume_input(text):
-    text = text.lower().replace('х', 'x').replace('*', 'x')
-    try:
-        val = float(text.replace(',', '.'))
-        if val < 20: return val 
-    except: pass
-    dims = re.findall(r'(\d+[.,]?\d*)', text)
-    if len(dims) >= 3:
-        try:
-            l = float(dims[-3].replace(',', '.'))
-            w = float(dims[-2].replace(',', '.'))
-            h = float(dims[-1].replace(',', '.'))
-            count = 1
-            if len(dims) >= 4: count = float(dims[-4].replace(',', '.'))
-            return round((l * w * h / 1000000) * count, 4)
-        except: return 0.0
-    return 0.0
-
 def get_product_category_from_ai(text):
     """Только для админки и AI чата"""
     if not MAKE_CATEGORIZER_WEBHOOK: return "obshhie"
     try:
-        resp = requests.post(MAKE_CATEGORIZER_WEBHOOK, json={'product_text': text}, timeout=10)
+        resp = post_webhook(MAKE_CATEGORIZER_WEBHOOK, {'product_text': text}, 10)
         key = resp.json().get('category_key')
         return key.lower() if key else "obshhie"
     except: return "obshhie"
 
 def send_tiktok_event(phone):
     if not MAKE_TIKTOK_WEBHOOK: return
-    try: requests.post(MAKE_TIKTOK_WEBHOOK, json={'phone': phone}, timeout=5)
+    try: post_webhook(MAKE_TIKTOK_WEBHOOK, {'phone': phone}, 5)
     except: pass
 
-def calculate_t1_line_item(weight, volume, category_key, warehouse):
-    rates = CONFIG.get('T1_RATES_DENSITY', {}).get(warehouse, CONFIG.get('T1_RATES_DENSITY', {}).get('GZ', {}))
-    cat_rates = rates.get(category_key, rates.get('obshhie'))
-    density = weight / volume if volume > 0 else 9999.0
-    base_price = 0
-    if cat_rates:
-        for r in sorted(cat_rates, key=lambda x: x.get('min_density', 0), reverse=True):
-            if density >= r.get('min_density', 0):
-                base_price = r.get('price', 0); break
-        if base_price == 0: base_price = cat_rates[-1].get('price', 0)
-    client_rate = base_price * 1.30
-    is_cbm = client_rate > 50
-    cost = (client_rate * volume) if is_cbm else (client_rate * weight)
-    return round(cost, 2), round(client_rate, 2), round(density, 2), is_cbm
-
-def calculate_t2_total(total_weight, city_name):
-    city_key = city_name.lower().strip()
-    zone = CONFIG.get('DESTINATION_ZONES', {}).get(city_key, "5") 
-    zone = str(zone)
-    weight_ranges = T2_RATES.get('weight_ranges', [])
-    extra_kg_rate = T2_RATES.get('extra_kg_rate', {}).get(zone, 260)
-    final_kzt_cost = 0
-    if total_weight <= 0: return 0, 0.8
-    found_range = False
-    for r in weight_ranges:
-        if total_weight <= r['max']:
-            final_kzt_cost = r['zones'].get(zone, 5000)
-            found_range = True; break
-    if not found_range and total_weight > 0 and weight_ranges:
-        rate_20kg_info = weight_ranges[-1].get('zones', {}) 
-        base_rate_20kg = rate_20kg_info.get(zone, 5000) 
-        final_kzt_cost = base_rate_20kg + (total_weight - 20) * extra_kg_rate
-    ref_rate_usd = {"1": 0.4, "2": 0.5, "3": 0.6, "4": 0.7, "5": 0.8}.get(zone, 0.8)
-    return int(final_kzt_cost), ref_rate_usd
-
 def generate_vertical_map(status, progress, warehouse_code="GZ", city_to="Алматы"):
     start_city = WAREHOUSE_NAMES.get(warehouse_code, "Гуанчжоу")
     route = [start_city, "Чанша", "Сиань", "Ланьчжоу", "Урумчи", "Хоргос (Граница)", city_to]
@@ -160,31 +90,54 @@ def generate_vertical_map(status, progress, warehouse_code="GZ", city_to="Алм
         else: map_lines.append(f"⬜️ {city}" + ("\n      ⬇️" if i != 6 else ""))
     return "\n".join(map_lines)
 
+async def throttled(kind, update):
+    if await rate_limit.allow(kind, update.effective_user.id): return False
+    if rate_limit.first_warning(update.effective_user.id):
+        await update.message.reply_text("⏳ Слишком много запросов. Попробуйте через минуту.")
+    return True
+
+def find_track(cur, track, chat_id):
+    cur.execute("SELECT status, actual_weight, product, warehouse_code, client_city, route_progress, contract_num FROM shipments WHERE track_number = %s OR contract_num = %s", (track, track))
+    row = cur.fetchone()
+    if not row: return None, None
+    # Клиент, который нашел свой груз, дальше получает пуши о смене статуса
+    subscribe(cur, row[6], chat_id)
+    return row, get_eta(cur, row[3], row[0])
+
 async def track_cargo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     track = update.message.text.strip().upper()
-    conn = get_db_connection()
-    if not conn: return
-    cur = conn.cursor()
-    cur.execute("SELECT status, actual_weight, product, warehouse_code, client_city, route_progress FROM shipments WHERE track_number = %s OR contract_num = %s", (track, track))
-    row = cur.fetchone()
-    conn.close()
+    if await throttled('track', update): return
+    # Несуществующие треки отвечаем из кэша, без запроса в БД
+    if rate_limit.unknown_tracks.get(track):
+        rate_limit.STATS['track_negative_hits'] += 1
+        await update.message.reply_text("❌ Груз не найден. Проверьте трек.")
+        return
+    try: found = await executors.run_io(db_call, find_track, track, update.effective_chat.id)
+    except executors.Busy:
+        await update.message.reply_text(executors.BUSY_TEXT); return
+    if found is None:
+        await update.message.reply_text("Ошибка подключения к БД."); return
+    row, eta = found
     if row:
-        status, weight, product, wh_code, city, progress = row
+        status, weight, product, wh_code, city, progress, _ = row
         if not wh_code: wh_code = "GZ"
         if not city: city = "Алматы"
         progress = progress if progress is not None else 10
         visual = generate_vertical_map(status, progress, wh_code, city)
-        await update.message.reply_text(f"📦 <b>ГРУЗ НАЙДЕН!</b>\n🆔 {track}\n📄 {product}\n⚖️ {weight} кг\n📍 <b>{status}</b>\n\n{visual}", parse_mode='HTML')
+        eta_line = f"\n⏱ Прибытие в Алматы: {format_eta(eta)}" if eta else ""
+        await update.message.reply_text(f"📦 <b>ГРУЗ НАЙДЕН!</b>\n🆔 {track}\n📄 {product}\n⚖️ {weight} кг\n📍 <b>{status}</b>{eta_line}\n\n{visual}", parse_mode='HTML')
     else:
+        rate_limit.unknown_tracks.set(track, True)
         await update.message.reply_text("❌ Груз не найден. Проверьте трек.")
 
 async def handle_ai_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_text = update.message.text
     if re.match(r'^[A-Za-z0-9-]{5,}$', user_text) and len(user_text) < 20: return await track_cargo(update, context)
     if not MAKE_AI_CHAT_WEBHOOK or user_text in ["🚚 Калькулятор", "🔎 Отследить груз"]: return
+    if await throttled('ai', update): return
     try:
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-        resp = requests.post(MAKE_AI_CHAT_WEBHOOK, json={'text_message': user_text}, timeout=20)
+        resp = await executors.run_io(post_webhook, MAKE_AI_CHAT_WEBHOOK, {'text_message': user_text}, 20)
         await update.message.reply_text(resp.text)
     except:
         await start(update, context)
@@ -192,6 +145,10 @@ async def handle_ai_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ================= HANDLERS =================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.args is not None:
+        # Сама команда /start (а не возврат в меню): метка источника из ссылки t.me/<bot>?start=tiktok
+        if context.args: context.user_data['source'] = context.args[0][:32].lower()
+        funnel.track(update.effective_user.id, context.user_data, 'start')
     await update.message.reply_text(
         "👋 <b>Здравствуйте! Я — Айсулу, ваш менеджер Post Pro.</b>\n"
         "Я помогу рассчитать доставку, отследить груз и отвечу на вопросы на 3 языках.\n\n"
@@ -245,11 +202,14 @@ async def cancel(u, c):
 
 async def calc_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['cart'] = []
+    funnel.new_session(context.user_data)
+    funnel.track(update.effective_user.id, context.user_data, 'calc_start')
     await update.message.reply_text("🏙 Введите <b>Город доставки</b> (в Казахстане):", parse_mode='HTML', reply_markup=MAIN_MENU)
     return CLIENT_CITY
 
 async def get_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['city'] = update.message.text
+    funnel.track(update.effective_user.id, context.user_data, 'city')
     kb = [[KeyboardButton("🇨🇳 Гуанчжоу"), KeyboardButton("🇨🇳 Фошань"), KeyboardButton("🇨🇳 Иу")]]
     await update.message.reply_text("✅ Склад:", reply_markup=ReplyKeyboardMarkup(kb, one_time_keyboard=True, resize_keyboard=True), parse_mode='HTML')
     return CLIENT_WAREHOUSE
@@ -261,6 +221,7 @@ async def get_warehouse(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif "Иу" in text: code = "IW"
     context.user_data['wh_code'] = code
     context.user_data['wh_name'] = WAREHOUSE_NAMES.get(code, "Гуанчжоу")
+    funnel.track(update.effective_user.id, context.user_data, 'warehouse')
     
     keyboard = []
     row = []
@@ -284,6 +245,7 @@ async def save_category_choice(update: Update, context: ContextTypes.DEFAULT_TYP
     cat_key = query.data.replace("cat_", "")
     cat_name = CATEGORY_BUTTONS.get(cat_key, cat_key)
     context.user_data['current_item'] = {'name': cat_name, 'category': cat_key}
+    funnel.track(update.effective_user.id, context.user_data, 'category')
     await query.edit_message_text(f"📦 Товар: <b>{cat_name}</b>\n⚖️ Введите <b>Вес (кг)</b>:", parse_mode='HTML')
     return CLIENT_WEIGHT
 
@@ -292,6 +254,7 @@ async def get_weight(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if w <= 0:
         await update.message.reply_text("🔢 Введите число:", reply_markup=MAIN_MENU); return CLIENT_WEIGHT
     context.user_data['current_item']['weight'] = w
+    funnel.track(update.effective_user.id, context.user_data, 'weight')
     
     await update.message.reply_text(
         "📦 <b>Введите Объем (м³)</b>\n"
@@ -303,12 +266,13 @@ async def get_weight(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return CLIENT_VOLUME
 
 async def get_volume(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    vol = parse_volume_input(update.message.text)
+    vol = parse_volume(update.message.text)
     if vol <= 0: 
         vol = context.user_data['current_item']['weight'] / 200
         await update.message.reply_text(f"⚠️ Габариты не распознаны. Расчетный объем: {vol:.2f} м³")
     
     context.user_data['current_item']['volume'] = vol
+    funnel.track(update.effective_user.id, context.user_data, 'volume')
     context.user_data['cart'].append(context.user_data['current_item'])
     
     kb = [[KeyboardButton("➕ Добавить товар"), KeyboardButton("🏁 Рассчитать")]]
@@ -338,58 +302,20 @@ async def handle_add_more(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_final_report(update, context):
     d = context.user_data
-    total_w = sum(i['weight'] for i in d['cart'])
-    total_v = sum(i['volume'] for i in d['cart'])
-    
-    t1_total_usd = 0
-    items_details = ""
+    # Повторный расчет той же корзины берется из LRU-кэша quotes
+    quote = quote_cart(d['wh_code'], d['city'], tuple((i['category'], i['name'], i['weight'], i['volume']) for i in d['cart']))
     
-    for i, item in enumerate(d['cart'], 1):
-        cost, rate, dens, is_cbm = calculate_t1_line_item(item['weight'], item['volume'], item['category'], d['wh_code'])
-        t1_total_usd += cost
-        unit = "м³" if is_cbm else "кг"
-        items_details += (
-            f"<b>{i}. {item['name']}</b>\n"
-            f"   ▫️ {item['weight']} кг / {item['volume']:.2f} м³ (Плотн: {dens:.0f})\n"
-            f"   ▫️ Тариф: ${rate}/{unit}\n"
-            f"   ▫️ Сумма: <b>${cost:.2f}</b>\n\n"
-        )
-
-    t2_kzt, t2_rate_usd = calculate_t2_total(total_w, d['city'])
-    
-    # СОХРАНЯЕМ ДАННЫЕ ДЛЯ АДМИНА
-    context.user_data['saved_calc'] = {
-        't1_usd': t1_total_usd,
-        't2_kzt': t2_kzt,
-        'details': items_details
-    }
-    
-    report = (
-        f"📊 <b>ДЕТАЛЬНЫЙ РАСЧЕТ | Заявка</b>\n\n"
-        f"🏙 <b>Маршрут:</b> {d['wh_name']} ➡️ {d['city']}\n\n"
-        f"📦 <b>СОСТАВ ГРУЗА:</b>\n"
-        f"{items_details}"
-        f"----------------------------------\n"
-        f"🇨🇳 <b>Т1 (КИТАЙ → АЛМАТЫ)</b>\n"
-        f"• Общий вес: <b>{total_w} кг</b>\n"
-        f"• Общий объем: <b>{total_v:.2f} м³</b>\n"
-        f"💵 <b>ИТОГО Т1: ${t1_total_usd:.2f} USD</b>\n\n"
-        
-        f"🇰🇿 <b>Т2 (АЛМАТЫ → ДВЕРЬ)</b>\n"
-        f"• Тарифная зона: {d['city']}\n"
-        f"💵 <b>ИТОГО Т2: ~{t2_kzt} ₸</b>\n\n"
-        
-        f"<i>Тариф по РК предварительный. Точный расчет — по прибытию в Алматы.</i>\n\n"
-        f"💡 <b>Страхование:</b> 1% от стоимости товара.\n"
-        f"💳 <b>Оплата:</b> При получении груза в тенге удобным Вам способом."
-    )
+    # СОХРАНЯЕМ РАСЧЕТ ДЛЯ АДМИНА (компактно, без HTML)
+    context.user_data['quote'] = quote.encode()
+    funnel.track(update.effective_user.id, context.user_data, 'report')
     
     kb = [[KeyboardButton("✅ Оставить заявку"), KeyboardButton("🔄 Новый расчет")]]
-    await update.message.reply_text(report, reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True), parse_mode='HTML')
+    await update.message.reply_text(quote.render_client(d['wh_name']), reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True), parse_mode='HTML')
     return CLIENT_DECISION
 
 async def client_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if "Оставить" in update.message.text:
+        funnel.track(update.effective_user.id, context.user_data, 'lead_form')
         await update.message.reply_text("👤 Как к вам обращаться? (Имя):", reply_markup=ReplyKeyboardRemove()); return CLIENT_NAME
     elif "Новый" in update.message.text:
         return await calc_start(update, context)
@@ -397,46 +323,47 @@ async def client_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def client_get_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['client_name'] = update.message.text
+    funnel.track(update.effective_user.id, context.user_data, 'name')
     await update.message.reply_text("📱 Ваш телефон:", reply_markup=ReplyKeyboardMarkup([[KeyboardButton("📱 Отправить контакт", request_contact=True)]], resize_keyboard=True)); return CLIENT_PHONE
 
+def save_application(cur, key, params):
+    """id новой заявки; False — повтор того же сообщения, заявка уже сохранена."""
+    if not idempotency.execute_claimed(cur, key, None, """
+        INSERT INTO applications (name, phone, details, source, city, total_weight, total_volume, calculated_cost, warehouse_code, chat_id)
+        SELECT %s, %s, %s, 'bot', %s, %s, %s, %s, %s, %s FROM claim RETURNING id
+    """, params): return False
+    return cur.fetchone()[0]
+
 async def client_finish(update: Update, context: ContextTypes.DEFAULT_TYPE):
     phone = update.message.contact.phone_number if update.message.contact else update.message.text
     d = context.user_data
-    send_tiktok_event(phone)
+    funnel.track(update.effective_user.id, d, 'lead')
+    # Пиксель TikTok — best effort: при перегрузке пула событие пропускаем, заявку — нет
+    try: await executors.run_io(send_tiktok_event, phone)
+    except executors.Busy: logger.warning("TikTok event skipped: io pool busy")
 
     if ADMIN_CHAT_ID:
-        # Восстанавливаем расчеты
-        saved = d.get('saved_calc', {})
-        t1_usd = saved.get('t1_usd', 0.0)
-        t2_kzt = saved.get('t2_kzt', 0)
-        details = saved.get('details', '')
-
-        total_w = sum(i['weight'] for i in d['cart'])
-        total_v = sum(i['volume'] for i in d['cart'])
+        quote = Quote.decode(d['quote'])
+        
+        # Заявка сохраняется вместе с расчетом: админ оформляет контракт именно по ней
+        try:
+            app_id = await executors.run_io(db_call, save_application, idempotency.message_key('application', update),
+                                            (d['client_name'], phone, d['quote'], d['city'], quote.total_weight, quote.total_volume, quote.t1_usd, d['wh_code'], update.effective_chat.id))
+        except executors.Busy:
+            await update.message.reply_text(executors.BUSY_TEXT); return CLIENT_PHONE
+        if app_id is False:
+            # Повтор того же сообщения с телефоном: заявка и уведомление админу уже были
+            await update.message.reply_text("✅ Заявка принята! Менеджер скоро свяжется с вами.", reply_markup=MAIN_MENU); return ConversationHandler.END
         
         context.bot_data['last_lead'] = {
             'name': d['client_name'], 'phone': phone, 'city': d['city'],
-            'wh': d['wh_code'], 'prod': d['cart'][0]['category'], 
-            'w': total_w, 'v': total_v,
-            'rate_hint': t1_usd / total_w if total_w > 0 else 0 # Подсказка для авто-тарифа
+            'wh': d['wh_code'], 'prod': d['cart'][0]['category'], 'chat_id': update.effective_chat.id,
+            'w': quote.total_weight, 'v': quote.total_volume, 'quote': d['quote']
         }
         
-        kb = InlineKeyboardButton("⚡️ Оформить контракт (Авто)", callback_data="admin_auto_create")
-        
-        # Полная копия информации для админа
-        admin_text = (
-            f"🔥 <b>НОВАЯ ЗАЯВКА</b>\n"
-            f"👤 {d['client_name']} ({phone})\n"
-            f"🏙 {d['city']} | 🏭 {d['wh_name']}\n\n"
-            f"📦 <b>ДЕТАЛИЗАЦИЯ:</b>\n"
-            f"{details}"
-            f"----------------------------------\n"
-            f"⚖️ <b>ВСЕГО:</b> {total_w} кг | {total_v:.2f} м³\n"
-            f"💵 <b>ИТОГО Т1: ${t1_usd:.2f}</b>\n"
-            f"🇰🇿 <b>ИТОГО Т2: ~{t2_kzt} ₸</b>"
-        )
-        try: await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=admin_text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup([[kb]]))
-        except: pass
+        kb = InlineKeyboardButton("⚡️ Оформить контракт (Авто)", callback_data=f"admin_auto_create_{app_id}" if app_id else "admin_auto_create")
+        sender.get(context.bot).send_nowait(ADMIN_CHAT_ID, sender.ADMIN, text=quote.render_admin(d['client_name'], phone, d['wh_name']),
+                                            parse_mode='HTML', reply_markup=InlineKeyboardMarkup([[kb]]))
         
     await update.message.reply_text("✅ Заявка принята! Менеджер скоро свяжется с вами.", reply_markup=MAIN_MENU); return ConversationHandler.END
 
@@ -447,21 +374,65 @@ async def admin_start(u, c):
     kb = [[KeyboardButton("📝 Создать контракт")], [KeyboardButton("🔙 Выход")]]
     await u.message.reply_text("👨‍💻 Админка", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)); return ConversationHandler.END
 
+async def admin_limits(u, c):
+    if str(u.effective_user.id) != str(ADMIN_CHAT_ID): return
+    await u.message.reply_text("🛡 <b>Лимиты запросов</b>\n" + rate_limit.format_stats() + "\n\n⚙️ <b>Пулы</b>\n" + executors.format_stats(), parse_mode='HTML')
+
+async def admin_export(u, c):
+    # /export [с] [по] [GZ|FS|IW] [статус]
+    if str(u.effective_user.id) != str(ADMIN_CHAT_ID): return
+    from export import parse_filters, export_to_tempfile, export_filename, TELEGRAM_MAX_FILE
+    try: export_filters = parse_filters(c.args or [], WAREHOUSE_NAMES)
+    except ValueError:
+        await u.message.reply_text("📤 /export [2025-01-01] [2025-03-31] [GZ|FS|IW] [статус]"); return
+    await u.message.reply_text("⏳ Готовлю выгрузку...")
+    try: path, rows = await executors.run_io(functools.partial(export_to_tempfile, DATABASE_URL, **export_filters))
+    except executors.Busy:
+        await u.message.reply_text(executors.BUSY_TEXT); return
+    except Exception as e:
+        logger.error(f"Export error: {e}")
+        await u.message.reply_text("❌ Ошибка выгрузки."); return
+    try:
+        size = os.path.getsize(path)
+        if size > TELEGRAM_MAX_FILE:
+            await u.message.reply_text(f"⚠️ Файл {size / 1024 / 1024:.0f} МБ больше лимита Telegram (50 МБ). Сузьте фильтры или выгрузите на сервере: python export.py")
+        else:
+            with open(path, 'rb') as f:
+                await u.message.reply_document(f, filename=export_filename(**export_filters), caption=f"📤 Грузов: {rows}")
+    finally:
+        os.unlink(path)
+
+def load_application(cur, app_id):
+    cur.execute("SELECT name, phone, city, warehouse_code, details, chat_id FROM applications WHERE id = %s", (app_id,))
+    return cur.fetchone()
+
 async def admin_auto_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    if 'last_lead' not in context.bot_data:
+    lead = None
+    app_id = query.data.replace("admin_auto_create", "").lstrip("_")
+    if app_id.isdigit():
+        try: row = await executors.run_io(db_call, load_application, int(app_id))
+        except executors.Busy:
+            await query.message.reply_text(executors.BUSY_TEXT); return ConversationHandler.END
+        if row:
+            quote = Quote.decode(row[4])
+            lead = {'name': row[0], 'phone': row[1], 'city': row[2], 'wh': row[3], 'prod': quote.items[0].category,
+                    'w': quote.total_weight, 'v': quote.total_volume, 'chat_id': row[5], 'quote': row[4]}
+    if lead is None: lead = context.bot_data.get('last_lead')
+    if not lead:
         await query.message.reply_text("Нет данных.")
         return ConversationHandler.END
-    lead = context.bot_data['last_lead']
     context.user_data.update({
         'adm_name': lead['name'], 'adm_phone': lead['phone'], 'adm_city': lead['city'],
-        'adm_wh': lead['wh'], 'adm_prod': lead['prod'], 'adm_w': lead['w'], 'adm_vol': lead['v']
+        'adm_wh': lead['wh'], 'adm_prod': lead['prod'], 'adm_w': lead['w'], 'adm_vol': lead['v'],
+        'adm_client_chat': lead.get('chat_id'), 'adm_quote': lead.get('quote'), 'edit_mode': None
     })
     return await admin_v_preview(query, context)
 
 async def admin_create_manual(u, c):
     if str(u.effective_user.id) != str(ADMIN_CHAT_ID): return ConversationHandler.END
+    c.user_data.update({'adm_client_chat': None, 'adm_quote': None, 'edit_mode': None})
     await u.message.reply_text("👤 Клиент:", reply_markup=ReplyKeyboardRemove()); return ADM_NAME
 
 async def admin_name(u, c): c.user_data['adm_name'] = u.message.text; await u.message.reply_text("📱 Телефон:"); return ADM_PHONE
@@ -488,11 +459,31 @@ async def admin_save_category_choice(update: Update, context: ContextTypes.DEFAU
 
 async def admin_w(u, c): c.user_data['adm_w'] = clean_number(u.message.text); await u.message.reply_text("📦 Объем:"); return ADM_VOLUME
 
+async def admin_vol(u, c):
+    vol = parse_volume(u.message.text)
+    if vol <= 0:
+        await u.message.reply_text("⚠️ Объем не распознан. Введите м³ (0.5 или 2 м куб) или габариты в см (60*40*50, 10 шт 60*40*50):")
+        return ADM_VOLUME
+    c.user_data['adm_vol'] = vol
+    return await admin_v_preview(u, c)
+
 async def admin_v_preview(u, c): 
-    if hasattr(u, 'message') and u.message: c.user_data['adm_vol'] = clean_number(u.message.text)
     d = c.user_data
-    total_cost, final_rate, _, _ = calculate_t1_line_item(d['adm_w'], d['adm_vol'], d['adm_prod'], d['adm_wh'])
-    c.user_data['final_rate'] = final_rate
+    if d.get('edit_mode') == 'weight': d['adm_quote'] = None  # Вес изменен — расчет заявки больше не актуален
+    if d.get('edit_mode') == 'rate':
+        final_rate = d['final_rate']
+        total_cost = round(final_rate * (d['adm_vol'] if d.get('final_is_cbm') else d['adm_w']), 2)
+    else:
+        quote = Quote.decode(d['adm_quote']) if d.get('adm_quote') else quote_cart(
+            d['adm_wh'], d['adm_city'], ((d['adm_prod'], d['adm_prod'], d['adm_w'], d['adm_vol']),))
+        total_cost = quote.t1_usd
+        if len(quote.items) == 1:
+            final_rate, d['final_is_cbm'] = quote.items[0].rate, quote.items[0].is_cbm
+        else:
+            # Смешанная корзина: договорной тариф — средний $/кг
+            final_rate, d['final_is_cbm'] = (round(total_cost / d['adm_w'], 2) if d['adm_w'] else 0), False
+        d['final_rate'] = final_rate
+    d['final_total'] = total_cost
     
     msg = (
         f"⚙️ <b>Проверка:</b>\n"
@@ -532,44 +523,100 @@ async def admin_edit_field_handler(u, c):
     elif mode == 'weight': c.user_data['adm_w'] = val
     return await admin_v_preview(u, c)
 
+def create_contract(cur, key, contract_num, params, actor, client_chat, payload):
+    """Номер контракта; при повторе того же нажатия — номер, созданный первой попыткой."""
+    if not idempotency.execute_claimed(cur, key, {'contract_num': contract_num},
+            "INSERT INTO shipments (contract_num, fio, phone, client_city, warehouse_code, product, category, declared_weight, declared_volume, agreed_rate, total_price_final, base_cost, status, created_at) SELECT %s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,'оформлен',NOW() FROM claim",
+            (contract_num,) + params):
+        return idempotency.stored_result(cur, key)['contract_num']
+    append_event(cur, contract_num, actor)
+    if client_chat: subscribe(cur, contract_num, client_chat)
+    # Вебхук уходит через make_outbox: контракт и его отправка в Make коммитятся вместе
+    outbox.enqueue(cur, 'MAKE_CONTRACT_WEBHOOK', payload, f"create:{contract_num}")
+    return contract_num
+
 async def admin_fin(u, c):
     message = u.effective_message 
     d = c.user_data
     rate = d['final_rate']
     contract_num = f"CN-{int(time.time())}"
     
-    total_price_usd = rate * d['adm_w']
+    total_price_usd = d['final_total']
+    quote = Quote.decode(d['adm_quote']) if d.get('adm_quote') else None
+    # Ручная правка тарифа меняет выручку, но не себестоимость
+    base_cost = quote.base_cost() if quote else \
+        round(get_matrix().t1_base_cost(d['adm_w'], d['adm_vol'], d['adm_prod'], d['adm_wh'], d.get('final_is_cbm', False)), 2)
     
-    conn = get_db_connection()
-    if conn:
-        cur = conn.cursor()
-        cur.execute("INSERT INTO shipments (contract_num, fio, phone, client_city, warehouse_code, product, declared_weight, declared_volume, agreed_rate, total_price_final, status, created_at) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,'оформлен',NOW())", 
-                    (contract_num, d['adm_name'], d['adm_phone'], d['adm_city'], d['adm_wh'], d['adm_prod'], d['adm_w'], d['adm_vol'], rate, total_price_usd))
-        conn.commit(); conn.close()
-        
-    if MAKE_CONTRACT_WEBHOOK:
-        try: requests.post(MAKE_CONTRACT_WEBHOOK, json={
-            "action":"create",
-            "contract_num":contract_num,
-            "chat_id":u.effective_chat.id,
-            "fio":d['adm_name'],
-            "phone":d['adm_phone'],
-            "warehouse_code":d['adm_wh'],
-            "product":d['adm_prod'],
-            "declared_weight":d['adm_w'],
-            "declared_volume":d['adm_vol'],
-            "rate":rate,
-            "total_amount": total_price_usd,
-            "created_at":str(datetime.now())
-        }, timeout=5)
-        except: pass
+    payload = {
+        "action":"create",
+        "contract_num":contract_num,
+        "chat_id":u.effective_chat.id,
+        "fio":d['adm_name'],
+        "phone":d['adm_phone'],
+        "warehouse_code":d['adm_wh'],
+        "product":d['adm_prod'],
+        "declared_weight":d['adm_w'],
+        "declared_volume":d['adm_vol'],
+        "rate":rate,
+        "total_amount": total_price_usd,
+        "quote": quote.make_payload() if quote else None,
+        "render_document": not contract_pdf.available(),
+        "created_at":str(datetime.now())
+    }
+    try:
+        created = await executors.run_io(db_call, create_contract, idempotency.callback_key('contract', u), contract_num,
+                                         (d['adm_name'], d['adm_phone'], d['adm_city'], d['adm_wh'], d['adm_prod'], d['adm_prod'], d['adm_w'], d['adm_vol'], rate, total_price_usd, base_cost),
+                                         str(u.effective_user.id), d.get('adm_client_chat'), payload)
+    except executors.Busy:
+        await message.reply_text(executors.BUSY_TEXT); return ADM_CONFIRM
+    if created != contract_num:
+        if created:
+            # Повторная доставка того же нажатия «Создать»: контракт уже создан первой попыткой
+            await message.reply_text(f"✅ <b>Контракт {created} создан!</b>", parse_mode='HTML')
+        else: await message.reply_text("❌ База данных недоступна, контракт не создан.")
+        return ConversationHandler.END
+    outbox.kick()
         
     await message.reply_text(f"✅ <b>Контракт {contract_num} создан!</b>", parse_mode='HTML')
+    fields = contract_pdf.contract_fields(contract_num, d['adm_name'], d['adm_phone'], d['adm_city'], d['adm_wh'], d['adm_prod'],
+                                          d['adm_w'], d['adm_vol'], rate, total_price_usd)
+    pdf = await contract_pdf.reply_with_contract(message, fields, contract_pdf.quote_items(quote) if quote else None)
+    if pdf and d.get('adm_client_chat'):
+        sender.get(c.bot).send_nowait(d['adm_client_chat'], sender.ADMIN, method='send_document', document=pdf,
+                                      filename=contract_pdf.contract_filename(contract_num))
     return ConversationHandler.END
 
 # --- SETUP ---
+def startup_checks():
+    """Прогрев тарифов, проверка БД и чистка старых ключей идемпотентности — в пуле потоков,
+    поллинг стартует, не дожидаясь их."""
+    get_matrix()
+    contract_pdf.available()
+    conn = get_db_connection()
+    if conn:
+        idempotency.prune(conn.cursor())
+        conn.commit(); conn.close()
+    else: logger.error("Startup check: database unavailable")
+
+async def start_workers(app):
+    executors.install(asyncio.get_running_loop())
+    asyncio.get_running_loop().run_in_executor(None, startup_checks)
+    if DATABASE_URL:
+        app.bot_data['notifier_task'] = asyncio.create_task(run_status_notifier(app.bot, DATABASE_URL))
+        app.bot_data['outbox_task'] = asyncio.create_task(outbox.run_relay(DATABASE_URL))
+        app.bot_data['funnel_task'] = asyncio.create_task(funnel.run_flusher(DATABASE_URL))
+
+async def stop_workers(app):
+    for key in ('notifier_task', 'outbox_task', 'funnel_task'):
+        task = app.bot_data.pop(key, None)
+        if task: task.cancel()
+    await sender.close_all()
+    executors.shutdown()
+    close_pool()
+
 def setup_application():
-    app = Application.builder().token(TOKEN).build()
+    app = Application.builder().token(TOKEN).post_init(start_workers).post_stop(stop_workers).build()
+    idempotency.install(app)
     stop_filter = filters.Regex('^🚚 Калькулятор$') | filters.Regex('^🔎 Отследить груз$')
     
     client_conv = ConversationHandler(
@@ -595,7 +642,7 @@ def setup_application():
     admin_conv = ConversationHandler(
         entry_points=[
             MessageHandler(filters.Regex('^📝 Создать контракт'), admin_create_manual),
-            CallbackQueryHandler(admin_auto_start, pattern='^admin_auto_create$')
+            CallbackQueryHandler(admin_auto_start, pattern='^admin_auto_create')
         ],
         states={
             ADM_NAME: [MessageHandler(filters.TEXT, admin_name)],
@@ -604,7 +651,7 @@ def setup_application():
             ADM_WAREHOUSE: [MessageHandler(filters.TEXT, admin_wh)],
             ADM_PRODUCT: [CallbackQueryHandler(admin_save_category_choice, pattern='^adm_cat_')],
             ADM_WEIGHT: [MessageHandler(filters.TEXT, admin_w)],
-            ADM_VOLUME: [MessageHandler(filters.TEXT, admin_v_preview)], 
+            ADM_VOLUME: [MessageHandler(filters.TEXT, admin_vol)], 
             ADM_CONFIRM: [CallbackQueryHandler(admin_confirm_handler)],
             ADM_EDIT_FIELD: [MessageHandler(filters.TEXT, admin_edit_field_handler)]
         },
@@ -613,6 +660,8 @@ def setup_application():
 
     app.add_handler(CommandHandler('start', start))
     app.add_handler(CommandHandler('admin', admin_start))
+    app.add_handler(CommandHandler('limits', admin_limits))
+    app.add_handler(CommandHandler('export', admin_export))
     
     # FIX: Глобальный обработчик выхода из админки
     app.add_handler(MessageHandler(filters.Regex('^🔙 Выход$'), start))
@@ -628,10 +677,9 @@ def setup_application():
     return app
 
 if __name__ == '__main__':
-    try: requests.get(f"https://api.telegram.org/bot{TOKEN}/deleteWebhook?drop_pending_updates=True")
-    except: pass
     if not TOKEN: logger.error("NO TOKEN")
     else:
+        get_matrix()        # Ошибка в config.json — ConfigError сразу, а не расчеты по пустым тарифам
         app = setup_application()
-
-        app.run_polling()    
+        # Вебхук снимает сам run_polling при старте — без отдельного блокирующего HTTP-запроса
+        app.run_polling(drop_pending_updates=True)
@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import psycopg2
+from dotenv import load_dotenv
+from shipment_search import SEARCH_SQL, CANDIDATES, normalize_query, search_shipments
+
+load_dotenv()
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+# Синтетические грузы помечаются префиксом контракта, чтобы их можно было удалить
+BENCH_PREFIX = 'BENCH-'
+
+SEED_SQL = """
+INSERT INTO shipments (contract_num, track_number, fio, phone, product, client_city, status, warehouse_code, created_at)
+SELECT %(prefix)s || g,
+       (ARRAY['GZ','FS','IW'])[1 + g %% 3] || (100000 + g),
+       (ARRAY['Айгуль','Ерлан','Данияр','Асель','Мадина','Нурлан','Жанна','Тимур','Алия','Серик'])[1 + g %% 10] || ' ' ||
+       (ARRAY['Ахметова','Сапаров','Иванова','Ким','Жумабаев','Нурпеисова','Ли','Касымов'])[1 + (g / 10) %% 8],
+       '+7 7' || lpad(((g * 7919) %% 100000000)::text, 9, '0'),
+       (ARRAY['кроссовки','куртки','сумки женские','телефоны','автозапчасти','игрушки','посуда','диван','обои','смесители'])[1 + (g / 7) %% 10],
+       (ARRAY['Алматы','Астана','Шымкент','Караганда','Актобе','Атырау','Павлодар','Семей'])[1 + (g / 3) %% 8],
+       (ARRAY['оформлен','Принят на складе GZ','В пути (Китай)','На границе (Хоргос)','Прибыл в Алматы'])[1 + g %% 5],
+       (ARRAY['GZ','FS','IW'])[1 + g %% 3],
+       NOW() - (g %% 365) * INTERVAL '1 day'
+FROM generate_series(%(start)s, %(stop)s) AS g
+ON CONFLICT DO NOTHING
+"""
+
+QUERIES = ['Айгуль', '0479', 'кроссовки', 'Шымкент', 'Ахмет', 'сумка', 'Нурлан Ким', 'смеситель', '7700']
+
+
+def seed(conn, total, batch=200000):
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM shipments WHERE contract_num LIKE %s", (BENCH_PREFIX + '%',))
+    start = cur.fetchone()[0] + 1
+    for lo in range(start, start + total, batch):
+        hi = min(lo + batch - 1, start + total - 1)
+        cur.execute(SEED_SQL, {'prefix': BENCH_PREFIX, 'start': lo, 'stop': hi})
+        conn.commit()
+        print(f"✅ Добавлено: {hi - start + 1}/{total}")
+    cur.execute("ANALYZE shipments")
+    conn.commit()
+
+
+def bench(conn, rounds=20):
+    cur = conn.cursor()
+    for q in QUERIES:
+        timings = []
+        for _ in range(rounds):
+            t = time.perf_counter()
+            rows = search_shipments(cur, q)
+            timings.append((time.perf_counter() - t) * 1000)
+        conn.rollback()
+        timings.sort()
+        print(f"{q:12} | найдено {len(rows):2} | p50 {timings[len(timings) // 2]:7.1f} мс | p95 {timings[int(len(timings) * 0.95) - 1]:7.1f} мс")
+
+
+def explain(conn, text):
+    """План запроса: ожидается Index Scan по idx_shipments_search_trgm_gist с Order By, без сортировки всех совпадений."""
+    cur = conn.cursor()
+    q = normalize_query(text)
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + SEARCH_SQL,
+                {'q': q, 'like': f"%{q}%", 'limit': 10, 'candidates': CANDIDATES, 'wh': None})
+    print("\n".join(row[0] for row in cur.fetchall()))
+    conn.rollback()
+
+
+def clean(conn):
+    cur = conn.cursor()
+    cur.execute("DELETE FROM shipments WHERE contract_num LIKE %s", (BENCH_PREFIX + '%',))
+    print(f"🗑 Удалено: {cur.rowcount}")
+    conn.commit()
+
+
+if __name__ == '__main__':
+    # python bench_search.py seed 1000000 | bench | explain [запрос] | clean
+    if not DATABASE_URL:
+        print("❌ Ошибка: Не задан DATABASE_URL.")
+        sys.exit(1)
+    cmd = sys.argv[1] if len(sys.argv) > 1 else 'bench'
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        if cmd == 'seed': seed(conn, int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
+        elif cmd == 'clean': clean(conn)
+        elif cmd == 'explain': explain(conn, sys.argv[2] if len(sys.argv) > 2 else QUERIES[0])
+        else: bench(conn)
+    finally:
+        conn.close()
@@ -0,0 +1,74 @@
+import os
+import sys
+import subprocess
+from statistics import median
+
+# Бот -> (модуль, функция сборки Application, переменная токена)
+TARGETS = {
+    'app': ('app', 'setup_application', 'TELEGRAM_BOT_TOKEN'),
+    'guangzhou': ('guangzhou_bot', 'setup_app', 'GUANGZHOU_BOT_TOKEN'),
+}
+# Токен нужен только билдеру Application; в сеть при сборке ничего не уходит
+DUMMY_TOKEN = '123456:BENCH'
+TOP_IMPORTS = 12
+
+CODE = """
+import time
+t = time.perf_counter()
+import {module}
+t_import = time.perf_counter()
+{module}.{func}()
+t_setup = time.perf_counter()
+print(f"{{(t_import - t) * 1000:.1f}} {{(t_setup - t_import) * 1000:.1f}}")
+"""
+
+
+def run_once(module, func, token_env):
+    env = dict(os.environ)
+    env[token_env] = env.get(token_env) or DUMMY_TOKEN
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', CODE.format(module=module, func=func)],
+                          capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    import_ms, setup_ms = map(float, proc.stdout.split()[-2:])
+    return import_ms, setup_ms, parse_importtime(proc.stderr, module)
+
+
+def parse_importtime(stderr, module):
+    """Строки 'import time: self [us] | cumulative | package' -> {импорт модуля бота: cumulative мс}.
+
+    Отступ имени = глубина вложенности. Прямые импорты модуля идут в выводе перед
+    ним самим с глубиной 1; все, что было до них (site, encodings), отбрасывается.
+    """
+    children = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line: continue
+        _, _, rest = line.partition(':')
+        _, cumulative_us, name = rest.split('|', 2)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        ms = int(cumulative_us) / 1000
+        if depth == 1: children[name.strip()] = ms
+        elif depth == 0:
+            if name.strip() == module: return dict(children, **{module: ms})
+            children = {}
+    return children
+
+
+def bench(name, runs):
+    module, func, token_env = TARGETS[name]
+    results = [run_once(module, func, token_env) for _ in range(runs)]
+    import_ms = median(r[0] for r in results)
+    setup_ms = median(r[1] for r in results)
+    print(f"=== {module}.{func}() | {runs} запусков ===")
+    print(f"import: {import_ms:.1f} мс | {func}(): {setup_ms:.1f} мс | итого: {import_ms + setup_ms:.1f} мс")
+    # Последний запуск: модули уже в кэше ОС, как на повторном старте контейнера
+    for pkg, ms in sorted(results[-1][2].items(), key=lambda kv: -kv[1])[:TOP_IMPORTS]:
+        print(f"  {ms:8.1f} мс  {pkg}")
+
+
+if __name__ == '__main__':
+    # python bench_startup.py [app|guangzhou|all] [запусков]
+    target = sys.argv[1] if len(sys.argv) > 1 else 'all'
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    for name in (TARGETS if target == 'all' else [target]):
+        bench(name, runs)
@@ -0,0 +1,177 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from psycopg2.pool import ThreadedConnectionPool
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+# Сколько ждать свободного соединения, прежде чем ответить «сервер загружен»
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+
+WAREHOUSE_NAMES = {"GZ": "Гуанчжоу", "FS": "Фошань", "IW": "Иу"}
+
+# --- КАТЕГОРИИ ---
+CATEGORY_BUTTONS = {
+    "odezhda": "👕 Одежда", "obuv": "👟 Обувь", "sumki": "👜 Сумки",
+    "tovary_dlja_doma": "🏠 Хозтовары", "igrushki": "🧸 Игрушки", "mebel": "🛋 Мебель",
+    "elektronika": "💻 Электроника", "telefony": "📱 Телефоны", "avtozapchasti": "🚗 Автозапчасти",
+    "santehnika": "🚿 Сантехника", "oborudovanie": "⚙️ Оборудование", "strojmaterialy": "🧱 Строймат.",
+    "tovary_dlja_zhivotnyh": "🐾 Зоотовары", "obshhie": "📦 Прочее"
+}
+
+
+def clean_number(text):
+    if not text: return 0.0
+    try: return float(text.replace(',', '.').strip())
+    except: return 0.0
+
+
+class Busy(Exception):
+    """Ресурс перегружен: нет места в очереди пула исполнителей или свободного соединения БД.
+    Хендлеры отвечают executors.BUSY_TEXT."""
+
+
+class TTLCache:
+    """Ограниченный словарь с временем жизни записей (LRU-вытеснение)."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None: return None
+        value, expires = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize: self._data.popitem(last=False)
+
+    def discard(self, key):
+        self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+# --- ПУЛ СОЕДИНЕНИЙ (один на процесс, общий для всех ботов) ---
+_pool = None
+_pool_size = DB_POOL_MAX
+_pool_lock = threading.Lock()
+# Слоты пула: getconn у исчерпанного ThreadedConnectionPool сразу бросает PoolError, а не ждет
+_slots = None
+
+
+def reserve_connections(n):
+    """Пул не меньше n соединений: каждому потоку, который ходит в БД, — свое, без ожидания."""
+    global _pool_size
+    with _pool_lock:
+        if _pool is not None and n > _pool_size:
+            logger.warning(f"DB pool already created with {_pool_size} connections, {n} requested")
+        _pool_size = max(_pool_size, n)
+
+
+class PooledConnection:
+    """Соединение из пула. close() возвращает его в пул (с откатом незакоммиченного), а не рвет."""
+    __slots__ = ('_conn', '_pool', '_slots')
+
+    def __init__(self, conn, pool, slots):
+        self._conn = conn
+        self._pool = pool
+        self._slots = slots
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None: return
+        try:
+            if not conn.closed: conn.rollback()
+            self._pool.putconn(conn, close=bool(conn.closed))
+        except Exception as e:
+            logger.warning(f"Connection not returned to pool: {e}")
+        finally:
+            self._slots.release()
+
+    def __del__(self):
+        # Возвращать соединение из финализатора небезопасно (GC в чужом потоке, пул уже закрыт):
+        # только сигнализируем об утечке слота
+        if getattr(self, '_conn', None) is not None:
+            logger.warning("Pooled DB connection garbage-collected without close()")
+
+
+def get_db_connection():
+    """Соединение из пула; None, если БД недоступна. Все соединения заняты дольше
+    DB_POOL_TIMEOUT — Busy."""
+    global _pool, _slots
+    try:
+        if _pool is None:
+            with _pool_lock:
+                if _pool is None:
+                    _slots = threading.BoundedSemaphore(_pool_size)
+                    _pool = ThreadedConnectionPool(DB_POOL_MIN, _pool_size, DATABASE_URL)
+    except Exception as e:
+        logger.error(f"DB connection error: {e}")
+        return None
+    pool, slots = _pool, _slots
+    if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+        logger.warning(f"DB pool exhausted: no free connection in {DB_POOL_TIMEOUT:g} s")
+        raise Busy('db')
+    try:
+        return PooledConnection(pool.getconn(), pool, slots)
+    except Exception as e:
+        slots.release()
+        logger.error(f"DB connection error: {e}")
+        return None
+
+
+def db_call(fn, *args):
+    """fn(cur, *args) в отдельной транзакции с коммитом; None, если БД недоступна.
+    Блокирующий вызов — из хендлеров через executors.run_io."""
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        result = fn(conn.cursor(), *args)
+        conn.commit()
+        return result
+    finally:
+        conn.close()
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None: _pool.closeall()
+        _pool = None
+
+
+# --- HTTP-КЛИЕНТ ДЛЯ ВЕБХУКОВ (одна keep-alive сессия на процесс) ---
+_session = None
+
+
+def http_session():
+    # requests импортируется при первом вебхуке, а не на старте бота
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+    return _session
+
+
+def post_webhook(url, payload, timeout):
+    return http_session().post(url, json=payload, timeout=timeout)
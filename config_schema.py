@@ -0,0 +1,206 @@
+import json
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+ZONES = ("1", "2", "3", "4", "5")
+UNITS = ('kg', 'm3')
+MARKUP = 1.30                   # T1_MARKUP необязателен: наценка по умолчанию
+CBM_RATE = 50                   # Ставка клиента выше — тариф за м³, не выше — за кг
+FALLBACK_WAREHOUSE = 'GZ'       # Неизвестный склад считается по тарифам GZ
+FALLBACK_CATEGORY = 'obshhie'   # Неизвестная категория — по тарифам obshhie
+# Город с зоной не из ZONES: T2 как и раньше — 5000 ₸ за любой диапазон и 260 ₸ за кг сверх.
+# Схема о таком городе предупреждает; перевод в настоящую зону — изменение цены, отдельным решением
+UNZONED_T2_COST = 5000
+UNZONED_T2_EXTRA_KG_RATE = 260
+
+# Полоса плотности Т1 и весовой диапазон Т2 (zones: зона -> стоимость, ₸)
+Band = namedtuple('Band', 'min_density price unit')
+WeightRange = namedtuple('WeightRange', 'max zones')
+
+
+class ConfigError(ValueError):
+    """config.json не прошел проверку схемы; в сообщении — все найденные ошибки."""
+
+
+class Config:
+    """Проверенный config.json: типы приведены, обязательные ключи на месте, полосы упорядочены.
+
+    Потребители берут поля напрямую, без .get() и подставных значений.
+    """
+    __slots__ = ('exchange_rate', 'greetings', 'zones', 'categories', 'prohibited_warning',
+                 'markup', 't1', 't2_ranges', 't2_extra_kg_rate', 'warnings')
+
+    def __init__(self, exchange_rate, greetings, zones, categories, prohibited_warning, markup, t1, t2_ranges, t2_extra_kg_rate, warnings=()):
+        self.exchange_rate = exchange_rate          # ₸ за $
+        self.greetings = greetings                  # (слово, ...)
+        self.zones = zones                          # {город в нижнем регистре: зона}
+        self.categories = categories                # {категория: (ключевые слова, ...)}
+        self.prohibited_warning = prohibited_warning
+        self.markup = markup
+        self.t1 = t1                                # {склад: {категория: (Band, ...) по убыванию плотности}}
+        self.t2_ranges = t2_ranges                  # (WeightRange, ...) по возрастанию веса
+        self.t2_extra_kg_rate = t2_extra_kg_rate    # {зона: ₸ за кг сверх последнего диапазона}
+        self.warnings = warnings                    # Не ошибки, но требуют внимания (город без зоны)
+
+
+class _Checker:
+    """Собирает ошибки с путями ключей, чтобы за один запуск увидеть все, а не первую."""
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+
+    def fail(self, path, message):
+        self.errors.append(f"{path}: {message}")
+
+    def warn(self, path, message):
+        self.warnings.append(f"{path}: {message}")
+
+    def of_type(self, path, value, kind, name):
+        if isinstance(value, kind) and not isinstance(value, bool): return True
+        self.fail(path, f"ожидался {name}, получено {value!r}"[:200])
+        return False
+
+    def number(self, path, value, minimum=None, positive=False):
+        if not self.of_type(path, value, (int, float), "число"): return 0.0
+        if positive and value <= 0: self.fail(path, f"должно быть > 0, получено {value}")
+        elif minimum is not None and value < minimum: self.fail(path, f"должно быть >= {minimum}, получено {value}")
+        return float(value)
+
+    def text(self, path, value):
+        if not self.of_type(path, value, str, "текст"): return ''
+        if not value.strip(): self.fail(path, "пустая строка")
+        return value
+
+    def mapping(self, path, value):
+        if not self.of_type(path, value, dict, "объект"): return {}
+        if not value: self.fail(path, "пустой объект")
+        return value
+
+    def items(self, path, value):
+        if not self.of_type(path, value, list, "список"): return []
+        if not value: self.fail(path, "пустой список")
+        return value
+
+    def zone_table(self, path, value, positive=True):
+        """{зона: число} ровно по ZONES: пропущенная зона — ошибка, а не подставные 5000/260."""
+        value = self.mapping(path, value)
+        for zone in value:
+            if zone not in ZONES: self.fail(f"{path}.{zone}", f"неизвестная зона, допустимы {', '.join(ZONES)}")
+        missing = [z for z in ZONES if z not in value]
+        if missing: self.fail(path, f"нет зон {', '.join(missing)}")
+        return {z: self.number(f"{path}.{z}", value[z], minimum=0, positive=positive) for z in ZONES if z in value}
+
+
+def _t1(check, raw, categories, markup):
+    t1 = {}
+    for wh, by_category in check.mapping('T1_RATES_DENSITY', raw.get('T1_RATES_DENSITY')).items():
+        path = f"T1_RATES_DENSITY.{wh}"
+        by_category = check.mapping(path, by_category)
+        if by_category and FALLBACK_CATEGORY not in by_category: check.fail(path, f"нет категории {FALLBACK_CATEGORY}")
+        missing = [c for c in categories if c not in by_category]
+        if by_category and missing: check.fail(path, f"нет тарифов для категорий {', '.join(missing)}")
+        t1[wh] = {}
+        for cat, bands in by_category.items():
+            cat_path = f"{path}.{cat}"
+            parsed = []
+            for i, band in enumerate(check.items(cat_path, bands)):
+                band_path = f"{cat_path}[{i}]"
+                if not check.of_type(band_path, band, dict, "объект"): continue
+                min_density = check.number(f"{band_path}.min_density", band.get('min_density'), minimum=0)
+                price = check.number(f"{band_path}.price", band.get('price'), positive=True)
+                unit = band.get('unit')
+                if unit not in UNITS: check.fail(f"{band_path}.unit", f"ожидалось {' или '.join(UNITS)}, получено {unit!r}")
+                # Единицу тарифа расчет определяет по величине ставки (CBM_RATE): они должны совпадать
+                elif (price * markup > CBM_RATE) != (unit == 'm3'):
+                    check.fail(band_path, f"ставка {price} × {markup} не соответствует единице {unit} (порог {CBM_RATE})")
+                if parsed and min_density >= parsed[-1].min_density:
+                    check.fail(band_path, f"полосы не упорядочены: min_density {min_density} после {parsed[-1].min_density}")
+                parsed.append(Band(min_density, price, unit))
+            t1[wh][cat] = tuple(parsed)
+    if t1 and FALLBACK_WAREHOUSE not in t1: check.fail('T1_RATES_DENSITY', f"нет склада {FALLBACK_WAREHOUSE}")
+    return t1
+
+
+def _t2(check, raw):
+    t2 = check.mapping('T2_RATES_DETAILED', raw.get('T2_RATES_DETAILED'))
+    parcel = check.mapping('T2_RATES_DETAILED.large_parcel', t2.get('large_parcel') if t2 else None)
+    ranges = []
+    path = 'T2_RATES_DETAILED.large_parcel.weight_ranges'
+    for i, r in enumerate(check.items(path, parcel.get('weight_ranges'))):
+        range_path = f"{path}[{i}]"
+        if not check.of_type(range_path, r, dict, "объект"): continue
+        top = check.number(f"{range_path}.max", r.get('max'), positive=True)
+        if ranges and top <= ranges[-1].max:
+            check.fail(range_path, f"диапазоны не упорядочены: max {top} после {ranges[-1].max}")
+        ranges.append(WeightRange(top, check.zone_table(f"{range_path}.zones", r.get('zones'))))
+    extra = check.zone_table('T2_RATES_DETAILED.large_parcel.extra_kg_rate', parcel.get('extra_kg_rate'), positive=False)
+    return tuple(ranges), extra
+
+
+def parse(raw):
+    """dict из config.json -> Config. ConfigError, если схема нарушена."""
+    check = _Checker()
+    if not check.of_type('config.json', raw, dict, "объект"): raise ConfigError("\n".join(check.errors))
+    known = {'EXCHANGE_RATE', 'GREETINGS', 'DESTINATION_ZONES', 'PRODUCT_CATEGORIES', 'PROHIBITED_GOODS',
+             'T1_MARKUP', 'T1_RATES_DENSITY', 'T2_RATES_DETAILED'}
+    unknown = sorted(set(raw) - known)
+    if unknown: logger.warning(f"config.json: unknown sections {unknown} are ignored")
+
+    exchange = check.mapping('EXCHANGE_RATE', raw.get('EXCHANGE_RATE'))
+    exchange_rate = check.number('EXCHANGE_RATE.rate', exchange.get('rate'), positive=True)
+
+    greetings = tuple(check.text(f"GREETINGS[{i}]", g).lower() for i, g in enumerate(check.items('GREETINGS', raw.get('GREETINGS'))))
+
+    zones = {}
+    for city, zone in check.mapping('DESTINATION_ZONES', raw.get('DESTINATION_ZONES')).items():
+        if str(zone) not in ZONES:
+            check.warn(f"DESTINATION_ZONES.{city}", f"неизвестная зона {zone!r} (допустимы {', '.join(ZONES)}): "
+                                                    f"T2 по {UNZONED_T2_COST} ₸ + {UNZONED_T2_EXTRA_KG_RATE} ₸/кг")
+        zones[city.lower().strip()] = str(zone)
+
+    categories = {}
+    for key, spec in check.mapping('PRODUCT_CATEGORIES', raw.get('PRODUCT_CATEGORIES')).items():
+        path = f"PRODUCT_CATEGORIES.{key}"
+        if not check.of_type(path, spec, dict, "объект"): continue
+        categories[key] = tuple(check.text(f"{path}.keywords[{i}]", w) for i, w in enumerate(check.items(f"{path}.keywords", spec.get('keywords'))))
+
+    prohibited = check.mapping('PROHIBITED_GOODS', raw.get('PROHIBITED_GOODS'))
+    warning = check.text('PROHIBITED_GOODS.warning_message', prohibited.get('warning_message'))
+
+    markup = check.number('T1_MARKUP', raw['T1_MARKUP'], positive=True) if 'T1_MARKUP' in raw else MARKUP
+    t1 = _t1(check, raw, categories, markup)
+    t2_ranges, t2_extra = _t2(check, raw)
+
+    if check.errors:
+        raise ConfigError(f"config.json не прошел проверку ({len(check.errors)}):\n" + "\n".join(check.errors))
+    for w in check.warnings: logger.warning(f"config.json: {w}")
+    return Config(exchange_rate, greetings, zones, categories, warning, markup, t1, t2_ranges, t2_extra, tuple(check.warnings))
+
+
+def loads(data):
+    """Содержимое config.json (bytes/str) -> Config."""
+    try: raw = json.loads(data)
+    except ValueError as e: raise ConfigError(f"config.json: невалидный JSON: {e}") from None
+    return parse(raw)
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+if __name__ == '__main__':
+    # Проверка перед выкладкой: python config_schema.py [config.json ...]; код выхода 1 при ошибках
+    import sys
+    status = 0
+    for path in sys.argv[1:] or ['config.json']:
+        try:
+            config = load(path)
+            print(f"✅ {path}: складов {len(config.t1)}, городов {len(config.zones)}, категорий {len(config.categories)}")
+        except (OSError, ValueError) as e:
+            print(f"❌ {path}: {e}")
+            status = 1
+    sys.exit(status)
@@ -0,0 +1,241 @@
+import os
+import io
+import time
+import logging
+import argparse
+from datetime import datetime
+from dotenv import load_dotenv
+from common import WAREHOUSE_NAMES
+from labels import draw_qr, label_payload
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+TEMPLATE_PATH = os.getenv('CONTRACT_TEMPLATE', 'contract_template.txt')
+FONT_DIR = os.getenv('CONTRACT_FONT_DIR', '/usr/share/fonts/truetype/dejavu')
+FONT, FONT_BOLD = 'DejaVuSans', 'DejaVuSans-Bold'
+
+# A4 в пунктах и поля страницы
+PAGE_W, PAGE_H = 595.27, 841.89
+MARGIN = 50
+TEXT_W = PAGE_W - 2 * MARGIN
+SIZE, LEADING = 10, 14
+ITEM_COLUMNS = (('Товар', 0), ('Вес, кг', 250), ('Объем, м³', 310), ('Ставка', 380), ('Сумма, $', 445))
+
+CONTRACT_COLUMNS = ('contract_num', 'fio', 'phone', 'client_city', 'warehouse_code', 'product',
+                    'COALESCE(actual_weight, declared_weight)', 'COALESCE(actual_volume, declared_volume)',
+                    'agreed_rate', 'total_price_final', 'track_number', 'created_at')
+
+_available = None
+_template = None
+_fonts = False
+
+
+def available():
+    """reportlab — необязательная зависимость: без нее контракт по-прежнему делает Make."""
+    global _available
+    if _available is None:
+        try:
+            import reportlab  # noqa: F401
+            _available = True
+        except ImportError:
+            logger.warning("reportlab not installed, contract PDFs are left to Make")
+            _available = False
+    return _available
+
+
+# --- ШАБЛОН ---
+
+def register_fonts():
+    """TTF с кириллицей регистрируются в reportlab один раз на процесс (договоры, этикетки)."""
+    global _fonts
+    if _fonts: return
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    for name in (FONT, FONT_BOLD):
+        pdfmetrics.registerFont(TTFont(name, os.path.join(FONT_DIR, name + '.ttf')))
+    _fonts = True
+
+
+class Template:
+    """Разобранный и сверстанный шаблон договора. Собирается один раз на процесс.
+
+    Абзацы без полей {…} переносятся по строкам заранее; с полями — при рендере,
+    но ширина глифов все равно берется из уже загруженных шрифтов.
+    """
+
+    def __init__(self, path):
+        from reportlab.lib.utils import simpleSplit
+        register_fonts()
+        self.split = simpleSplit
+        self.stamp = os.stat(path).st_mtime_ns
+        self.blocks = []        # (вид, шрифт, размер, строки | текст с полями)
+        with open(path, 'r', encoding='utf-8') as f: text = f.read()
+        for line in text.splitlines():
+            line = line.rstrip()
+            if not line: self.blocks.append(('gap', None, None, None))
+            elif line in ('[items]', '[sign]'): self.blocks.append((line[1:-1], None, None, None))
+            elif line.startswith('# '): self._add('title', FONT_BOLD, 13, line[2:])
+            elif line.startswith('## '): self._add('text', FONT_BOLD, SIZE, line[3:])
+            elif line.startswith('= '): self._add('place', FONT, SIZE, line[2:])
+            else: self._add('text', FONT, SIZE, line)
+
+    def _add(self, kind, font, size, text):
+        static = '{' not in text
+        self.blocks.append((kind, font, size, self.split(text, font, size, TEXT_W) if static else text))
+
+    def lines(self, payload, font, size, fields):
+        return payload if isinstance(payload, list) else self.split(payload.format_map(fields), font, size, TEXT_W)
+
+
+def get_template():
+    global _template
+    if _template is None or _template.stamp != os.stat(TEMPLATE_PATH).st_mtime_ns:
+        _template = Template(TEMPLATE_PATH)
+    return _template
+
+
+# --- ДАННЫЕ ---
+
+def _num(x, digits=2):
+    return f"{float(x or 0):,.{digits}f}".replace(',', ' ')
+
+
+def contract_fields(contract_num, fio, phone, city, warehouse_code, product, weight, volume, rate, total, track=None, created_at=None):
+    return {
+        'contract_num': contract_num, 'fio': fio or '—', 'phone': phone or '—', 'city': city or 'Алматы',
+        'warehouse': WAREHOUSE_NAMES.get(warehouse_code, warehouse_code or '—'), 'product': product or '—',
+        'weight': _num(weight, 1), 'volume': _num(volume, 3), 'rate': _num(rate), 'total': _num(total),
+        'track': track or 'будет присвоен при приемке', 'date': (created_at or datetime.now()).strftime('%d.%m.%Y'),
+    }
+
+
+def quote_items(quote):
+    """Строки таблицы груза из расчета (quotes.Quote)."""
+    return [(i.name, _num(i.weight, 1), _num(i.volume, 3), f"${i.rate}/{i.unit}", _num(i.cost)) for i in quote.items]
+
+
+def load_contracts(cur, contract_nums=None, days=None):
+    """[(contract_num, поля)] из shipments — для пакетной генерации."""
+    sql = f"SELECT {', '.join(CONTRACT_COLUMNS)} FROM shipments"
+    if contract_nums: cur.execute(sql + " WHERE contract_num = ANY(%s) ORDER BY created_at", (list(contract_nums),))
+    else: cur.execute(sql + " WHERE created_at > NOW() - %s * INTERVAL '1 day' ORDER BY created_at", (days or 1,))
+    return [(row[0], contract_fields(*row)) for row in cur.fetchall()]
+
+
+# --- РЕНДЕР ---
+
+def render_contract(fields, items=None):
+    """PDF договора (bytes). CPU-работа: из бота — через executors.run_cpu."""
+    from reportlab.pdfgen import canvas
+    tpl = get_template()
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=(PAGE_W, PAGE_H), pageCompression=1)
+    c.setTitle(f"Договор {fields['contract_num']}")
+    # QR с номером контракта: на складе его сканируют вместо выбора из списка ожидаемых
+    draw_qr(c, label_payload(fields['contract_num']), PAGE_W - MARGIN - 48, PAGE_H - MARGIN + 2, 46)
+    y = PAGE_H - MARGIN - 20
+
+    def need(height):
+        nonlocal y
+        if y - height < MARGIN:
+            c.showPage()
+            y = PAGE_H - MARGIN
+
+    for kind, font, size, payload in tpl.blocks:
+        if kind == 'gap':
+            y -= LEADING / 2
+        elif kind == 'items':
+            rows = items or [(fields['product'], fields['weight'], fields['volume'], f"${fields['rate']}", fields['total'])]
+            need(LEADING * 2)
+            c.setFont(FONT_BOLD, 9)
+            for title, x in ITEM_COLUMNS: c.drawString(MARGIN + x, y - LEADING, title)
+            y -= LEADING + 4
+            c.line(MARGIN, y + 1, PAGE_W - MARGIN, y + 1)
+            c.setFont(FONT, 9)
+            for row in rows:
+                need(LEADING)
+                y -= LEADING
+                for (_, x), value in zip(ITEM_COLUMNS, row): c.drawString(MARGIN + x, y, str(value)[:42])
+            y -= LEADING / 2
+        elif kind == 'sign':
+            need(LEADING * 5)
+            y -= LEADING * 2
+            c.setFont(FONT_BOLD, SIZE)
+            c.drawString(MARGIN, y, "Экспедитор: Post Pro")
+            c.drawString(MARGIN + TEXT_W / 2, y, f"Клиент: {fields['fio']}")
+            y -= LEADING * 2
+            c.setFont(FONT, SIZE)
+            c.drawString(MARGIN, y, "_______________ / подпись")
+            c.drawString(MARGIN + TEXT_W / 2, y, "_______________ / подпись")
+        else:
+            lines = tpl.lines(payload, font, size, fields)
+            leading = size * 1.4
+            need(leading * len(lines))
+            c.setFont(font, size)
+            for line in lines:
+                y -= leading
+                if kind == 'title': c.drawCentredString(PAGE_W / 2, y, line)
+                elif kind == 'place':
+                    left, _, right = line.partition(' | ')
+                    c.drawString(MARGIN, y, left)
+                    c.drawRightString(PAGE_W - MARGIN, y, right)
+                else: c.drawString(MARGIN, y, line)
+    c.save()
+    return buf.getvalue()
+
+
+def render_to_file(args):
+    """Для пула процессов в пакетном режиме: (поля, путь) -> размер файла."""
+    fields, path = args
+    data = render_contract(fields)
+    with open(path, 'wb') as f: f.write(data)
+    return len(data)
+
+
+def contract_filename(contract_num):
+    return f"contract_{contract_num}.pdf"
+
+
+async def reply_with_contract(message, fields, items=None):
+    """Рендерит договор в пуле процессов и отвечает им на message. Возвращает PDF или None."""
+    if not available(): return None
+    import executors
+    try:
+        pdf = await executors.run_cpu(render_contract, fields, items)
+        await message.reply_document(pdf, filename=contract_filename(fields['contract_num']))
+        return pdf
+    except Exception as e:
+        # Контракт уже создан: без PDF он остается рабочим, документ можно перевыпустить из CLI
+        logger.error(f"Contract PDF {fields['contract_num']} failed: {e}")
+        return None
+
+
+if __name__ == '__main__':
+    # python contract_pdf.py CN-1700000000 CN-1700000001 -o contracts/
+    # python contract_pdf.py --days 30 -o contracts/ [--workers 4]
+    # python contract_pdf.py --bench 500   (без БД, замер скорости)
+    from concurrent.futures import ProcessPoolExecutor
+    parser = argparse.ArgumentParser(description="Пакетная генерация договоров в PDF")
+    parser.add_argument('contracts', nargs='*')
+    parser.add_argument('--days', type=int)
+    parser.add_argument('--bench', type=int, help="N тестовых договоров без БД")
+    parser.add_argument('-o', '--output', default='contracts')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.bench:
+        jobs = [(f"CN-{1700000000 + n}", contract_fields(f"CN-{1700000000 + n}", "Иванов Иван", "+77010000000", "Астана", "GZ",
+                                                         "Одежда", 125.5, 0.84, 3.2, 401.6)) for n in range(args.bench)]
+    else:
+        import psycopg2
+        conn = psycopg2.connect(DATABASE_URL)
+        try: jobs = load_contracts(conn.cursor(), args.contracts, args.days)
+        finally: conn.close()
+    os.makedirs(args.output, exist_ok=True)
+    t = time.perf_counter()
+    with ProcessPoolExecutor(args.workers) as pool:
+        sizes = list(pool.map(render_to_file, [(f, os.path.join(args.output, contract_filename(cn))) for cn, f in jobs], chunksize=16))
+    seconds = time.perf_counter() - t
+    print(f"✅ {len(sizes)} договоров за {seconds:.1f} c ({len(sizes) / seconds * 60:.0f}/мин), {sum(sizes) / 1024 / 1024:.1f} МБ → {args.output}")
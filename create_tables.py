@@ -1,6 +1,8 @@
 import os
+import sys
 import psycopg2
 from dotenv import load_dotenv
+from common import WAREHOUSE_NAMES
 
 load_dotenv()
 DATABASE_URL = os.getenv('DATABASE_URL')
@@ -49,6 +51,194 @@ CREATE TABLE IF NOT EXISTS applications (
     calculated_cost REAL
 );
 
+-- Очередь приемки без фильтра склада (оператор нескольких складов); по одному складу — warehouse_indexes_sql
+CREATE INDEX IF NOT EXISTS idx_shipments_expected ON shipments (created_at DESC, contract_num DESC) WHERE status = 'оформлен';
+
+-- Коробки внутри груза (одна строка на место, с временем сканирования)
+CREATE TABLE IF NOT EXISTS packages (
+    id BIGSERIAL PRIMARY KEY,
+    contract_num TEXT NOT NULL REFERENCES shipments(contract_num) ON DELETE CASCADE,
+    box_no INTEGER NOT NULL,             -- Номер места в партии (1..N)
+    weight REAL,
+    volume REAL,
+    length REAL,                         -- Габариты в метрах (если вводились)
+    width REAL,
+    height REAL,
+    scanned_by TEXT,                     -- Кто принял коробку (Telegram id оператора)
+    scanned_at TIMESTAMP DEFAULT NOW(),
+    UNIQUE (contract_num, box_no)
+);
+
+-- Покрывающий индекс: итоги по контракту считаются index-only scan
+CREATE INDEX IF NOT EXISTS idx_packages_contract_totals ON packages (contract_num) INCLUDE (weight, volume, scanned_at);
+
+CREATE OR REPLACE VIEW shipment_package_totals AS
+SELECT contract_num,
+       COUNT(*) AS boxes,
+       SUM(weight) AS total_weight,
+       SUM(volume) AS total_volume,
+       MAX(scanned_at) AS last_scan
+FROM packages
+GROUP BY contract_num;
+
+-- Журнал смен статуса (только добавление)
+CREATE TABLE IF NOT EXISTS shipment_events (
+    id BIGSERIAL PRIMARY KEY,            -- Курсор для "события после X"
+    contract_num TEXT NOT NULL,
+    track_number TEXT,
+    warehouse_code TEXT,
+    status TEXT NOT NULL,
+    route_progress INTEGER,
+    actor TEXT,                          -- Кто сменил статус (Telegram id)
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    xid xid8 NOT NULL DEFAULT pg_current_xact_id()   -- Транзакция: курсор читателей (xid, id), см. events_since
+);
+
+CREATE INDEX IF NOT EXISTS idx_shipment_events_contract ON shipment_events (contract_num, id);
+CREATE INDEX IF NOT EXISTS idx_shipment_events_created ON shipment_events (created_at);
+
+CREATE OR REPLACE FUNCTION shipment_events_append_only() RETURNS trigger AS $$
+BEGIN
+    RAISE EXCEPTION 'shipment_events is append-only';
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_shipment_events_append_only ON shipment_events;
+CREATE TRIGGER trg_shipment_events_append_only BEFORE UPDATE OR DELETE ON shipment_events
+    FOR EACH ROW EXECUTE FUNCTION shipment_events_append_only();
+
+-- Будим воркер уведомлений после коммита пачки событий
+CREATE OR REPLACE FUNCTION shipment_events_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('shipment_events', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_shipment_events_notify ON shipment_events;
+CREATE TRIGGER trg_shipment_events_notify AFTER INSERT ON shipment_events
+    FOR EACH STATEMENT EXECUTE FUNCTION shipment_events_notify();
+
+-- Текущее состояние груза (проекция журнала)
+CREATE TABLE IF NOT EXISTS shipment_state (
+    contract_num TEXT PRIMARY KEY,
+    status TEXT,
+    route_progress INTEGER,
+    last_event_id BIGINT,
+    changed_at TIMESTAMP
+);
+
+-- Чаты клиентов, которые получают пуши о смене статуса
+CREATE TABLE IF NOT EXISTS shipment_subscribers (
+    contract_num TEXT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (contract_num, chat_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_shipment_subscribers_chat ON shipment_subscribers (chat_id);
+
+-- Позиция воркеров в журнале событий
+CREATE TABLE IF NOT EXISTS notifier_cursor (
+    name TEXT PRIMARY KEY,
+    last_event_id BIGINT NOT NULL DEFAULT 0,
+    last_xid xid8
+);
+
+-- Очередь вызовов Make.com: пишется в одной транзакции с грузом, отправляется релеем
+CREATE TABLE IF NOT EXISTS make_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    webhook TEXT NOT NULL,               -- Имя переменной окружения (MAKE_CONTRACT_WEBHOOK, ...)
+    payload JSONB NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_make_outbox_pending ON make_outbox (next_attempt_at, id) WHERE sent_at IS NULL;
+
+-- Планы загрузки фур: какой принятый груз в какую машину
+CREATE TABLE IF NOT EXISTS load_plans (
+    id SERIAL PRIMARY KEY,
+    warehouse_code TEXT NOT NULL,
+    created_by TEXT,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS load_plan_items (
+    plan_id INTEGER NOT NULL REFERENCES load_plans(id) ON DELETE CASCADE,
+    truck_no INTEGER NOT NULL,
+    contract_num TEXT NOT NULL,
+    zone TEXT,
+    dispatched_at TIMESTAMP,
+    PRIMARY KEY (plan_id, truck_no, contract_num)
+);
+
+-- Грузы неотправленных фур: повторный /plan их пропускает
+CREATE INDEX IF NOT EXISTS idx_load_plan_items_open ON load_plan_items (contract_num) WHERE dispatched_at IS NULL;
+
+-- Модель сроков доставки: когда груз достиг этапа, гистограммы плеч, готовая таблица ETA
+CREATE TABLE IF NOT EXISTS transit_marks (
+    contract_num TEXT NOT NULL,
+    stage TEXT NOT NULL,                 -- accepted / departed / border / almaty
+    reached_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (contract_num, stage)
+);
+
+CREATE TABLE IF NOT EXISTS transit_leg_hist (
+    warehouse_code TEXT NOT NULL,
+    leg TEXT NOT NULL,                   -- 'accepted>departed' и т.п.
+    bucket INTEGER NOT NULL,             -- Корзина по 6 часов
+    n INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (warehouse_code, leg, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS transit_eta (
+    warehouse_code TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    low_hours REAL,
+    high_hours REAL,
+    samples INTEGER,
+    PRIMARY KEY (warehouse_code, stage)
+);
+
+-- Идемпотентность побочных эффектов (создание/приемка) при повторной доставке апдейтов
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,                -- 'new_cargo:<chat>:<message_id>', 'contract:cb:<callback_id>' ...
+    result JSONB,                        -- Ответ первой попытки (номер контракта, трек)
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- События воронки калькулятора (только добавление, пишутся пачками из буфера бота)
+CREATE TABLE IF NOT EXISTS funnel_events (
+    id BIGSERIAL PRIMARY KEY,
+    session_id BIGINT,                   -- Проход калькулятора; NULL у входа /start
+    user_id BIGINT,
+    step TEXT NOT NULL,                  -- start, calc_start, city ... lead
+    step_no SMALLINT NOT NULL,           -- Порядковый номер шага (funnel.STEPS)
+    city TEXT,
+    category TEXT,
+    warehouse_code TEXT,
+    source TEXT,                         -- Метка из /start (tiktok, ...) или 'direct'
+    created_at TIMESTAMP NOT NULL
+);
+
+-- Время вставки растет вместе с id: BRIN на порядки меньше B-tree
+CREATE INDEX IF NOT EXISTS idx_funnel_events_created ON funnel_events USING BRIN (created_at);
+
+CREATE OR REPLACE FUNCTION funnel_events_append_only() RETURNS trigger AS $$
+BEGIN
+    RAISE EXCEPTION 'funnel_events is append-only';
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_funnel_events_append_only ON funnel_events;
+CREATE TRIGGER trg_funnel_events_append_only BEFORE UPDATE OR DELETE ON funnel_events
+    FOR EACH ROW EXECUTE FUNCTION funnel_events_append_only();
+
 -- Таблица расходов
 CREATE TABLE IF NOT EXISTS expenses (
     id SERIAL PRIMARY KEY,
@@ -59,6 +249,95 @@ CREATE TABLE IF NOT EXISTS expenses (
 );
 """
 
+# Дневные итоги P&L. Триггеры применяют дельту (OLD со знаком минус, NEW со знаком плюс),
+# поэтому отчет читает только строки за период и не зависит от объема истории.
+# Создается после ALTER: триггер ссылается на shipments.base_cost.
+PNL_ROLLUPS_SQL = """
+CREATE TABLE IF NOT EXISTS pnl_daily (
+    day DATE NOT NULL,                   -- Дата оформления груза (created_at)
+    warehouse_code TEXT NOT NULL,
+    category TEXT NOT NULL,
+    source TEXT NOT NULL,
+    shipments INTEGER NOT NULL DEFAULT 0,
+    revenue NUMERIC(14, 2) NOT NULL DEFAULT 0,      -- Сумма total_price_final, $
+    base_cost NUMERIC(14, 2) NOT NULL DEFAULT 0,    -- Сумма base_cost, $
+    PRIMARY KEY (day, warehouse_code, category, source)
+);
+
+CREATE TABLE IF NOT EXISTS expenses_daily (
+    day DATE NOT NULL,
+    category TEXT NOT NULL,              -- 'marketing', 'it', 'content', 'office'
+    amount NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, category)
+);
+
+CREATE OR REPLACE FUNCTION pnl_daily_add(s shipments, sign INTEGER) RETURNS void AS $$
+    INSERT INTO pnl_daily AS p (day, warehouse_code, category, source, shipments, revenue, base_cost)
+    VALUES (COALESCE(s.created_at::date, DATE '1970-01-01'), COALESCE(s.warehouse_code, 'GZ'),
+            COALESCE(s.category, 'obshhie'), COALESCE(s.source, 'Direct'),
+            sign, sign * COALESCE(s.total_price_final, 0)::numeric, sign * COALESCE(s.base_cost, 0)::numeric)
+    ON CONFLICT (day, warehouse_code, category, source) DO UPDATE SET
+        shipments = p.shipments + EXCLUDED.shipments,
+        revenue = p.revenue + EXCLUDED.revenue,
+        base_cost = p.base_cost + EXCLUDED.base_cost;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION pnl_daily_apply() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN PERFORM pnl_daily_add(OLD, -1); END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN PERFORM pnl_daily_add(NEW, 1); END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_pnl_daily_ins_del ON shipments;
+CREATE TRIGGER trg_pnl_daily_ins_del AFTER INSERT OR DELETE ON shipments
+    FOR EACH ROW EXECUTE FUNCTION pnl_daily_apply();
+
+DROP TRIGGER IF EXISTS trg_pnl_daily_upd ON shipments;
+CREATE TRIGGER trg_pnl_daily_upd AFTER UPDATE ON shipments
+    FOR EACH ROW WHEN ((OLD.total_price_final, OLD.base_cost, OLD.created_at, OLD.warehouse_code, OLD.category, OLD.source)
+                       IS DISTINCT FROM (NEW.total_price_final, NEW.base_cost, NEW.created_at, NEW.warehouse_code, NEW.category, NEW.source))
+    EXECUTE FUNCTION pnl_daily_apply();
+
+CREATE OR REPLACE FUNCTION expenses_daily_apply() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO expenses_daily AS e (day, category, amount)
+        VALUES (COALESCE(OLD.date, DATE '1970-01-01'), COALESCE(OLD.category, 'other'), -COALESCE(OLD.amount, 0))
+        ON CONFLICT (day, category) DO UPDATE SET amount = e.amount + EXCLUDED.amount;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO expenses_daily AS e (day, category, amount)
+        VALUES (COALESCE(NEW.date, DATE '1970-01-01'), COALESCE(NEW.category, 'other'), COALESCE(NEW.amount, 0))
+        ON CONFLICT (day, category) DO UPDATE SET amount = e.amount + EXCLUDED.amount;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_expenses_daily ON expenses;
+CREATE TRIGGER trg_expenses_daily AFTER INSERT OR UPDATE OR DELETE ON expenses
+    FOR EACH ROW EXECUTE FUNCTION expenses_daily_apply();
+"""
+
+
+def warehouse_indexes_sql(codes):
+    """Partial indexes на каждый склад: очередь приемки и принятые грузы (вход планировщика фур).
+
+    Индекс склада содержит только его строки — страницы очереди и выборки планировщика одного
+    склада не читают чужие, а новый склад из WAREHOUSE_NAMES получает свои индексы при запуске скрипта.
+    """
+    sql = []
+    for code in codes:
+        wh = code.lower()
+        sql.append(f"CREATE INDEX IF NOT EXISTS idx_shipments_expected_{wh} ON shipments (created_at DESC, contract_num DESC) "
+                   f"WHERE status = 'оформлен' AND warehouse_code = '{code}';")
+        sql.append(f"CREATE INDEX IF NOT EXISTS idx_shipments_accepted_{wh} ON shipments (contract_num) "
+                   f"WHERE status LIKE 'Принят на складе%' AND warehouse_code = '{code}';")
+    return sql
+
+
 # SQL для обновления существующей таблицы
 ALTER_TABLES_SQL = [
     "ALTER TABLE shipments ADD COLUMN IF NOT EXISTS category TEXT DEFAULT 'obshhie';",
@@ -66,10 +345,43 @@ ALTER_TABLES_SQL = [
     "ALTER TABLE applications ADD COLUMN IF NOT EXISTS city TEXT;",
     "ALTER TABLE applications ADD COLUMN IF NOT EXISTS total_weight REAL;",
     "ALTER TABLE applications ADD COLUMN IF NOT EXISTS total_volume REAL;",
-    "ALTER TABLE applications ADD COLUMN IF NOT EXISTS calculated_cost REAL;"
+    "ALTER TABLE applications ADD COLUMN IF NOT EXISTS calculated_cost REAL;",
+    "ALTER TABLE applications ADD COLUMN IF NOT EXISTS warehouse_code TEXT;",
+    "ALTER TABLE applications ADD COLUMN IF NOT EXISTS chat_id BIGINT;",
+    # Поиск /find: текст для триграмм (телефон дополнительно цифрами) и tsvector для словоформ
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+    """ALTER TABLE shipments ADD COLUMN IF NOT EXISTS search_text TEXT GENERATED ALWAYS AS (
+        coalesce(fio, '') || ' ' || coalesce(phone, '') || ' ' || regexp_replace(coalesce(phone, ''), '\\D', '', 'g')
+        || ' ' || coalesce(product, '') || ' ' || coalesce(client_city, '')) STORED;""",
+    """ALTER TABLE shipments ADD COLUMN IF NOT EXISTS search_tsv tsvector GENERATED ALWAYS AS (
+        to_tsvector('russian', coalesce(fio, '') || ' ' || coalesce(product, '') || ' ' || coalesce(client_city, ''))) STORED;""",
+    # Top-N без сортировки всех совпадений: KNN (<->>) умеет только GiST; GIN-индексы поиску больше не нужны
+    "CREATE INDEX IF NOT EXISTS idx_shipments_search_trgm_gist ON shipments USING GIST (search_text gist_trgm_ops);",
+    "DROP INDEX IF EXISTS idx_shipments_search_trgm;",
+    "DROP INDEX IF EXISTS idx_shipments_search_tsv;",
+    # P&L: себестоимость Т1 (цена перевозчика без наценки) рядом с total_price_final
+    "ALTER TABLE shipments ADD COLUMN IF NOT EXISTS base_cost REAL;",
+    PNL_ROLLUPS_SQL,
+    # Склады операторов: склад указан у каждого груза (раньше пустой склад означал GZ)
+    "UPDATE shipments SET warehouse_code = 'GZ' WHERE warehouse_code IS NULL;",
+    "ALTER TABLE shipments ALTER COLUMN warehouse_code SET DEFAULT 'GZ';",
+    *warehouse_indexes_sql(WAREHOUSE_NAMES),
+    "DROP INDEX IF EXISTS idx_shipments_expected_wh;",
+    "DROP INDEX IF EXISTS idx_shipments_accepted;",
+    # Курсор журнала по (xid, id): id выдается до коммита, поздний коммит с меньшим id терялся
+    "ALTER TABLE shipment_events ADD COLUMN IF NOT EXISTS xid xid8 NOT NULL DEFAULT pg_current_xact_id();",
+    "CREATE INDEX IF NOT EXISTS idx_shipment_events_xid ON shipment_events (xid, id);",
+    "ALTER TABLE notifier_cursor ADD COLUMN IF NOT EXISTS last_xid xid8;",
+    # Очередь приемки: курсор страниц — created_at, пустой ломал «Далее»
+    "UPDATE shipments SET created_at = NOW() WHERE created_at IS NULL;",
+    "ALTER TABLE shipments ALTER COLUMN created_at SET DEFAULT NOW();",
+    # /expected <имя|телефон>: префикс через LIKE — text_pattern_ops работает при любой collation
+    "CREATE INDEX IF NOT EXISTS idx_shipments_expected_fio ON shipments (lower(fio) text_pattern_ops) WHERE status = 'оформлен';",
+    "CREATE INDEX IF NOT EXISTS idx_shipments_expected_phone ON shipments (phone text_pattern_ops) WHERE status = 'оформлен';",
 ]
 
 conn = None
+failed = []
 try:
     conn = psycopg2.connect(DATABASE_URL)
     cursor = conn.cursor()
@@ -79,18 +391,27 @@ try:
     cursor.execute(CREATE_TABLES_SQL)
     print("✅ Основные таблицы созданы/проверены")
     
-    # Обновляем существующие таблицы
+    # Обновляем существующие таблицы. Каждая команда — в своей точке сохранения:
+    # ошибка одной (нет прав на CREATE EXTENSION) не обрывает транзакцию для остальных
     for alter_sql in ALTER_TABLES_SQL:
+        cursor.execute("SAVEPOINT alter_step")
         try:
             cursor.execute(alter_sql)
+            cursor.execute("RELEASE SAVEPOINT alter_step")
             print(f"✅ Выполнено: {alter_sql[:50]}...")
         except Exception as e:
-            print(f"⚠️ Предупреждение при выполнении ALTER: {e}")
+            cursor.execute("ROLLBACK TO SAVEPOINT alter_step")
+            failed.append(alter_sql)
+            print(f"❌ Ошибка: {alter_sql[:50]}...\n   {e}")
     
     conn.commit()
-    print("🎉 БАЗА ДАННЫХ ГОТОВА К РАБОТЕ!")
+    if failed:
+        print(f"⚠️ МИГРАЦИЯ ЗАВЕРШЕНА С ОШИБКАМИ: {len(failed)} из {len(ALTER_TABLES_SQL)} команд не выполнены")
+    else:
+        print("🎉 БАЗА ДАННЫХ ГОТОВА К РАБОТЕ!")
     
 except Exception as e:
+    failed.append(e)
     print(f"❌❌❌ КРИТИЧЕСКАЯ ОШИБКА: {e}")
     if conn:
         conn.rollback()
@@ -98,3 +419,5 @@ finally:
     if conn:
         cursor.close()
         conn.close()
+
+if failed: sys.exit(1)
@@ -0,0 +1,123 @@
+import os
+import time
+import asyncio
+import logging
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from common import DB_POOL_MAX, Busy, reserve_connections
+
+logger = logging.getLogger(__name__)
+
+# CPU: разбор манифестов, миниатюры, PDF, пересчет тарифов — в отдельных процессах (GIL)
+CPU_WORKERS = int(os.getenv('EXEC_CPU_WORKERS', max(1, (os.cpu_count() or 2) - 1)))
+# I/O: psycopg2 и requests блокируют поток; потоков не больше, чем соединений в пуле БД
+IO_WORKERS = int(os.getenv('EXEC_IO_WORKERS', DB_POOL_MAX))
+# Сколько задач может ждать своей очереди; дальше — Busy, а не бесконечный рост очереди
+CPU_QUEUE = int(os.getenv('EXEC_CPU_QUEUE', CPU_WORKERS * 4))
+IO_QUEUE = int(os.getenv('EXEC_IO_QUEUE', IO_WORKERS * 8))
+# Фоновые воркеры (outbox, нотификатор, модель транзита, воронка, стартовые проверки) —
+# run_in_executor(None, ...) в свой пул, чтобы не занимать потоки io мимо допуска
+BG_WORKERS = int(os.getenv('EXEC_BG_WORKERS', 4))
+# Потоки io и фоновые (стартовые проверки) берут соединения из общего пула: он не уже их суммы
+reserve_connections(IO_WORKERS + BG_WORKERS)
+ADMIT_TIMEOUT = float(os.getenv('EXEC_ADMIT_TIMEOUT', 5))
+BUSY_TEXT = "⏳ Сервер сейчас загружен, повторите через минуту."
+
+
+class Pool:
+    """Пул исполнителей с ограниченной очередью и счетчиками глубины/ожидания."""
+
+    def __init__(self, name, factory, workers, queue):
+        self.name = name
+        self.workers = workers
+        self.limit = workers + queue
+        self.stats = Counter()
+        self.waiting = 0
+        self.running = 0
+        self.max_latency = 0.0          # Ожидание допуска + выполнение
+        self._factory = factory
+        self._executor = None
+        self._admit = None
+
+    @property
+    def executor(self):
+        # Процессы стартуют при первой задаче, а не при импорте/запуске бота
+        if self._executor is None: self._executor = self._factory(self.workers)
+        return self._executor
+
+    async def run(self, fn, *args, timeout=ADMIT_TIMEOUT):
+        """await fn(*args) в пуле. Busy, если за timeout не освободилось место в очереди."""
+        if self._admit is None: self._admit = asyncio.Semaphore(self.limit)
+        t = time.monotonic()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._admit.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.stats['rejected'] += 1
+            raise Busy(self.name) from None
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.running -= 1
+            self._admit.release()
+            self.stats['done'] += 1
+            self.max_latency = max(self.max_latency, time.monotonic() - t)
+
+    def shutdown(self, wait=True):
+        if self._executor: self._executor.shutdown(wait=wait, cancel_futures=True)
+        self._executor = None
+
+    def format_stats(self):
+        # running — принятые пулом (в работе + в очереди executor), waiting — ждут допуска
+        return (f"{self.name}: workers {self.workers} | running {self.running}/{self.limit} | waiting {self.waiting} | "
+                f"done {self.stats['done']} | rejected {self.stats['rejected']} | max latency {self.max_latency:.1f} c")
+
+
+def _process_pool(workers):
+    # spawn: форк процесса с event loop, потоками и открытыми соединениями БД небезопасен
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def _thread_pool(workers):
+    return ThreadPoolExecutor(workers, thread_name_prefix='io')
+
+
+cpu = Pool('cpu', _process_pool, CPU_WORKERS, CPU_QUEUE)
+io = Pool('io', _thread_pool, IO_WORKERS, IO_QUEUE)
+
+
+async def run_cpu(fn, *args, timeout=ADMIT_TIMEOUT):
+    """CPU-задача в процессе: fn и аргументы должны пиклиться (функция модуля, не lambda)."""
+    return await cpu.run(fn, *args, timeout=timeout)
+
+
+async def run_io(fn, *args, timeout=ADMIT_TIMEOUT):
+    """Блокирующий I/O (psycopg2, requests) в потоке."""
+    return await io.run(fn, *args, timeout=timeout)
+
+
+_background = None
+
+
+def install(loop):
+    """Отдельный пул фоновых воркеров — executor по умолчанию для run_in_executor(None, ...).
+    Хендлеры идут только через run_io/run_cpu с допуском."""
+    global _background
+    if _background is None: _background = ThreadPoolExecutor(BG_WORKERS, thread_name_prefix='bg')
+    loop.set_default_executor(_background)
+
+
+def shutdown():
+    global _background
+    cpu.shutdown()
+    io.shutdown(wait=False)
+    if _background: _background.shutdown(wait=False, cancel_futures=True)
+    _background = None
+
+
+def format_stats():
+    return "\n".join(p.format_stats() for p in (cpu, io))
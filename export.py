@@ -0,0 +1,101 @@
+import os
+import re
+import gzip
+import argparse
+import tempfile
+from datetime import date
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+EXPORT_COLUMNS = (
+    'contract_num', 'track_number', 'created_at', 'status', 'warehouse_code', 'fio', 'phone', 'client_city',
+    'product', 'category', 'source', 'declared_weight', 'declared_volume', 'actual_weight', 'actual_volume',
+    'agreed_rate', 'additional_cost', 'total_price_final', 'base_cost', 'media_link',
+)
+TELEGRAM_MAX_FILE = 50 * 1024 * 1024
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+_LIKE_SPECIAL_RE = re.compile(r'([\\%_])')
+
+
+def parse_filters(args, warehouses):
+    """'/export 2025-01-01 2025-03-31 GZ В пути' -> {'date_from', 'date_to', 'warehouse', 'status'}."""
+    filters = {'date_from': None, 'date_to': None, 'warehouse': None, 'status': None}
+    rest = []
+    for a in args:
+        if _DATE_RE.match(a):
+            filters['date_to' if filters['date_from'] else 'date_from'] = date.fromisoformat(a)
+        elif a.upper() in warehouses and not filters['warehouse']:
+            filters['warehouse'] = a.upper()
+        else:
+            rest.append(a)
+    if rest: filters['status'] = " ".join(rest)
+    return filters
+
+
+def build_query(cur, date_from=None, date_to=None, warehouse=None, status=None):
+    """SELECT для COPY. COPY не принимает параметры, поэтому значения подставляет mogrify."""
+    where, params = [], []
+    if date_from: where.append("created_at >= %s"); params.append(date_from)
+    if date_to: where.append("created_at < %s::date + 1"); params.append(date_to)
+    if warehouse: where.append("warehouse_code = %s"); params.append(warehouse)
+    if status: where.append("status ILIKE %s"); params.append(_LIKE_SPECIAL_RE.sub(r'\\\1', status) + '%')
+    sql = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM shipments"
+    if where: sql += " WHERE " + " AND ".join(where)
+    return cur.mogrify(sql + " ORDER BY created_at, contract_num", params).decode()
+
+
+def export_csv_gz(conn, fileobj, **filters):
+    """Стримит выгрузку в fileobj как CSV.gz (UTF-8 с BOM для Excel).
+
+    COPY TO STDOUT отдает строки потоком прямо в gzip — память не зависит от числа строк.
+    Возвращает число строк.
+    """
+    with conn.cursor() as cur:
+        query = build_query(cur, **filters)
+        with gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6) as gz:
+            gz.write(b'\xef\xbb\xbf')  # BOM: Excel откроет кириллицу без мастера импорта
+            cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", gz)
+            rows = cur.rowcount
+    conn.rollback()
+    return rows
+
+
+def export_to_tempfile(dsn, **filters):
+    """(путь к временному .csv.gz, строк). Файл удаляет вызывающий."""
+    conn = psycopg2.connect(dsn)
+    try:
+        with tempfile.NamedTemporaryFile(prefix='shipments_', suffix='.csv.gz', delete=False) as f:
+            try: rows = export_csv_gz(conn, f, **filters)
+            except Exception:
+                os.unlink(f.name)
+                raise
+        return f.name, rows
+    finally:
+        conn.close()
+
+
+def export_filename(date_from=None, date_to=None, warehouse=None, status=None):
+    parts = ['shipments', warehouse, date_from and date_from.isoformat(), date_to and date_to.isoformat()]
+    return "_".join(p for p in parts if p) + ".csv.gz"
+
+
+if __name__ == '__main__':
+    # python export.py --from 2025-01-01 --to 2025-12-31 --wh GZ --status "В пути" -o shipments.csv.gz
+    parser = argparse.ArgumentParser(description="Выгрузка грузов в CSV.gz")
+    parser.add_argument('--from', dest='date_from', type=date.fromisoformat)
+    parser.add_argument('--to', dest='date_to', type=date.fromisoformat)
+    parser.add_argument('--wh', dest='warehouse')
+    parser.add_argument('--status')
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+    filters = {k: v for k, v in vars(args).items() if k != 'output'}
+    output = args.output or export_filename(**filters)
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        with open(output, 'wb') as f: rows = export_csv_gz(conn, f, **filters)
+    finally:
+        conn.close()
+    print(f"✅ {output}: {rows} строк, {os.path.getsize(output) / 1024 / 1024:.1f} МБ")
@@ -0,0 +1,170 @@
+import os
+import sys
+import random
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+FLUSH_SECONDS = 5
+FLUSH_SIZE = 500
+MAX_BUFFER = 50000          # Если БД недоступна долго — теряем самые старые события, а не память
+
+# Шаги калькулятора по порядку; 'start' — вход в бота (/start с меткой источника)
+STEPS = ('start', 'calc_start', 'city', 'warehouse', 'category', 'weight', 'volume', 'report', 'lead_form', 'name', 'lead')
+STEP_NO = {s: i for i, s in enumerate(STEPS)}
+STEP_TITLES = {
+    'calc_start': 'Открыл калькулятор', 'city': 'Город', 'warehouse': 'Склад', 'category': 'Категория',
+    'weight': 'Вес', 'volume': 'Объем', 'report': 'Получил расчет', 'lead_form': 'Нажал «Оставить заявку»',
+    'name': 'Имя', 'lead': 'Заявка',
+}
+
+_buffer = deque(maxlen=MAX_BUFFER)
+_wake = None
+
+
+def new_session(user_data):
+    """Новый проход калькулятора: шаги считаются по сессии, а не по пользователю."""
+    user_data['funnel_session'] = random.getrandbits(63)
+    for key in ('city', 'wh_code', 'current_item'): user_data.pop(key, None)
+
+
+def track(user_id, user_data, step):
+    """Кладет событие в буфер процесса. В БД ничего не пишется — это делает run_flusher пачками."""
+    item = user_data.get('current_item') or {}
+    _buffer.append((user_data.get('funnel_session'), user_id, step, STEP_NO[step], user_data.get('city'),
+                    item.get('category'), user_data.get('wh_code'), user_data.get('source') or 'direct', datetime.now()))
+    if len(_buffer) >= FLUSH_SIZE and _wake: _wake.set()
+
+
+def flush(conn):
+    """Один INSERT на пачку; при ошибке события возвращаются в буфер."""
+    batch = []
+    while _buffer: batch.append(_buffer.popleft())
+    if not batch: return 0
+    try:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO funnel_events (session_id, user_id, step, step_no, city, category, warehouse_code, source, created_at)
+                VALUES %s
+            """, batch, page_size=1000)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        _buffer.extendleft(reversed(batch))
+        raise
+    return len(batch)
+
+
+async def run_flusher(dsn):
+    """Фоновый сброс буфера воронки раз в FLUSH_SECONDS (или сразу при FLUSH_SIZE событий)."""
+    global _wake
+    loop = asyncio.get_running_loop()
+    _wake = asyncio.Event()
+    conn = None
+    try:
+        while True:
+            try: await asyncio.wait_for(_wake.wait(), FLUSH_SECONDS)
+            except asyncio.TimeoutError: pass
+            _wake.clear()
+            if not _buffer: continue
+            try:
+                if conn is None or conn.closed:
+                    conn = await loop.run_in_executor(None, psycopg2.connect, dsn)
+                await loop.run_in_executor(None, flush, conn)
+            except Exception as e:
+                logger.error(f"Funnel flush error: {e}")
+                if conn: conn.close()
+                conn = None
+    except asyncio.CancelledError:
+        # Остановка бота: дописываем хвост синхронно
+        try:
+            if _buffer:
+                if conn is None or conn.closed: conn = psycopg2.connect(dsn)
+                flush(conn)
+        except Exception as e:
+            logger.error(f"Funnel final flush lost {len(_buffer)} events: {e}")
+        if conn: conn.close()
+        raise
+
+
+# --- АГРЕГАТЫ ---
+
+SESSIONS_SQL = """
+WITH s AS (
+    SELECT session_id, MAX(step_no) AS reached, initcap(trim(MAX(city))) AS city,
+           MIN(category) AS category, MAX(source) AS source
+    FROM funnel_events
+    WHERE session_id IS NOT NULL AND created_at > NOW() - %(days)s * INTERVAL '1 day'
+    GROUP BY session_id
+)
+"""
+
+
+def dropoff(cur, days=30):
+    """[(шаг, сессий дошло)] по порядку шагов калькулятора."""
+    cur.execute(SESSIONS_SQL + """
+        SELECT k, COUNT(*) FILTER (WHERE reached >= k) FROM s, generate_series(%(first)s, %(last)s) AS k
+        GROUP BY k ORDER BY k
+    """, {'days': days, 'first': STEP_NO['calc_start'], 'last': STEP_NO['lead']})
+    return [(STEPS[k], n) for k, n in cur.fetchall()]
+
+
+def conversion_by(cur, dim, days=30, limit=15):
+    """[(значение, сессий, дошли до расчета, заявок)] по городу / категории / источнику."""
+    assert dim in ('city', 'category', 'source')
+    cur.execute(SESSIONS_SQL + f"""
+        SELECT COALESCE({dim}, '—'), COUNT(*), COUNT(*) FILTER (WHERE reached >= %(report)s),
+               COUNT(*) FILTER (WHERE reached >= %(lead)s)
+        FROM s GROUP BY 1 ORDER BY 2 DESC LIMIT %(limit)s
+    """, {'days': days, 'report': STEP_NO['report'], 'lead': STEP_NO['lead'], 'limit': limit})
+    return cur.fetchall()
+
+
+def attribution(cur, days=30):
+    """[(источник, входов /start, сессий калькулятора, заявок)] — метка из ссылки t.me/<bot>?start=tiktok."""
+    cur.execute("""
+        SELECT source,
+               COUNT(*) FILTER (WHERE step = 'start'),
+               COUNT(DISTINCT session_id) FILTER (WHERE step = 'calc_start'),
+               COUNT(DISTINCT session_id) FILTER (WHERE step = 'lead')
+        FROM funnel_events WHERE created_at > NOW() - %s * INTERVAL '1 day'
+        GROUP BY source ORDER BY 2 DESC
+    """, (days,))
+    return cur.fetchall()
+
+
+def _pct(part, whole):
+    return f"{part / whole * 100:5.1f}%" if whole else "    —"
+
+
+def report(conn, days=30):
+    cur = conn.cursor()
+    steps = dropoff(cur, days)
+    print(f"\n🧭 Воронка калькулятора за {days} дн.")
+    top = steps[0][1] if steps else 0
+    prev = top
+    for step, n in steps:
+        print(f"  {STEP_TITLES[step]:26} {n:7} | от входа {_pct(n, top)} | от шага {_pct(n, prev)}")
+        prev = n
+    for dim, title in (('city', 'Города'), ('category', 'Категории')):
+        print(f"\n{title}:")
+        for key, sessions, reports, leads in conversion_by(cur, dim, days):
+            print(f"  {key:22} {sessions:6} сесс. | расчет {_pct(reports, sessions)} | заявка {_pct(leads, sessions)}")
+    print("\nИсточники (TikTok и др.):")
+    for source, starts, sessions, leads in attribution(cur, days):
+        print(f"  {source:22} /start {starts:6} | калькулятор {sessions:6} | заявок {leads:5} | CR {_pct(leads, starts or sessions)}")
+
+
+if __name__ == '__main__':
+    # python funnel.py [дней]
+    conn = psycopg2.connect(DATABASE_URL)
+    try: report(conn, int(sys.argv[1]) if len(sys.argv) > 1 else 30)
+    finally: conn.close()
@@ -1,15 +1,24 @@
 import os
 import logging
 import random
-import psycopg2
-import requests
-import json
 import time
-from datetime import datetime
+import asyncio
+from datetime import datetime, timedelta
 # FIX: Добавлен ReplyKeyboardRemove в импорты
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler
 from dotenv import load_dotenv
+from common import WAREHOUSE_NAMES, CATEGORY_BUTTONS, clean_number, get_db_connection, db_call, close_pool
+from tariff_matrix import get_matrix
+from volume_parser import parse_boxes
+from packages import parse_weights, check_packages, build_packages, price_packages, base_cost_packages, insert_packages
+from shipment_events import update_status_bulk, append_event
+import outbox
+import idempotency
+import operators
+import executors
+import contract_pdf
+import labels
 
 # --- НАСТРОЙКИ ---
 load_dotenv()
@@ -21,24 +30,7 @@ MAKE_CONTRACT_WEBHOOK = os.getenv('MAKE_CONTRACT_WEBHOOK')
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# --- КОНФИГУРАЦИЯ ---
-try:
-    with open('config.json', 'r', encoding='utf-8') as f:
-        CONFIG = json.load(f)
-    T1_RATES = CONFIG.get('T1_RATES_DENSITY', {})
-except:
-    T1_RATES = {}
-
-WAREHOUSE_NAMES = {"GZ": "Гуанчжоу", "FS": "Фошань", "IW": "Иу"}
-
-# --- КАТЕГОРИИ ---
-CATEGORY_BUTTONS = {
-    "odezhda": "👕 Одежда", "obuv": "👟 Обувь", "sumki": "👜 Сумки",
-    "tovary_dlja_doma": "🏠 Хозтовары", "igrushki": "🧸 Игрушки", "mebel": "🛋 Мебель",
-    "elektronika": "💻 Электроника", "telefony": "📱 Телефоны", "avtozapchasti": "🚗 Автозапчасти",
-    "santehnika": "🚿 Сантехника", "oborudovanie": "⚙️ Оборудование", "strojmaterialy": "🧱 Строймат.",
-    "tovary_dlja_zhivotnyh": "🐾 Зоотовары", "obshhie": "📦 Прочее"
-}
+# Тарифы из config.json загружает tariff_matrix (лениво, с кэшем config.cache)
 
 # --- СОСТОЯНИЯ ---
 (WAITING_ACTUAL_WEIGHT, WAITING_ACTUAL_VOLUME, WAITING_ADDITIONAL_COST, WAITING_MEDIA) = range(4)
@@ -47,56 +39,33 @@ WAITING_STATUS_TRACK = 5
 # Для "Нового Груза"
 (NEW_FIO, NEW_WH, NEW_PROD, NEW_WEIGHT, NEW_VOLUME, NEW_COST, NEW_MEDIA) = range(6, 13)
 
-# --- ФУНКЦИИ ---
-
-def get_db_connection():
-    try: return psycopg2.connect(DATABASE_URL)
-    except: return None
-
-def clean_number(text):
-    if not text: return 0.0
-    try: return float(text.replace(',', '.').strip())
-    except: return 0.0
+VOLUME_RETRY_TEXT = "⚠️ Объем не распознан. Введите м³ (0.5 или 2 м куб) или габариты в см (60*40*50, 10 шт 60*40*50):"
 
-def notify_make_update(payload):
-    if not MAKE_WAREHOUSE_WEBHOOK: return
-    try: requests.post(MAKE_WAREHOUSE_WEBHOOK, json=payload, timeout=3)
-    except: pass
-
-def notify_make_create(payload):
-    if not MAKE_CONTRACT_WEBHOOK: return
-    try: requests.post(MAKE_CONTRACT_WEBHOOK, json=payload, timeout=5)
-    except: pass
+# --- ФУНКЦИИ ---
 
 def calculate_t1_full(weight, volume, category_key, warehouse_code, agreed_rate_min=0):
-    rates = T1_RATES.get(warehouse_code, T1_RATES.get('GZ', {}))
-    cat_rates = rates.get(category_key, rates.get('obshhie'))
-    
-    density = weight / volume if volume > 0 else 9999.0
-    base_price = 0
-    
-    if cat_rates:
-        for r in sorted(cat_rates, key=lambda x: x.get('min_density', 0), reverse=True):
-            if density >= r.get('min_density', 0):
-                base_price = r.get('price', 0); break
-        if base_price == 0: base_price = cat_rates[-1].get('price', 0)
-    
-    calculated_rate = base_price * 1.30
-    final_rate_unit = max(calculated_rate, agreed_rate_min)
-    
-    is_cbm = final_rate_unit > 50 
-    cost = (final_rate_unit * volume) if is_cbm else (final_rate_unit * weight)
-    
+    cost, final_rate_unit, density, is_cbm = get_matrix().t1_rate(weight, volume, category_key, warehouse_code, agreed_rate_min)
     return round(cost, 2), round(final_rate_unit, 2), round(density, 0), is_cbm
 
 # --- СБРОС БАЗЫ ДАННЫХ ---
+def wipe_shipments(cur):
+    # DELETE, а не TRUNCATE: триггеры pnl_daily вычитают удаленные грузы, packages — каскадом
+    cur.execute("DELETE FROM shipments") # Полная очистка таблицы
+    # Все, что построено по грузам: журнал, подписки, отметки и модель транзита, планы фур,
+    # ключи идемпотентности (иначе повтор вернул бы трек удаленного груза)
+    cur.execute("""
+        TRUNCATE shipment_events, shipment_state, shipment_subscribers, transit_marks, transit_leg_hist, transit_eta,
+                 load_plan_items, load_plans, idempotency_keys
+    """)
+    return True
+
 async def reset_database(u, c):
-    conn = get_db_connection()
-    if conn:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM shipments") # Полная очистка таблицы
-        conn.commit()
-        conn.close()
+    if not operators.is_manager(u.effective_user.id):
+        await u.message.reply_text("⛔ Сброс базы доступен только оператору всех складов."); return
+    try: wiped = await executors.run_io(db_call, wipe_shipments)
+    except executors.Busy:
+        await u.message.reply_text(executors.BUSY_TEXT); return
+    if wiped:
         await u.message.reply_text("🗑 <b>ВСЕ ДАННЫЕ УДАЛЕНЫ!</b>\nБаза бота полностью очищена.", parse_mode='HTML')
     else:
         await u.message.reply_text("Ошибка подключения к БД.")
@@ -118,24 +87,95 @@ async def cancel(u, c): await u.message.reply_text("Отмена.", reply_markup
 
 # --- СЦЕНАРИЙ 1: ПРИЕМКА ОЖИДАЕМОГО ---
 
-async def show_expected(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db_connection()
-    if not conn: return
-    cur = conn.cursor()
-    cur.execute("SELECT contract_num, fio, product FROM shipments WHERE status ILIKE 'оформлен' ORDER BY created_at DESC LIMIT 15")
+EXPECTED_PAGE_SIZE = 15
+EPOCH = datetime(1970, 1, 1)
+
+def like_prefix(text):
+    """Начало строки для LIKE: % и _ из ввода — буквально."""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def fetch_expected(cur, scope, wh=None, q=None, cursor=None):
+    """Страница оформленных контрактов складов оператора (keyset по created_at, contract_num).
+    Возвращает (строки, есть_еще). Один склад — свой partial index idx_shipments_expected_<склад>;
+    поиск по началу имени/телефона — text_pattern_ops индексы idx_shipments_expected_fio/_phone.
+    Без created_at курсор не построить: такие строки миграция заполняет, здесь — отсекаем."""
+    sql = ("SELECT contract_num, fio, product, created_at FROM shipments "
+           "WHERE status = 'оформлен' AND created_at IS NOT NULL AND warehouse_code = ANY(%s)")
+    params = [[wh] if wh else list(scope)]
+    if q:
+        # ILIKE не использует индекс: префикс по lower(fio), как в индексе
+        sql += " AND (lower(fio) LIKE lower(%s) OR phone LIKE %s)"; params += [like_prefix(q), like_prefix(q)]
+    if cursor:
+        sql += " AND (created_at, contract_num) < (%s, %s)"; params += list(cursor)
+    sql += " ORDER BY created_at DESC, contract_num DESC LIMIT %s"
+    params.append(EXPECTED_PAGE_SIZE + 1)
+
+    cur.execute(sql, params)
     rows = cur.fetchall()
-    conn.close()
+    return rows[:EXPECTED_PAGE_SIZE], len(rows) > EXPECTED_PAGE_SIZE
+
+def encode_cursor(created_at, contract_num):
+    # callback_data в Telegram — максимум 64 байта: "expn_<мкс с 1970>_<контракт>"
+    if created_at is None: return None
+    data = f"expn_{(created_at - EPOCH) // timedelta(microseconds=1)}_{contract_num}"
+    return data if len(data.encode()) <= 64 else None
+
+def decode_cursor(data):
+    micros, cn = data[len("expn_"):].split("_", 1)
+    return EPOCH + timedelta(microseconds=int(micros)), cn
+
+def render_expected(rows, has_more, wh, scope):
+    keyboard = [[InlineKeyboardButton(
+        ("✅ " if (wh or "*") == code else "") + (code if code != "*" else "Все"), callback_data=f"expw_{code}")
+        for code in ("*",) + scope]] if len(scope) > 1 else []
+    for cn, fio, product, _ in rows:
+        keyboard.append([InlineKeyboardButton(f"{fio} | {product}", callback_data=f"accept_{cn}")])
+    if has_more and rows:
+        next_data = encode_cursor(rows[-1][3], rows[-1][0])
+        if next_data: keyboard.append([InlineKeyboardButton("➡️ Далее", callback_data=next_data)])
+    return InlineKeyboardMarkup(keyboard)
+
+async def show_expected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /expected [GZ|FS|IW] [имя или начало телефона]
+    args = list(context.args or [])
+    scope = context.user_data['scope']
+    wh = args.pop(0).upper() if args and args[0].upper() in scope else None
+    q = " ".join(args) or None
+    context.user_data['exp_filter'] = (wh, q)
+    try: rows, has_more = await executors.run_io(db_call, fetch_expected, scope, wh, q) or ([], False)
+    except executors.Busy:
+        await update.message.reply_text(executors.BUSY_TEXT); return
     
-    if not rows:
+    if not rows and not wh and not q:
         await update.message.reply_text("📋 Список пуст. Нет оформленных контрактов.")
         return
-
-    keyboard = []
-    for row in rows:
-        text = f"{row[1]} | {row[2]}"
-        keyboard.append([InlineKeyboardButton(text, callback_data=f"accept_{row[0]}")])
     
-    await update.message.reply_text("📋 <b>Выберите груз для приемки:</b>", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+    title = "📋 <b>Выберите груз для приемки:</b>" + (f"\n🔎 {q}" if q else "")
+    await update.message.reply_text(title, reply_markup=render_expected(rows, has_more, wh, scope), parse_mode='HTML')
+
+async def expected_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    wh, q = context.user_data.get('exp_filter', (None, None))
+    scope = context.user_data['scope']
+    cursor = None
+    if query.data.startswith("expw_"):
+        code = query.data[len("expw_"):]
+        wh = code if code in scope else None
+        context.user_data['exp_filter'] = (wh, q)
+    else:
+        cursor = decode_cursor(query.data)
+    try: rows, has_more = await executors.run_io(db_call, fetch_expected, scope, wh if wh in scope else None, q, cursor) or ([], False)
+    except executors.Busy:
+        await query.message.reply_text(executors.BUSY_TEXT); return
+    text = "📋 <b>Выберите груз для приемки:</b>" + (f"\n🔎 {q}" if q else "")
+    if not rows: text += "\n\nНичего не найдено."
+    await query.edit_message_text(text, reply_markup=render_expected(rows, has_more, wh, scope), parse_mode='HTML')
+
+def load_contract(cur, cn, scope):
+    cur.execute("SELECT fio, agreed_rate, product, warehouse_code FROM shipments WHERE contract_num = %s AND warehouse_code = ANY(%s)",
+                (cn, list(scope)))
+    return cur.fetchone()
 
 async def start_contract_receive_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -143,44 +183,46 @@ async def start_contract_receive_button(update: Update, context: ContextTypes.DE
     cn = query.data.replace("accept_", "")
     context.user_data['cn'] = cn
     
-    conn = get_db_connection()
-    if conn:
-        cur = conn.cursor()
-        cur.execute("SELECT fio, agreed_rate, product, warehouse_code FROM shipments WHERE contract_num = %s", (cn,))
-        row = cur.fetchone()
-        conn.close()
-        if row:
-            wh_code = row[3] if row[3] else "GZ"
-            context.user_data.update({'fio': row[0], 'agreed_rate': float(row[1] or 0), 'prod': row[2], 'wh': wh_code})
-            wh_name = WAREHOUSE_NAMES.get(wh_code, wh_code)
-            await query.edit_message_text(f"📥 <b>Приемка: {cn}</b>\n🏭 Склад плана: <b>{wh_name}</b>\n👤 {row[0]}\n📦 {row[2]}\n\n⚖️ <b>Введите ФАКТИЧЕСКИЙ ВЕС (кг):</b>", parse_mode='HTML')
-            return WAITING_ACTUAL_WEIGHT
+    try: row = await executors.run_io(db_call, load_contract, cn, context.user_data['scope'])
+    except executors.Busy:
+        await query.message.reply_text(executors.BUSY_TEXT); return ConversationHandler.END
+    if row:
+        wh_code = row[3]
+        context.user_data.update({'fio': row[0], 'agreed_rate': float(row[1] or 0), 'prod': row[2], 'wh': wh_code})
+        wh_name = WAREHOUSE_NAMES.get(wh_code, wh_code)
+        await query.edit_message_text(f"📥 <b>Приемка: {cn}</b>\n🏭 Склад плана: <b>{wh_name}</b>\n👤 {row[0]}\n📦 {row[2]}\n\n⚖️ <b>Введите ФАКТИЧЕСКИЙ ВЕС (кг):</b>", parse_mode='HTML')
+        return WAITING_ACTUAL_WEIGHT
     
     await query.edit_message_text("❌ Ошибка: Контракт не найден.")
     return ConversationHandler.END
 
 async def get_actual_weight(u, c):
-    c.user_data['fact_w'] = clean_number(u.message.text)
-    await u.message.reply_text("📏 <b>Введите ФАКТИЧЕСКИЙ ОБЪЕМ (м³):</b>\n(Например: 0.5 или 60*40*50)", parse_mode='HTML')
+    # Несколько мест: веса через пробел ("12.5 14 13")
+    weights = parse_weights(u.message.text)
+    c.user_data['fact_weights'] = weights
+    c.user_data['fact_w'] = round(sum(weights), 3)
+    await u.message.reply_text("📏 <b>Введите ФАКТИЧЕСКИЙ ОБЪЕМ (м³):</b>\n(Например: 0.5 или 60*40*50; разные коробки — через ;)", parse_mode='HTML')
     return WAITING_ACTUAL_VOLUME
 
 async def get_actual_volume(u, c):
-    text = u.message.text
-    if '*' in text or 'х' in text or 'x' in text:
-        try:
-            dims = text.replace('х', 'x').replace('*', 'x').split('x')
-            v = (float(dims[0]) * float(dims[1]) * float(dims[2])) / 1000000
-        except: v = 0.0
-    else:
-        v = clean_number(text)
-        
-    if v <= 0: v = c.user_data['fact_w'] / 200
-    c.user_data['fact_v'] = v
+    boxes = parse_boxes(u.message.text)
+    v = round(sum(b.volume * b.count for b in boxes), 4)
+    if v <= 0:
+        await u.message.reply_text(VOLUME_RETRY_TEXT)
+        return WAITING_ACTUAL_VOLUME
     d = c.user_data
-    cost, final_rate, dens, is_cbm = calculate_t1_full(d['fact_w'], v, d['prod'], d['wh'], d['agreed_rate'])
-    c.user_data['final_calc'] = {'cost': cost, 'rate': final_rate, 'is_cbm': is_cbm}
+    error = check_packages(d.get('fact_weights', []), boxes)
+    if error:
+        await u.message.reply_text(error)
+        return WAITING_ACTUAL_VOLUME
+    c.user_data['fact_v'] = v
+    pieces = build_packages(d.get('fact_weights', []), boxes, v)
+    c.user_data['packages'] = pieces
+    cost, final_rate, dens, is_cbm = price_packages(pieces, d['fact_w'], v, d['prod'], d['wh'], d['agreed_rate'])
+    base = base_cost_packages(pieces, d['fact_w'], v, d['prod'], d['wh'], d['agreed_rate'])
+    c.user_data['final_calc'] = {'cost': cost, 'rate': final_rate, 'is_cbm': is_cbm, 'base': base}
     
-    await u.message.reply_text(f"✅ Вес: {d['fact_w']} кг | V: {v:.3f} м³\n💰 База: ${cost}\n\n🛠 <b>Нужны доп. услуги (упаковка/обрешетка)?</b>\n👉 Если да — введите сумму ($)\n👉 Если нет — напишите 0", parse_mode='HTML')
+    await u.message.reply_text(f"✅ Вес: {d['fact_w']} кг | V: {v:.3f} м³ | Мест: {len(pieces)}\n💰 База: ${cost}\n\n🛠 <b>Нужны доп. услуги (упаковка/обрешетка)?</b>\n👉 Если да — введите сумму ($)\n👉 Если нет — напишите 0", parse_mode='HTML')
     return WAITING_ADDITIONAL_COST
 
 async def get_additional_cost(u, c):
@@ -188,6 +230,23 @@ async def get_additional_cost(u, c):
     await u.message.reply_text("📸 <b>Сделайте ФОТО груза:</b>\n(Или нажмите /skip)", parse_mode='HTML')
     return WAITING_MEDIA
 
+def accept_cargo(cur, key, result, params, cn, scope, pieces, actor, payload):
+    """Записывает приемку. {'track', 'total'} — ее трек и сумма (при повторе того же сообщения —
+    первой попытки); False — контракта нет на складах оператора."""
+    if not idempotency.execute_claimed(cur, key, result, """
+        UPDATE shipments 
+        SET status=%s, track_number=%s, actual_weight=%s, actual_volume=%s, 
+            additional_cost=%s, total_price_final=%s, base_cost=%s, agreed_rate=%s, media_link=%s
+        FROM claim WHERE contract_num=%s AND warehouse_code = ANY(%s)
+    """, params + (cn, list(scope)),
+            exists="SELECT 1 FROM shipments WHERE contract_num=%s AND warehouse_code = ANY(%s)", exists_params=(cn, list(scope))):
+        # Нет ключа — UPDATE не нашел контракт; есть — приемка уже записана первой попыткой
+        return idempotency.stored_result(cur, key) or False
+    insert_packages(cur, cn, pieces, actor)
+    append_event(cur, cn, actor)
+    outbox.enqueue(cur, 'MAKE_WAREHOUSE_WEBHOOK', payload, f"update:{cn}:{result['track']}")
+    return result
+
 async def save_contract_final(u, c):
     media_link = "Без медиа"
     if u.message.photo:
@@ -204,20 +263,27 @@ async def save_contract_final(u, c):
     total_price = round(calc['cost'] + d['add_cost'], 2)
     status = f"Принят на складе {prefix}"
     
-    conn = get_db_connection()
-    if conn:
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE shipments 
-            SET status=%s, track_number=%s, actual_weight=%s, actual_volume=%s, 
-                additional_cost=%s, total_price_final=%s, agreed_rate=%s, media_link=%s
-            WHERE contract_num=%s
-        """, (status, track, d['fact_w'], d['fact_v'], d['add_cost'], total_price, calc['rate'], media_link, d['cn']))
-        conn.commit(); conn.close()
-    
-    notify_make_update({"action": "update", "contract_num": d['cn'], "track": track, "actual_weight": d['fact_w'], "actual_volume": d['fact_v'], "total_price": total_price, "status": status, "media_link": media_link})
+    try:
+        accepted = await executors.run_io(db_call, accept_cargo, idempotency.message_key('accept', u), {'track': track, 'total': total_price},
+                                          (status, track, d['fact_w'], d['fact_v'], d['add_cost'], total_price, calc['base'], calc['rate'], media_link),
+                                          d['cn'], d['scope'], d.get('packages') or build_packages([d['fact_w']], [], d['fact_v']), str(u.effective_user.id),
+                                          {"action": "update", "contract_num": d['cn'], "track": track, "actual_weight": d['fact_w'], "actual_volume": d['fact_v'], "total_price": total_price, "status": status, "media_link": media_link})
+    except executors.Busy:
+        await u.message.reply_text(executors.BUSY_TEXT); return WAITING_MEDIA
+    if accepted is None:
+        await u.message.reply_text("Ошибка подключения к БД.")
+        return ConversationHandler.END
+    if accepted is False:
+        await u.message.reply_text("❌ Ошибка: Контракт не найден.")
+        return ConversationHandler.END
+    if accepted['track'] != track:
+        # Повтор того же сообщения: приемка уже записана, отвечаем ее треком
+        await u.message.reply_text(f"✅ <b>ГРУЗ ПРИНЯТ!</b>\n🆔 Трек: <code>{accepted['track']}</code>\n💰 Итого: <b>${accepted['total']}</b>", parse_mode='HTML')
+        return ConversationHandler.END
+    outbox.kick()
     
     await u.message.reply_text(f"✅ <b>ГРУЗ ПРИНЯТ!</b>\n🆔 Трек: <code>{track}</code>\n💰 Итого: <b>${total_price}</b>", parse_mode='HTML', reply_markup=ReplyKeyboardMarkup([[KeyboardButton("📋 ОЖИДАЕМЫЕ ГРУЗЫ"), KeyboardButton("📦 НОВЫЙ ГРУЗ")], [KeyboardButton("🚚 ОТПРАВЛЕНО"), KeyboardButton("🛃 НА ГРАНИЦЕ"), KeyboardButton("✅ ДОСТАВЛЕНО")]], resize_keyboard=True))
+    await labels.reply_with_labels(u.message, d['cn'], track, len(d.get('packages') or [1]), prefix, d['fio'])
     return ConversationHandler.END
 
 
@@ -229,15 +295,17 @@ async def new_cargo_start(u, c):
 
 async def new_cargo_fio(u, c): 
     c.user_data['new_fio'] = u.message.text
-    kb = [[KeyboardButton("GZ (Гуанчжоу)"), KeyboardButton("IW (Иу)"), KeyboardButton("FS (Фошань)")]]
+    kb = [[KeyboardButton(f"{code} ({WAREHOUSE_NAMES[code]})") for code in c.user_data['scope']]]
     await u.message.reply_text("🏭 <b>Выберите Склад приема:</b>", reply_markup=ReplyKeyboardMarkup(kb, one_time_keyboard=True, resize_keyboard=True), parse_mode='HTML')
     return NEW_WH
 
 async def new_cargo_wh(u, c):
-    text = u.message.text
-    if "IW" in text: code = "IW"
-    elif "FS" in text: code = "FS"
-    else: code = "GZ"
+    text = u.message.text.upper()
+    scope = c.user_data['scope']
+    code = next((code for code in scope if code in text), scope[0] if len(scope) == 1 else None)
+    if not code:
+        await u.message.reply_text("🏭 Выберите склад кнопкой: " + ", ".join(scope))
+        return NEW_WH
     c.user_data['new_wh'] = code
     
     keyboard = []
@@ -259,12 +327,23 @@ async def new_cargo_prod_callback(u, c):
     return NEW_WEIGHT
 
 async def new_cargo_weight(u, c): 
-    c.user_data['new_w'] = clean_number(u.message.text)
+    weights = parse_weights(u.message.text)
+    c.user_data['new_weights'] = weights
+    c.user_data['new_w'] = round(sum(weights), 3)
     await u.message.reply_text("📦 <b>Введите Объем (м³):</b>", parse_mode='HTML')
     return NEW_VOLUME
 
 async def new_cargo_vol(u, c): 
-    c.user_data['new_v'] = clean_number(u.message.text)
+    boxes = parse_boxes(u.message.text)
+    if not boxes:
+        await u.message.reply_text(VOLUME_RETRY_TEXT)
+        return NEW_VOLUME
+    error = check_packages(c.user_data.get('new_weights', []), boxes)
+    if error:
+        await u.message.reply_text(error)
+        return NEW_VOLUME
+    c.user_data['new_boxes'] = boxes
+    c.user_data['new_v'] = round(sum(b.volume * b.count for b in boxes), 4)
     await u.message.reply_text("🛠 <b>Нужны доп. услуги (упаковка/обрешетка)?</b>\n👉 Если да — введите сумму ($)\n👉 Если нет — напишите 0", parse_mode='HTML')
     return NEW_COST
 
@@ -273,6 +352,23 @@ async def new_cargo_cost(u, c):
     await u.message.reply_text("📸 <b>Фото (или /skip):</b>", parse_mode='HTML')
     return NEW_MEDIA
 
+def register_new_cargo(cur, key, result, params, pieces, actor, payload):
+    """Создает груз без контракта. {'contract_num', 'track', 'total'} — при повторе того же
+    сообщения значения первой попытки."""
+    if not idempotency.execute_claimed(cur, key, result, """
+        INSERT INTO shipments (
+            contract_num, track_number, fio, product, category, status, warehouse_code, 
+            actual_weight, actual_volume, additional_cost, total_price_final, base_cost, 
+            media_link, created_at, agreed_rate
+        ) SELECT %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), %s FROM claim
+    """, params):
+        return idempotency.stored_result(cur, key)
+    cn_num = result['contract_num']
+    insert_packages(cur, cn_num, pieces, actor)
+    append_event(cur, cn_num, actor)
+    outbox.enqueue(cur, 'MAKE_CONTRACT_WEBHOOK', payload, f"create:{cn_num}")
+    return result
+
 async def new_cargo_finish(u, c):
     media_link = "Без медиа"
     if u.message.photo:
@@ -282,31 +378,39 @@ async def new_cargo_finish(u, c):
     d = c.user_data
     cn_num = f"CN-{int(time.time())}"
     track = f"{d['new_wh']}{random.randint(100000, 999999)}"
-    cost, rate, dens, is_cbm = calculate_t1_full(d['new_w'], d['new_v'], d['new_prod'], d['new_wh'], 0)
+    pieces = build_packages(d.get('new_weights', []), d.get('new_boxes', []), d['new_v'])
+    cost, rate, dens, is_cbm = price_packages(pieces, d['new_w'], d['new_v'], d['new_prod'], d['new_wh'], 0)
     total = round(cost + d['new_cost'], 2)
+    base = base_cost_packages(pieces, d['new_w'], d['new_v'], d['new_prod'], d['new_wh'], 0)
     status = f"Принят на складе {d['new_wh']}"
     
-    conn = get_db_connection()
-    if conn:
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO shipments (
-                contract_num, track_number, fio, product, status, warehouse_code, 
-                actual_weight, actual_volume, additional_cost, total_price_final, 
-                media_link, created_at, agreed_rate
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), %s)
-        """, (cn_num, track, d['new_fio'], d['new_prod'], status, d['new_wh'], d['new_w'], d['new_v'], d['new_cost'], total, media_link, rate))
-        conn.commit(); conn.close()
-
-    notify_make_create({
+    payload = {
         "action": "create", "contract_num": cn_num, "fio": d['new_fio'], 
         "warehouse_code": d['new_wh'], "product": d['new_prod'], 
         "declared_weight": d['new_w'], "declared_volume": d['new_v'], 
         "rate": rate, "created_at": str(datetime.now()),
-        "actual_weight": d['new_w'], "status": status, "media_link": media_link, "track": track
-    })
+        "actual_weight": d['new_w'], "status": status, "media_link": media_link, "track": track,
+        "render_document": not contract_pdf.available()
+    }
+    try:
+        created = await executors.run_io(db_call, register_new_cargo, idempotency.message_key('new_cargo', u), {'contract_num': cn_num, 'track': track, 'total': total},
+                                         (cn_num, track, d['new_fio'], d['new_prod'], d['new_prod'], status, d['new_wh'], d['new_w'], d['new_v'], d['new_cost'], total, base, media_link, rate),
+                                         pieces, str(u.effective_user.id), payload)
+    except executors.Busy:
+        await u.message.reply_text(executors.BUSY_TEXT); return NEW_MEDIA
+    if created is None:
+        await u.message.reply_text("Ошибка подключения к БД.")
+        return ConversationHandler.END
+    if created['contract_num'] != cn_num:
+        # Повтор того же сообщения: груз уже создан первой попыткой
+        await u.message.reply_text(f"✅ <b>НОВЫЙ ГРУЗ СОЗДАН!</b>\n\n🆔 Контракт: {created['contract_num']}\n🆔 Трек: <b>{created['track']}</b>\n💰 Итого: <b>${created['total']}</b>", parse_mode='HTML')
+        return ConversationHandler.END
+    outbox.kick()
 
     await u.message.reply_text(f"✅ <b>НОВЫЙ ГРУЗ СОЗДАН!</b>\n\n🆔 Контракт: {cn_num}\n🆔 Трек: <b>{track}</b>\n💰 Итого: <b>${total}</b>\n📍 Склад: {d['new_wh']}", parse_mode='HTML', reply_markup=ReplyKeyboardMarkup([[KeyboardButton("📋 ОЖИДАЕМЫЕ ГРУЗЫ"), KeyboardButton("📦 НОВЫЙ ГРУЗ")], [KeyboardButton("🚚 ОТПРАВЛЕНО"), KeyboardButton("🛃 НА ГРАНИЦЕ"), KeyboardButton("✅ ДОСТАВЛЕНО")]], resize_keyboard=True))
+    await contract_pdf.reply_with_contract(u.message, contract_pdf.contract_fields(
+        cn_num, d['new_fio'], None, None, d['new_wh'], d['new_prod'], d['new_w'], d['new_v'], rate, total, track))
+    await labels.reply_with_labels(u.message, cn_num, track, len(pieces), d['new_wh'], d['new_fio'])
     return ConversationHandler.END
 
 # --- СТАТУСЫ ---
@@ -315,31 +419,191 @@ async def set_status_mode(u, c):
     await u.message.reply_text(f"👇 Режим: {u.message.text}\nВведите Трек номер (или несколько через пробел):")
     return WAITING_STATUS_TRACK
 
+# Режим (кнопка меню) -> (статус, прогресс маршрута)
+STATUS_MODES = {
+    'sent': ("🚚 ОТПРАВЛЕНО", "В пути (Китай)", 40),
+    'border': ("🛃 НА ГРАНИЦЕ", "На границе (Хоргос)", 70),
+    'done': ("✅ ДОСТАВЛЕНО", "Прибыл в Алматы", 100),
+}
+
+def status_for_mode(mode):
+    for button, st, pr in STATUS_MODES.values():
+        if button.split()[-1] in mode: return st, pr
+    return "В пути", 20
+
+async def apply_status(message, u, c, codes, mode):
+    st, pr = status_for_mode(mode)
+    try:
+        # Статус + событие журнала + проекция — одной транзакцией
+        updated = await executors.run_io(db_call, update_status_bulk, codes, st, pr, str(u.effective_user.id), c.user_data['scope'])
+    except executors.Busy:
+        await message.reply_text(executors.BUSY_TEXT); return
+    updated_count = len(updated or [])
+    missing = f"\n⚠️ Не найдено на ваших складах: {len(codes) - updated_count}" if updated_count < len(codes) else ""
+    await message.reply_text(f"✅ Обновлено грузов: {updated_count}\nСтатус: {st}{missing}")
+
 async def update_status(u, c):
     raw_text = u.message.text.strip().upper()
     tracks = [t.strip() for t in raw_text.replace(',', ' ').split()]
-    mode = c.user_data.get('smode', '')
-    
-    if "ОТПРАВЛЕНО" in mode: st = "В пути (Китай)"; pr = 40 
-    elif "ГРАНИЦЕ" in mode: st = "На границе (Хоргос)"; pr = 70
-    elif "ДОСТАВЛЕНО" in mode: st = "Прибыл в Алматы"; pr = 100
-    else: st = "В пути"; pr = 20
-        
+    await apply_status(u.message, u, c, tracks, c.user_data.get('smode', ''))
+    return WAITING_STATUS_TRACK
+
+# --- СКАНИРОВАНИЕ ЭТИКЕТОК ---
+async def read_codes(u, c):
+    """Фото этикеток/договоров -> (контракты, треки). None — ничего не распознано (ответ уже отправлен)."""
+    if not labels.decoder_available():
+        await u.message.reply_text("📷 Распознавание штрихкодов не установлено. Введите треки текстом.")
+        return None
+    f = await c.bot.get_file(u.message.photo[-1].file_id if u.message.photo else u.message.document.file_id)
+    data = bytes(await f.download_as_bytearray())
+    try: texts = await executors.run_cpu(labels.decode_image, data)
+    except executors.Busy:
+        await u.message.reply_text(executors.BUSY_TEXT); return None
+    except Exception as e:
+        logger.error(f"Barcode decode error: {e}")
+        texts = []
+    contracts, tracks = labels.parse_codes(texts)
+    if not contracts and not tracks:
+        await u.message.reply_text("📷 Штрихкоды не найдены. Снимите этикетки ближе и ровнее или введите треки текстом.")
+        return None
+    return contracts, tracks
+
+async def update_status_photo(u, c):
+    # Режим статуса уже выбран: фото пачки этикеток = ввод всех треков с него
+    codes = await read_codes(u, c)
+    if codes: await apply_status(u.message, u, c, codes[0] + codes[1], c.user_data.get('smode', ''))
+    return WAITING_STATUS_TRACK
+
+def find_scanned(cur, codes, scope):
+    cur.execute("""
+        SELECT contract_num, track_number, fio, product, status FROM shipments
+        WHERE (contract_num = ANY(%s) OR track_number = ANY(%s)) AND warehouse_code = ANY(%s)
+        ORDER BY created_at
+    """, (codes, codes, list(scope)))
+    return cur.fetchall()
+
+async def scan_photo(u, c):
+    """Фото вне сценариев: договоры к приемке — кнопками приемки, принятые грузы — кнопками статуса."""
+    codes = await read_codes(u, c)
+    if not codes: return
+    try: rows = await executors.run_io(db_call, find_scanned, codes[0] + codes[1], c.user_data['scope'])
+    except executors.Busy:
+        await u.message.reply_text(executors.BUSY_TEXT); return
+    if not rows:
+        await u.message.reply_text("📷 Распознанные коды не найдены на ваших складах."); return
+    expected = [r for r in rows if r[4] == 'оформлен']
+    accepted = [r for r in rows if r[4] != 'оформлен']
+    if expected:
+        keyboard = [[InlineKeyboardButton(f"📥 {fio} | {product}", callback_data=f"accept_{cn}")] for cn, _, fio, product, _ in expected]
+        await u.message.reply_text(f"📋 <b>К приемке: {len(expected)}</b>", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+    if accepted:
+        c.user_data['scanned'] = [r[0] for r in accepted]
+        keyboard = [[InlineKeyboardButton(button, callback_data=f"scan_st_{key}") for key, (button, _, _) in STATUS_MODES.items()]]
+        lines = "\n".join(f"🆔 <code>{track or cn}</code> | {status}" for cn, track, _, _, status in accepted[:30])
+        await u.message.reply_text(f"📦 <b>Распознано грузов: {len(accepted)}</b>\n{lines}\n\nНовый статус для всех:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+
+async def scan_status(u, c):
+    query = u.callback_query
+    await query.answer()
+    codes = c.user_data.pop('scanned', None)
+    if not codes:
+        await query.edit_message_reply_markup(None); return
+    mode = STATUS_MODES.get(query.data[len("scan_st_"):], ("",))[0]
+    await query.edit_message_reply_markup(None)
+    await apply_status(query.message, u, c, codes, mode)
+
+# --- ПОИСК ---
+async def find_shipment(u, c):
+    from shipment_search import search_shipments, MIN_QUERY_LEN  # Редкие команды грузятся при первом вызове
+    text = " ".join(c.args or [])
+    if len(text.strip()) < MIN_QUERY_LEN:
+        await u.message.reply_text(f"🔎 /find <имя, телефон, товар или город> (от {MIN_QUERY_LEN} символов)")
+        return
+    try: rows = await executors.run_io(db_call, search_shipments, text, 10, c.user_data['scope'])
+    except executors.Busy:
+        await u.message.reply_text(executors.BUSY_TEXT); return
+    if rows is None:
+        await u.message.reply_text("Ошибка подключения к БД."); return
+    if not rows:
+        await u.message.reply_text("🔎 Ничего не найдено.")
+        return
+    lines = [f"🆔 <code>{track or cn}</code> | {fio} | {phone or '—'}\n📦 {product} → {city or '—'} | 📍 {status}"
+             for cn, track, fio, phone, product, city, status, _ in rows]
+    await u.message.reply_text("🔎 <b>Найдено:</b>\n\n" + "\n\n".join(lines), parse_mode='HTML')
+
+# --- ПЛАН ЗАГРУЗКИ ФУР ---
+async def plan_loading(u, c):
+    # /plan GZ
+    from load_planner import load_accepted, plan_trucks, save_plan
+    scope = c.user_data['scope']
+    wh = (c.args[0].upper() if c.args else scope[0])
+    if wh not in scope:
+        await u.message.reply_text("🚛 /plan " + " | ".join(scope))
+        return
+    try:
+        # Выборка и сохранение — в потоках, раскладка по фурам — в процессе: loop не ждет ни того, ни другого
+        parcels = await executors.run_io(db_call, load_accepted, wh)
+        if parcels is None:
+            await u.message.reply_text("Ошибка подключения к БД."); return
+        trucks = await executors.run_cpu(plan_trucks, parcels) if parcels else []
+        if not trucks:
+            await u.message.reply_text(f"🚛 На складе {wh} нет принятых грузов.")
+            return
+        plan_id = await executors.run_io(db_call, save_plan, wh, trucks, str(u.effective_user.id))
+    except executors.Busy:
+        await u.message.reply_text(executors.BUSY_TEXT); return
+    if plan_id is None:
+        await u.message.reply_text("Ошибка подключения к БД."); return
+
+    lines, keyboard = [], []
+    for n, t in enumerate(trucks, 1):
+        lines.append(f"🚛 <b>Фура {n}</b> (зона {t.zone}): {len(t.parcels)} гр. | {t.weight:.0f} кг | {t.volume:.1f} м³")
+        keyboard.append([InlineKeyboardButton(f"🚚 Отправить фуру {n}", callback_data=f"plan_{plan_id}_{n}")])
+    await u.message.reply_text(f"📋 <b>План загрузки {wh} №{plan_id}</b>\n\n" + "\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+
+async def plan_dispatch(u, c):
+    query = u.callback_query
+    await query.answer()
+    _, plan_id, truck_no = query.data.split("_")
+    from load_planner import dispatch_truck
+    try: count = await executors.run_io(db_call, dispatch_truck, int(plan_id), int(truck_no), str(u.effective_user.id), c.user_data['scope'])
+    except executors.Busy:
+        await query.message.reply_text(executors.BUSY_TEXT); return
+    if count is None:
+        await query.message.reply_text("Ошибка подключения к БД."); return
+    await query.message.reply_text(f"✅ Фура {truck_no}: отправлено грузов {count}")
+
+# --- SETUP ---
+def startup_checks():
+    """Прогрев тарифов, проверка БД и чистка старых ключей идемпотентности — в пуле потоков,
+    поллинг стартует, не дожидаясь их."""
+    get_matrix()
+    contract_pdf.available()
     conn = get_db_connection()
-    updated_count = 0
     if conn:
-        cur = conn.cursor()
-        for t in tracks:
-            cur.execute("UPDATE shipments SET status=%s, route_progress=%s WHERE track_number=%s OR contract_num=%s", (st, pr, t, t))
-            if cur.rowcount > 0: updated_count += 1
+        idempotency.prune(conn.cursor())
         conn.commit(); conn.close()
-        
-    await u.message.reply_text(f"✅ Обновлено грузов: {updated_count}\nСтатус: {st}")
-    return WAITING_STATUS_TRACK
+    else: logger.error("Startup check: database unavailable")
+
+async def start_workers(app):
+    executors.install(asyncio.get_running_loop())
+    asyncio.get_running_loop().run_in_executor(None, startup_checks)
+    if DATABASE_URL:
+        from transit_model import run_transit_model
+        app.bot_data['outbox_task'] = asyncio.create_task(outbox.run_relay(DATABASE_URL))
+        app.bot_data['transit_task'] = asyncio.create_task(run_transit_model(DATABASE_URL))
+
+async def stop_workers(app):
+    for key in ('outbox_task', 'transit_task'):
+        task = app.bot_data.pop(key, None)
+        if task: task.cancel()
+    executors.shutdown()
+    close_pool()
 
-# --- SETUP ---
 def setup_app():
-    app = Application.builder().token(TOKEN).build()
+    app = Application.builder().token(TOKEN).post_init(start_workers).post_stop(stop_workers).build()
+    idempotency.install(app)
+    operators.install(app)
     
     conv = ConversationHandler(
         entry_points=[CallbackQueryHandler(start_contract_receive_button, pattern='^accept_')],
@@ -368,23 +632,31 @@ def setup_app():
     
     stat_conv = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex('^(🚚|🛃|✅)'), set_status_mode)],
-        states={WAITING_STATUS_TRACK: [MessageHandler(filters.TEXT, update_status)]},
+        states={WAITING_STATUS_TRACK: [MessageHandler(filters.PHOTO | filters.Document.IMAGE, update_status_photo),
+                                       MessageHandler(filters.TEXT, update_status)]},
         fallbacks=[CommandHandler('cancel', cancel)]
     )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("reset_db", reset_database)) # ДОБАВЛЕНА КОМАНДА СБРОСА
     app.add_handler(MessageHandler(filters.Regex('^📋'), show_expected))
+    app.add_handler(CommandHandler("expected", show_expected))
+    app.add_handler(CommandHandler("find", find_shipment))
+    app.add_handler(CommandHandler("plan", plan_loading))
+    app.add_handler(CallbackQueryHandler(plan_dispatch, pattern='^plan_'))
+    app.add_handler(CallbackQueryHandler(expected_page, pattern='^exp[wn]_'))
     app.add_handler(conv)
     app.add_handler(new_cargo_conv)
     app.add_handler(stat_conv)
+    app.add_handler(CallbackQueryHandler(scan_status, pattern='^scan_st_'))
+    app.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, scan_photo))
     
     return app
 
 if __name__ == '__main__':
-    try: requests.get(f"https://api.telegram.org/bot{TOKEN}/deleteWebhook?drop_pending_updates=True")
-    except: pass
     if not TOKEN: logger.error("NO TOKEN")
     else:
+        get_matrix()        # Ошибка в config.json — ConfigError сразу, а не расчеты по пустым тарифам
         app = setup_app()
-        app.run_polling()
\ No newline at end of file
+        # Вебхук снимает сам run_polling при старте — без отдельного блокирующего HTTP-запроса
+        app.run_polling(drop_pending_updates=True)
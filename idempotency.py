@@ -0,0 +1,80 @@
+import json
+import logging
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, TypeHandler
+from common import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Telegram повторяет неподтвержденные апдейты до суток
+SEEN_TTL = 24 * 3600
+SEEN_SIZE = 50000
+KEEP_KEYS_DAYS = 7
+
+_seen = TTLCache(SEEN_SIZE, SEEN_TTL)
+
+# Захват ключа вшит в тот же запрос, что и сама запись: на обычном (не повторном) пути
+# лишнего round trip нет. Запрос после CTE должен брать строки FROM claim.
+# CTE с INSERT выполняется всегда, даже если основной запрос ничего не изменил, поэтому
+# для UPDATE ключ захватывается только при существующей целевой строке ({exists}).
+CLAIM_CTE = """
+WITH claim AS (
+    INSERT INTO idempotency_keys (key, result) SELECT %s, %s WHERE {exists}
+    ON CONFLICT (key) DO NOTHING RETURNING key
+)
+"""
+
+
+# --- ПАМЯТЬ: повторная доставка того же апдейта в этот процесс ---
+
+async def _drop_duplicates(update: Update, context):
+    keys = [(context.bot.id, 'upd', update.update_id)]
+    if update.callback_query: keys.append((context.bot.id, 'cb', update.callback_query.id))
+    if any(_seen.get(k) for k in keys):
+        logger.info(f"Duplicate update {update.update_id} dropped")
+        raise ApplicationHandlerStop
+    for k in keys: _seen.set(k, True)
+
+
+# Группа фильтра дубликатов: раньше всех остальных хендлеров, в т.ч. проверки складов (operators)
+GROUP = -2
+
+
+def install(app):
+    """Ставит фильтр дубликатов перед всеми хендлерами бота (group=GROUP)."""
+    app.add_handler(TypeHandler(Update, _drop_duplicates), group=GROUP)
+
+
+# --- БАЗА: побочные эффекты (создание/приемка), в т.ч. после рестарта ---
+
+def message_key(scope, update):
+    """Ключ операции по сообщению: повторная доставка несет тот же chat_id/message_id."""
+    return f"{scope}:{update.effective_chat.id}:{update.effective_message.message_id}"
+
+
+def callback_key(scope, update):
+    return f"{scope}:cb:{update.callback_query.id}"
+
+
+def execute_claimed(cur, key, result, sql, params, exists=None, exists_params=()):
+    """Выполняет INSERT/UPDATE из sql, только если key еще не занят.
+
+    result (JSON) сохраняется вместе с ключом, чтобы на повторе ответить тем же.
+    exists — SELECT целевой строки для UPDATE: без нее ключ не захватывается, и
+    stored_result вернет None. Возвращает True, если операция выполнена впервые.
+    """
+    cte = CLAIM_CTE.format(exists=f"EXISTS ({exists})" if exists else "TRUE")
+    cur.execute(cte + sql, (key, json.dumps(result, ensure_ascii=False, default=str)) + tuple(exists_params) + tuple(params))
+    return cur.rowcount > 0
+
+
+def stored_result(cur, key):
+    """Результат первой попытки или None (ключ не занят: целевая запись не нашлась)."""
+    cur.execute("SELECT result FROM idempotency_keys WHERE key = %s", (key,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def prune(cur, days=KEEP_KEYS_DAYS):
+    cur.execute("DELETE FROM idempotency_keys WHERE created_at < NOW() - %s * INTERVAL '1 day'", (days,))
+    return cur.rowcount
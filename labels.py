@@ -0,0 +1,134 @@
+import io
+import re
+import logging
+from common import WAREHOUSE_NAMES
+
+logger = logging.getLogger(__name__)
+
+# Термоэтикетка 58×40 мм (в пунктах)
+LABEL_W, LABEL_H = 58 * 72 / 25.4, 40 * 72 / 25.4
+FONT, FONT_BOLD = 'DejaVuSans', 'DejaVuSans-Bold'      # Регистрирует contract_pdf.register_fonts
+
+# QR: "PP1|<контракт>|<трек>|<место>/<мест>"; Code128 — только трек (читают любые сканеры)
+PAYLOAD_PREFIX = 'PP1'
+TRACK_RE = re.compile(r'^[A-Z]{2}\d{6}$')
+CONTRACT_RE = re.compile(r'^CN-\d+$')
+
+_decoder = None
+
+
+def label_payload(contract_num, track=None, box_no=None, boxes=None):
+    place = f"{box_no}/{boxes}" if box_no else ""
+    return f"{PAYLOAD_PREFIX}|{contract_num}|{track or ''}|{place}"
+
+
+def parse_codes(texts):
+    """Считанные строки -> (контракты, треки) без повторов, в порядке считывания.
+
+    Понимает QR наших этикеток и договоров, голый трек из Code128 и номер контракта.
+    """
+    contracts, tracks = {}, {}
+    for text in texts:
+        text = (text or '').strip()
+        if text.startswith(PAYLOAD_PREFIX + '|'):
+            _, cn, track, _ = (text.split('|') + ['', '', ''])[:4]
+            if track: tracks[track] = True
+            elif cn: contracts[cn] = True
+            continue
+        for part in text.upper().replace(',', ' ').split():
+            if TRACK_RE.match(part): tracks[part] = True
+            elif CONTRACT_RE.match(part): contracts[part] = True
+    return list(contracts), list(tracks)
+
+
+# --- ЭТИКЕТКИ ---
+
+def draw_qr(c, payload, x, y, size):
+    """QR-код на холсте reportlab (используется и в договоре).
+
+    Кодируется один раз и рисуется одним путем из квадратов: QrCodeWidget кодирует
+    данные повторно ради габаритов и строит фигуру на каждый модуль — в разы медленнее.
+    """
+    from reportlab.graphics.barcode import qrencoder
+    qr = qrencoder.QRCode(None, qrencoder.QRErrorCorrectLevel.M)
+    qr.addData(payload)
+    qr.make()
+    n = qr.getModuleCount()
+    cell = size / (n + 2)            # +1 модуль тихой зоны с каждой стороны
+    path = c.beginPath()
+    for row in range(n):
+        for col in range(n):
+            if qr.isDark(row, col): path.rect(x + (col + 1) * cell, y + size - (row + 2) * cell, cell, cell)
+    c.drawPath(path, stroke=0, fill=1)
+
+
+def render_labels(contract_num, track, boxes, warehouse_code=None, fio=None):
+    """PDF с этикеткой на каждое место груза (bytes). CPU-работа: из бота — через executors.run_cpu."""
+    from reportlab.pdfgen import canvas
+    from reportlab.graphics.barcode.code128 import Code128
+    from contract_pdf import register_fonts
+    register_fonts()
+    boxes = max(int(boxes or 1), 1)
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=(LABEL_W, LABEL_H), pageCompression=1)
+    c.setTitle(f"Этикетки {track}")
+    # Сверху Code128 во всю ширину, снизу слева текст, справа QR
+    barcode = Code128(track, barHeight=24, barWidth=0.9, humanReadable=True, fontName=FONT, fontSize=8)
+    qr = 58
+    for box_no in range(1, boxes + 1):
+        barcode.drawOn(c, (LABEL_W - barcode.width) / 2, LABEL_H - 36)
+        draw_qr(c, label_payload(contract_num, track, box_no, boxes), LABEL_W - qr - 4, 4, qr)
+        c.setFont(FONT_BOLD, 11)
+        c.drawString(6, 46, f"Место {box_no}/{boxes}")
+        c.setFont(FONT, 7)
+        c.drawString(6, 32, contract_num)
+        c.drawString(6, 22, WAREHOUSE_NAMES.get(warehouse_code, warehouse_code or ''))
+        c.drawString(6, 12, (fio or '')[:20])
+        c.showPage()
+    c.save()
+    return buf.getvalue()
+
+
+def labels_filename(track):
+    return f"labels_{track}.pdf"
+
+
+async def reply_with_labels(message, contract_num, track, boxes, warehouse_code=None, fio=None):
+    """Этикетки всех мест ответом на message (рендер в пуле процессов). Без reportlab — ничего."""
+    from contract_pdf import available
+    if not available(): return
+    import executors
+    try:
+        pdf = await executors.run_cpu(render_labels, contract_num, track, boxes, warehouse_code, fio)
+        await message.reply_document(pdf, filename=labels_filename(track), caption=f"🏷 Этикетки: {boxes} шт. — по одной на каждое место")
+    except Exception as e:
+        logger.error(f"Labels {track} failed: {e}")
+
+
+# --- РАСПОЗНАВАНИЕ ---
+
+def decoder_available():
+    """pyzbar (+ системная libzbar) — необязательная зависимость: без нее треки вводятся текстом."""
+    global _decoder
+    if _decoder is None:
+        try:
+            from pyzbar import pyzbar  # noqa: F401
+            from PIL import Image  # noqa: F401
+            _decoder = True
+        except ImportError as e:
+            logger.warning(f"Barcode decoder unavailable: {e}")
+            _decoder = False
+    return _decoder
+
+
+def decode_image(data):
+    """Все Code128/QR на фото (bytes) -> список строк. CPU-работа: через executors.run_cpu."""
+    from pyzbar import pyzbar
+    from PIL import Image, ImageOps
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert('L')
+    found = pyzbar.decode(image, symbols=[pyzbar.ZBarSymbol.CODE128, pyzbar.ZBarSymbol.QRCODE])
+    if not found and max(image.size) > 1600:
+        # Крупное фото пачки этикеток: zbar надежнее на уменьшенной копии
+        image.thumbnail((1600, 1600))
+        found = pyzbar.decode(image, symbols=[pyzbar.ZBarSymbol.CODE128, pyzbar.ZBarSymbol.QRCODE])
+    return [s.data.decode('utf-8', 'replace') for s in found]
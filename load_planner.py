@@ -0,0 +1,98 @@
+import os
+from collections import namedtuple
+from psycopg2.extras import execute_values
+from tariff_matrix import get_matrix
+from shipment_events import update_status_bulk
+
+# Вместимость одной фуры/контейнера
+TRUCK_MAX_WEIGHT = float(os.getenv('TRUCK_MAX_WEIGHT', 20000))   # кг
+TRUCK_MAX_VOLUME = float(os.getenv('TRUCK_MAX_VOLUME', 82))      # м³
+DISPATCH_STATUS, DISPATCH_PROGRESS = "В пути (Китай)", 40
+ACCEPTED_STATUS = 'Принят на складе%'
+# Неотправленная фура плана держит свои грузы столько часов: повторный /plan их не берет
+PLAN_OPEN_HOURS = int(os.getenv('PLAN_OPEN_HOURS', 48))
+
+Parcel = namedtuple('Parcel', 'contract_num track weight volume zone')
+
+
+class Truck:
+    __slots__ = ('zone', 'parcels', 'weight', 'volume')
+
+    def __init__(self, zone):
+        self.zone = zone
+        self.parcels = []
+        self.weight = 0.0
+        self.volume = 0.0
+
+    def fits(self, p):
+        return self.weight + p.weight <= TRUCK_MAX_WEIGHT and self.volume + p.volume <= TRUCK_MAX_VOLUME
+
+    def add(self, p):
+        self.parcels.append(p)
+        self.weight += p.weight
+        self.volume += p.volume
+
+
+def load_accepted(cur, warehouse_code):
+    """Принятые на складе, еще не отправленные грузы (partial index idx_shipments_accepted_<склад>).
+
+    Грузы из неотправленных фур открытых планов пропускаются: планы не пересекаются.
+    """
+    cur.execute("""
+        SELECT contract_num, track_number, COALESCE(actual_weight, 0), COALESCE(actual_volume, 0), client_city
+        FROM shipments s
+        WHERE warehouse_code = %s AND status LIKE %s
+          AND NOT EXISTS (
+              SELECT 1 FROM load_plan_items i JOIN load_plans p ON p.id = i.plan_id
+              WHERE i.contract_num = s.contract_num AND i.dispatched_at IS NULL
+                AND p.created_at > NOW() - %s * INTERVAL '1 hour')
+    """, (warehouse_code, ACCEPTED_STATUS, PLAN_OPEN_HOURS))
+    matrix = get_matrix()
+    return [Parcel(cn, track, float(w), float(v), matrix.zone_for(city or "Алматы")) for cn, track, w, v, city in cur.fetchall()]
+
+
+def plan_trucks(parcels):
+    """First-fit decreasing по двум измерениям (вес и объем), отдельно для каждой зоны доставки.
+
+    Грузы сортируются по наибольшей доле от вместимости фуры, каждый кладется в первую
+    фуру своей зоны, где хватает и веса, и объема. O(n · фур), тысячи грузов — доли секунды.
+    """
+    by_zone = {}
+    for p in parcels: by_zone.setdefault(p.zone, []).append(p)
+    trucks = []
+    for zone in sorted(by_zone):
+        zone_trucks = []
+        for p in sorted(by_zone[zone], key=lambda p: max(p.weight / TRUCK_MAX_WEIGHT, p.volume / TRUCK_MAX_VOLUME), reverse=True):
+            truck = next((t for t in zone_trucks if t.fits(p)), None)
+            if truck is None:
+                # Негабарит больше фуры все равно едет отдельной машиной
+                truck = Truck(zone)
+                zone_trucks.append(truck)
+            truck.add(p)
+        trucks.extend(zone_trucks)
+    return trucks
+
+
+def save_plan(cur, warehouse_code, trucks, actor=None):
+    cur.execute("INSERT INTO load_plans (warehouse_code, created_by) VALUES (%s, %s) RETURNING id", (warehouse_code, actor))
+    plan_id = cur.fetchone()[0]
+    execute_values(cur, "INSERT INTO load_plan_items (plan_id, truck_no, contract_num, zone) VALUES %s",
+                   [(plan_id, n, p.contract_num, t.zone) for n, t in enumerate(trucks, 1) for p in t.parcels])
+    return plan_id
+
+
+def dispatch_truck(cur, plan_id, truck_no, actor=None, warehouses=None):
+    """Отправляет одну фуру плана одним массовым обновлением статуса. Возвращает число грузов.
+
+    warehouses — склады оператора: план чужого склада не отправляется. Статус меняется только
+    у грузов, все еще принятых на складе: уже отправленные другим планом не откатываются.
+    """
+    wh = None if warehouses is None else list(warehouses)
+    cur.execute("""
+        UPDATE load_plan_items SET dispatched_at = NOW()
+        WHERE plan_id = %s AND truck_no = %s AND dispatched_at IS NULL
+          AND plan_id IN (SELECT id FROM load_plans WHERE %s::text[] IS NULL OR warehouse_code = ANY(%s::text[]))
+        RETURNING contract_num
+    """, (plan_id, truck_no, wh, wh))
+    contracts = [r[0] for r in cur.fetchall()]
+    return len(update_status_bulk(cur, contracts, DISPATCH_STATUS, DISPATCH_PROGRESS, actor, warehouses, ACCEPTED_STATUS))
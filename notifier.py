@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import psycopg2
+from telegram.error import Forbidden, BadRequest
+from shipment_events import events_since, read_cursor, write_cursor, journal_end
+import sender
+
+logger = logging.getLogger(__name__)
+
+CURSOR_NAME = 'client_push'
+BATCH_SIZE = 500
+IDLE_POLL_SECONDS = 30        # Страховочный опрос, если NOTIFY потерялся (переподключение и т.п.)
+SKIP_STATUSES = ('оформлен',)
+MAX_MESSAGE_LEN = 4096        # Лимит Telegram на текст сообщения
+
+
+def subscribe(cur, contract_num, chat_id):
+    """Привязывает чат клиента к грузу (повторная привязка — без ошибок)."""
+    cur.execute("""
+        INSERT INTO shipment_subscribers (contract_num, chat_id) VALUES (%s, %s)
+        ON CONFLICT DO NOTHING
+    """, (contract_num, chat_id))
+
+
+def _load_cursor(cur):
+    # Первый запуск: не рассылаем всю историю, начинаем с текущего конца журнала
+    return read_cursor(cur, CURSOR_NAME) or journal_end(cur)
+
+
+def _fetch_batch(conn, cursor):
+    """События после курсора + подписчики этих грузов (2 запроса на пачку)."""
+    with conn.cursor() as cur:
+        events, cursor = events_since(cur, cursor, BATCH_SIZE)
+        if not events: return [], {}, cursor
+        contracts = list({e[1] for e in events})
+        cur.execute("SELECT contract_num, chat_id FROM shipment_subscribers WHERE contract_num = ANY(%s)", (contracts,))
+        subs = {}
+        for cn, chat_id in cur.fetchall(): subs.setdefault(cn, []).append(chat_id)
+    conn.rollback()
+    return events, subs, cursor
+
+
+def _save_cursor(conn, cursor, dead_chats=()):
+    with conn.cursor() as cur:
+        write_cursor(cur, CURSOR_NAME, cursor)
+        if dead_chats: cur.execute("DELETE FROM shipment_subscribers WHERE chat_id = ANY(%s)", (list(dead_chats),))
+    conn.commit()
+
+
+def format_updates(updates):
+    """Сводка на чат: последний статус по каждому грузу. Список сообщений не длиннее MAX_MESSAGE_LEN."""
+    header = "🔔 <b>Обновление статуса</b>\n\n"
+    messages, text = [], header
+    for cn, track, status, progress in updates:
+        line = f"📦 <b>{track or cn}</b>: {status} ({progress}%)\n"
+        if len(text) + len(line) > MAX_MESSAGE_LEN and text != header:
+            messages.append(text.rstrip())
+            text = header
+        text += line
+    messages.append(text.rstrip())
+    return messages
+
+
+def _is_dead_chat(error):
+    # Клиент заблокировал бота или чат удален; прочие BadRequest (разметка, длина) — наша ошибка, не клиента
+    return isinstance(error, Forbidden) or (isinstance(error, BadRequest) and 'chat not found' in str(error).lower())
+
+
+async def _send_all(bot, messages):
+    """Через общую очередь бота (лимиты и 429 — там); ответы операторов идут раньше пушей.
+
+    messages — {chat_id: [текст, ...]}. Возвращает чаты, которые больше не принимают сообщения.
+    """
+    out = sender.get(bot)
+    sends = [(chat_id, text) for chat_id, texts in messages.items() for text in texts]
+    results = await asyncio.gather(*(out.submit(chat_id, sender.PUSH, text=text, parse_mode='HTML') for chat_id, text in sends),
+                                   return_exceptions=True)
+    dead = set()
+    for (chat_id, _), result in zip(sends, results):
+        if _is_dead_chat(result): dead.add(chat_id)
+        elif isinstance(result, Exception): logger.warning(f"Push to {chat_id} failed: {result}")
+    return dead
+
+
+async def _run_once(bot, dsn):
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+
+    conn = await loop.run_in_executor(None, psycopg2.connect, dsn)
+    listen = await loop.run_in_executor(None, psycopg2.connect, dsn)
+    listen.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    listen.cursor().execute("LISTEN shipment_events")
+
+    def on_notify():
+        listen.poll()
+        listen.notifies.clear()
+        wake.set()
+
+    loop.add_reader(listen.fileno(), on_notify)
+    try:
+        with conn.cursor() as cur: cursor = _load_cursor(cur)
+        conn.rollback()
+        while True:
+            wake.clear()
+            events, subs, next_cursor = await loop.run_in_executor(None, _fetch_batch, conn, cursor)
+            if not events:
+                try: await asyncio.wait_for(wake.wait(), IDLE_POLL_SECONDS)
+                except asyncio.TimeoutError: pass
+                continue
+
+            per_chat = {}
+            for _, cn, track, _, status, progress, _, _ in events:
+                if status in SKIP_STATUSES: continue
+                for chat_id in subs.get(cn, ()):
+                    per_chat.setdefault(chat_id, {})[cn] = (cn, track, status, progress)
+            dead = await _send_all(bot, {chat: format_updates(u.values()) for chat, u in per_chat.items()})
+            cursor = next_cursor
+            # Курсор двигается только после отправки: при падении пачка уйдет повторно (at-least-once)
+            await loop.run_in_executor(None, _save_cursor, conn, cursor, dead)
+    finally:
+        loop.remove_reader(listen.fileno())
+        listen.close(); conn.close()
+
+
+async def run_status_notifier(bot, dsn):
+    """Фоновый воркер: LISTEN shipment_events -> пачка событий -> пуши подписанным клиентам."""
+    while True:
+        try:
+            await _run_once(bot, dsn)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Status notifier error: {e}")
+            await asyncio.sleep(10)
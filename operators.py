@@ -0,0 +1,63 @@
+import os
+import logging
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, TypeHandler
+from common import WAREHOUSE_NAMES
+import idempotency
+
+logger = logging.getLogger(__name__)
+
+ALL = '*'
+NO_ACCESS_TEXT = "⛔ Нет доступа к складам. Обратитесь к администратору."
+
+
+def parse_operators(spec):
+    """'111111:GZ,FS;222222:*' -> {111111: ('GZ', 'FS'), 222222: ('*',)}. '*' — все склады, включая новые."""
+    operators = {}
+    for part in filter(None, (p.strip() for p in spec.split(';'))):
+        user_id, _, codes = part.partition(':')
+        codes = tuple(c.strip().upper() for c in codes.split(',') if c.strip())
+        # Опечатка в одной записи не должна ронять бота при старте: пропускаем ее, как неизвестный склад
+        if not user_id.strip().isdigit() or not codes:
+            logger.warning(f"WAREHOUSE_OPERATORS: malformed entry {part!r} skipped")
+            continue
+        unknown = [c for c in codes if c != ALL and c not in WAREHOUSE_NAMES]
+        if unknown: logger.warning(f"WAREHOUSE_OPERATORS: unknown warehouses {unknown} for {user_id}")
+        operators[int(user_id)] = codes
+    return operators
+
+
+OPERATORS = parse_operators(os.getenv('WAREHOUSE_OPERATORS', ''))
+if not OPERATORS:
+    logger.warning("WAREHOUSE_OPERATORS is not set: every user sees all warehouses")
+
+
+def scope(user_id):
+    """Склады оператора в порядке WAREHOUSE_NAMES; пустой кортеж — не оператор."""
+    codes = OPERATORS.get(user_id, ()) if OPERATORS else (ALL,)
+    if ALL in codes: return tuple(WAREHOUSE_NAMES)
+    return tuple(c for c in WAREHOUSE_NAMES if c in codes)
+
+
+def is_manager(user_id):
+    """Оператор всех складов: ему доступны общие операции (сброс базы и т.п.)."""
+    return not OPERATORS or ALL in OPERATORS.get(user_id, ())
+
+
+async def _check_scope(update: Update, context):
+    user = update.effective_user
+    codes = scope(user.id) if user else ()
+    if not codes:
+        if update.callback_query: await update.callback_query.answer(NO_ACCESS_TEXT, show_alert=True)
+        elif update.effective_message: await update.effective_message.reply_text(NO_ACCESS_TEXT)
+        raise ApplicationHandlerStop
+    context.user_data['scope'] = codes
+
+
+def install(app):
+    """Сессия оператора ограничена его складами: context.user_data['scope'] до всех хендлеров.
+
+    Группа сразу после фильтра дубликатов (в одной группе срабатывает один хендлер):
+    повторно доставленный апдейт отбрасывается до проверки и не получает второй отказ.
+    """
+    app.add_handler(TypeHandler(Update, _check_scope), group=idempotency.GROUP + 1)
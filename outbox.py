@@ -0,0 +1,136 @@
+import os
+import json
+import asyncio
+import logging
+import psycopg2
+from dotenv import load_dotenv
+from common import http_session
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+BATCH_SIZE = 50
+POLL_SECONDS = 5
+MAX_BACKOFF_SECONDS = 3600
+HTTP_TIMEOUT = 10
+# Взятая в работу пачка скрыта от других релеев на это время; упавший релей — ее повторят после
+LEASE_SECONDS = BATCH_SIZE * HTTP_TIMEOUT + 60
+
+# Вебхуки хранятся в очереди по имени переменной окружения, а не по URL
+WEBHOOKS = ('MAKE_CONTRACT_WEBHOOK', 'MAKE_WAREHOUSE_WEBHOOK')
+
+_wake = None
+_unconfigured = set()   # О ненастроенном вебхуке пишем в лог один раз
+
+
+def enqueue(cur, webhook, payload, idempotency_key):
+    """Кладет вызов вебхука в make_outbox в текущей транзакции; дубликат ключа игнорируется."""
+    cur.execute("""
+        INSERT INTO make_outbox (idempotency_key, webhook, payload) VALUES (%s, %s, %s)
+        ON CONFLICT (idempotency_key) DO NOTHING
+    """, (idempotency_key, webhook, json.dumps(payload, ensure_ascii=False, default=str)))
+
+
+def kick():
+    """Будит релей этого процесса сразу после коммита, не дожидаясь опроса."""
+    if _wake: _wake.set()
+
+
+def _claim(conn, webhooks, limit):
+    """Берет пачку в работу: сдвигает next_attempt_at на LEASE_SECONDS и коммитит.
+    Блокировки строк не держатся, пока идут HTTP-запросы."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE make_outbox SET next_attempt_at = NOW() + %s * INTERVAL '1 second'
+            WHERE id IN (
+                SELECT id FROM make_outbox
+                WHERE sent_at IS NULL AND next_attempt_at <= NOW() AND webhook = ANY(%s)
+                ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, idempotency_key, webhook, payload, attempts
+        """, (LEASE_SECONDS, list(webhooks), limit))
+        rows = sorted(cur.fetchall())
+    conn.commit()
+    return rows
+
+
+def _report_unconfigured(conn, configured):
+    """Строки вебхуков без URL в окружении остаются в очереди до настройки — пишем об этом в лог."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT webhook, count(*) FROM make_outbox
+            WHERE sent_at IS NULL AND NOT (webhook = ANY(%s)) GROUP BY webhook
+        """, (list(configured),))
+        pending = cur.fetchall()
+    conn.commit()
+    for webhook, count in pending:
+        if webhook not in _unconfigured:
+            _unconfigured.add(webhook)
+            logger.warning(f"Outbox: {webhook} is not configured, {count} calls left pending")
+
+
+def drain_once(conn, limit=BATCH_SIZE):
+    """Отправляет одну пачку. Строки сначала забираются (SKIP LOCKED, аренда, коммит),
+    потом отправляются вне транзакции: несколько релеев работают параллельно."""
+    configured = [w for w in WEBHOOKS if os.getenv(w)]
+    _report_unconfigured(conn, configured)
+    if not configured: return 0
+    sent = 0
+    for row_id, key, webhook, payload, attempts in _claim(conn, configured, limit):
+        body = dict(payload, idempotency_key=key)
+        try:
+            resp = http_session().post(os.getenv(webhook), json=body, headers={'Idempotency-Key': key}, timeout=HTTP_TIMEOUT)
+            resp.raise_for_status()
+            with conn.cursor() as cur:
+                cur.execute("UPDATE make_outbox SET sent_at = NOW(), attempts = attempts + 1 WHERE id = %s", (row_id,))
+            sent += 1
+        except Exception as e:
+            delay = min(2 ** attempts * 10, MAX_BACKOFF_SECONDS)
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE make_outbox SET attempts = attempts + 1, last_error = %s,
+                        next_attempt_at = NOW() + %s * INTERVAL '1 second'
+                    WHERE id = %s
+                """, (str(e)[:500], delay, row_id))
+        # Каждый результат коммитится сразу: упавший посреди пачки релей не повторит отправленное
+        conn.commit()
+    return sent
+
+
+async def run_relay(dsn):
+    """Фоновый релей make_outbox -> Make.com для бота."""
+    global _wake
+    loop = asyncio.get_running_loop()
+    _wake = asyncio.Event()
+    conn = None
+    while True:
+        try:
+            if conn is None or conn.closed:
+                conn = await loop.run_in_executor(None, psycopg2.connect, dsn)
+            _wake.clear()
+            sent = await loop.run_in_executor(None, drain_once, conn)
+            if sent >= BATCH_SIZE: continue
+            try: await asyncio.wait_for(_wake.wait(), POLL_SECONDS)
+            except asyncio.TimeoutError: pass
+        except asyncio.CancelledError:
+            if conn: conn.close()
+            raise
+        except Exception as e:
+            logger.error(f"Outbox relay error: {e}")
+            if conn: conn.close()
+            conn = None
+            await asyncio.sleep(POLL_SECONDS)
+
+
+if __name__ == '__main__':
+    # Ручной прогон очереди (например, после падения бота): python outbox.py
+    logging.basicConfig(level=logging.INFO)
+    conn = psycopg2.connect(DATABASE_URL)
+    total = 0
+    while True:
+        n = drain_once(conn)
+        total += n
+        if n < BATCH_SIZE: break
+    conn.close()
+    print(f"✅ Отправлено: {total}")
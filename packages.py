@@ -0,0 +1,106 @@
+import os
+import re
+from tariff_matrix import get_matrix
+
+# 'consignment' — тариф по плотности всей партии (как раньше), 'box' — по плотности каждой коробки
+PACKAGE_PRICING = os.getenv('PACKAGE_PRICING', 'consignment')
+# Мест в одной приемке не больше: по строке на место в packages и по странице этикеток
+MAX_PIECES = int(os.getenv('MAX_PIECES', 500))
+
+_WEIGHT_SPLIT_RE = re.compile(r'[\s;+]+')
+
+
+def parse_weights(text):
+    """'12.5 14 13' / '12,5+14' -> [12.5, 14.0]; нечисловые куски пропускаются."""
+    weights = []
+    for part in _WEIGHT_SPLIT_RE.split(text or ''):
+        try: weights.append(float(part.replace(',', '.')))
+        except ValueError: pass
+    return [w for w in weights if w > 0]
+
+
+def _volume_only(boxes):
+    """Введен только общий объем ("0.5 м³"): ни габаритов, ни количества мест."""
+    return sum(b.count for b in boxes) <= 1 and all(b.length is None for b in boxes)
+
+
+def check_packages(weights, boxes):
+    """Текст ошибки для оператора или None: дробное или слишком большое количество мест,
+    весов введено не столько, сколько мест."""
+    if any(b.count != int(b.count) for b in boxes):
+        return "⚠️ Количество мест должно быть целым."
+    count = sum(int(b.count) for b in boxes)
+    if count > MAX_PIECES:
+        return f"⚠️ Мест: {count}, больше {MAX_PIECES} в одной приемке не бывает. Проверьте количество."
+    if len(weights) > 1 and not _volume_only(boxes) and len(weights) != count:
+        return f"⚠️ Весов введено {len(weights)}, а мест по объему {count}. Введите объем на {len(weights)} мест(а) или /cancel."
+    return None
+
+
+def build_packages(weights, boxes, total_volume):
+    """Раскладывает партию на коробки: [{'weight', 'volume', 'length', 'width', 'height'}].
+
+    Если весов столько же, сколько коробок, каждая коробка получает свой вес; если введен
+    только общий объем, а весов несколько — место на каждый вес, объем делится по весу;
+    иначе общий вес делится пропорционально объему. ValueError — кол-во не прошло check_packages.
+    """
+    if any(b.count != int(b.count) for b in boxes) or sum(b.count for b in boxes) > MAX_PIECES:
+        raise ValueError(check_packages([], boxes))
+    total_weight = sum(weights)
+    if len(weights) > 1 and _volume_only(boxes):
+        volume = sum(b.volume * b.count for b in boxes) or total_volume
+        return [{'weight': w, 'volume': round(volume * w / total_weight, 6), 'length': None, 'width': None, 'height': None}
+                for w in weights]
+    pieces = []
+    for b in boxes:
+        for _ in range(int(b.count)):
+            pieces.append({'weight': 0.0, 'volume': round(b.volume, 6), 'length': b.length, 'width': b.width, 'height': b.height})
+    if not pieces:
+        pieces = [{'weight': 0.0, 'volume': total_volume, 'length': None, 'width': None, 'height': None}]
+
+    if len(weights) == len(pieces):
+        for p, w in zip(pieces, weights): p['weight'] = w
+    else:
+        vol_sum = sum(p['volume'] for p in pieces) or 1
+        for p in pieces: p['weight'] = round(total_weight * p['volume'] / vol_sum, 3)
+    return pieces
+
+
+def price_packages(pieces, weight, volume, category_key, warehouse_code, agreed_rate_min=0, mode=None):
+    """Т1 по партии: (cost, rate, density, is_cbm). В режиме 'box' стоимость — сумма по коробкам."""
+    matrix = get_matrix()
+    cost, rate, density, is_cbm = matrix.t1_rate(weight, volume, category_key, warehouse_code, agreed_rate_min)
+    if (mode or PACKAGE_PRICING) == 'box' and len(pieces) > 1:
+        cost = sum(matrix.t1_rate(p['weight'], p['volume'], category_key, warehouse_code, agreed_rate_min)[0] for p in pieces)
+        # Средневзвешенный тариф для отображения
+        base = volume if is_cbm else weight
+        if base: rate = cost / base
+    return round(cost, 2), round(rate, 2), round(density, 0), is_cbm
+
+
+def base_cost_packages(pieces, weight, volume, category_key, warehouse_code, agreed_rate_min=0, mode=None):
+    """Себестоимость Т1 (без наценки) той же разбивкой, что и price_packages."""
+    matrix = get_matrix()
+    parts = [(p['weight'], p['volume']) for p in pieces] if (mode or PACKAGE_PRICING) == 'box' and len(pieces) > 1 else [(weight, volume)]
+    total = 0.0
+    for w, v in parts:
+        is_cbm = matrix.t1_rate(w, v, category_key, warehouse_code, agreed_rate_min)[3]
+        total += matrix.t1_base_cost(w, v, category_key, warehouse_code, is_cbm)
+    return round(total, 2)
+
+
+def insert_packages(cur, contract_num, pieces, scanned_by=None):
+    """Записывает коробки одним INSERT; повторная приемка заменяет прежний набор."""
+    from psycopg2.extras import execute_values
+    cur.execute("DELETE FROM packages WHERE contract_num = %s", (contract_num,))
+    execute_values(cur, """
+        INSERT INTO packages (contract_num, box_no, weight, volume, length, width, height, scanned_by, scanned_at)
+        VALUES %s
+    """, [(contract_num, i, p['weight'], p['volume'], p['length'], p['width'], p['height'], scanned_by)
+          for i, p in enumerate(pieces, 1)], template="(%s, %s, %s, %s, %s, %s, %s, %s, NOW())")
+
+
+def get_package_totals(cur, contract_num):
+    """(коробок, вес, объем) из представления shipment_package_totals."""
+    cur.execute("SELECT boxes, total_weight, total_volume FROM shipment_package_totals WHERE contract_num = %s", (contract_num,))
+    return cur.fetchone() or (0, 0.0, 0.0)
@@ -0,0 +1,151 @@
+import os
+import json
+from collections import OrderedDict
+from tariff_matrix import get_matrix
+
+QUOTE_CACHE_SIZE = int(os.getenv('QUOTE_CACHE_SIZE', 2048))
+ENCODING_VERSION = 1
+
+
+class LineItem:
+    __slots__ = ('category', 'name', 'weight', 'volume', 'density', 'rate', 'is_cbm', 'cost')
+
+    def __init__(self, category, name, weight, volume, density, rate, is_cbm, cost):
+        self.category = category
+        self.name = name
+        self.weight = weight
+        self.volume = volume
+        self.density = density
+        self.rate = rate
+        self.is_cbm = is_cbm
+        self.cost = cost
+
+    @property
+    def unit(self):
+        return "м³" if self.is_cbm else "кг"
+
+
+class Quote:
+    """Расчет корзины: считается один раз, дальше только рендерится (клиент, админ, Make.com)."""
+    __slots__ = ('warehouse', 'city', 'items', 't1_usd', 't2_kzt', 't2_rate_usd')
+
+    def __init__(self, warehouse, city, items, t2_kzt, t2_rate_usd):
+        self.warehouse = warehouse
+        self.city = city
+        self.items = tuple(items)
+        self.t1_usd = round(sum(i.cost for i in self.items), 2)
+        self.t2_kzt = t2_kzt
+        self.t2_rate_usd = t2_rate_usd
+
+    @property
+    def total_weight(self):
+        return sum(i.weight for i in self.items)
+
+    @property
+    def total_volume(self):
+        return sum(i.volume for i in self.items)
+
+    def base_cost(self):
+        """Себестоимость Т1 по ценам перевозчика (без наценки) — для P&L."""
+        matrix = get_matrix()
+        return round(sum(matrix.t1_base_cost(i.weight, i.volume, i.category, self.warehouse, i.is_cbm) for i in self.items), 2)
+
+    # --- КОМПАКТНАЯ СЕРИАЛИЗАЦИЯ ---
+    def encode(self):
+        """[версия, склад, город, Т2 ₸, Т2 $/кг, [[категория, имя, вес, объем, плотность, тариф, м³?, сумма], ...]]"""
+        return json.dumps([ENCODING_VERSION, self.warehouse, self.city, self.t2_kzt, self.t2_rate_usd,
+                           [[i.category, i.name, i.weight, i.volume, i.density, i.rate, int(i.is_cbm), i.cost] for i in self.items]],
+                          ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def decode(cls, data):
+        version, warehouse, city, t2_kzt, t2_rate_usd, items = json.loads(data)
+        if version != ENCODING_VERSION: raise ValueError(f"Unknown quote encoding: {version}")
+        return cls(warehouse, city, [LineItem(c, n, w, v, d, r, bool(cbm), cost) for c, n, w, v, d, r, cbm, cost in items],
+                   t2_kzt, t2_rate_usd)
+
+    # --- ПРЕДСТАВЛЕНИЯ ---
+    def render_items(self):
+        return "".join(
+            f"<b>{n}. {i.name}</b>\n"
+            f"   ▫️ {i.weight} кг / {i.volume:.2f} м³ (Плотн: {i.density:.0f})\n"
+            f"   ▫️ Тариф: ${i.rate}/{i.unit}\n"
+            f"   ▫️ Сумма: <b>${i.cost:.2f}</b>\n\n"
+            for n, i in enumerate(self.items, 1)
+        )
+
+    def render_client(self, wh_name):
+        return (
+            f"📊 <b>ДЕТАЛЬНЫЙ РАСЧЕТ | Заявка</b>\n\n"
+            f"🏙 <b>Маршрут:</b> {wh_name} ➡️ {self.city}\n\n"
+            f"📦 <b>СОСТАВ ГРУЗА:</b>\n"
+            f"{self.render_items()}"
+            f"----------------------------------\n"
+            f"🇨🇳 <b>Т1 (КИТАЙ → АЛМАТЫ)</b>\n"
+            f"• Общий вес: <b>{self.total_weight} кг</b>\n"
+            f"• Общий объем: <b>{self.total_volume:.2f} м³</b>\n"
+            f"💵 <b>ИТОГО Т1: ${self.t1_usd:.2f} USD</b>\n\n"
+
+            f"🇰🇿 <b>Т2 (АЛМАТЫ → ДВЕРЬ)</b>\n"
+            f"• Тарифная зона: {self.city}\n"
+            f"💵 <b>ИТОГО Т2: ~{self.t2_kzt} ₸</b>\n\n"
+
+            f"<i>Тариф по РК предварительный. Точный расчет — по прибытию в Алматы.</i>\n\n"
+            f"💡 <b>Страхование:</b> 1% от стоимости товара.\n"
+            f"💳 <b>Оплата:</b> При получении груза в тенге удобным Вам способом."
+        )
+
+    def render_admin(self, client_name, phone, wh_name):
+        return (
+            f"🔥 <b>НОВАЯ ЗАЯВКА</b>\n"
+            f"👤 {client_name} ({phone})\n"
+            f"🏙 {self.city} | 🏭 {wh_name}\n\n"
+            f"📦 <b>ДЕТАЛИЗАЦИЯ:</b>\n"
+            f"{self.render_items()}"
+            f"----------------------------------\n"
+            f"⚖️ <b>ВСЕГО:</b> {self.total_weight} кг | {self.total_volume:.2f} м³\n"
+            f"💵 <b>ИТОГО Т1: ${self.t1_usd:.2f}</b>\n"
+            f"🇰🇿 <b>ИТОГО Т2: ~{self.t2_kzt} ₸</b>"
+        )
+
+    def make_payload(self):
+        return {
+            "warehouse_code": self.warehouse, "city": self.city,
+            "t1_usd": self.t1_usd, "t2_kzt": self.t2_kzt,
+            "total_weight": self.total_weight, "total_volume": self.total_volume,
+            "items": [{"category": i.category, "weight": i.weight, "volume": i.volume, "density": i.density,
+                       "rate": i.rate, "unit": "m3" if i.is_cbm else "kg", "cost": i.cost} for i in self.items],
+        }
+
+
+# --- LRU ГОТОВЫХ РАСЧЕТОВ ---
+_quotes = OrderedDict()
+_quotes_matrix = None
+
+
+def quote_cart(warehouse, city, items):
+    """items — кортеж (category, name, weight, volume). Повтор той же корзины — O(1) из LRU.
+
+    Кэш сбрасывается, когда tariff_matrix пересобирает матрицу после изменения config.json.
+    """
+    global _quotes_matrix
+    matrix = get_matrix()
+    if matrix is not _quotes_matrix:
+        _quotes.clear()
+        _quotes_matrix = matrix
+    key = (warehouse, city.lower().strip(), tuple(items))
+    quote = _quotes.get(key)
+    if quote is not None:
+        _quotes.move_to_end(key)
+        return quote
+
+    lines = []
+    for category, name, weight, volume in items:
+        cost, rate, density, is_cbm = matrix.t1_rate(weight, volume, category, warehouse)
+        lines.append(LineItem(category, name, weight, volume, round(density, 2), round(rate, 2), is_cbm, round(cost, 2)))
+    t2_kzt, t2_rate_usd = matrix.t2_cost(sum(i.weight for i in lines), city)
+    quote = Quote(warehouse, city, lines, t2_kzt, t2_rate_usd)
+
+    _quotes[key] = quote
+    if len(_quotes) > QUOTE_CACHE_SIZE: _quotes.popitem(last=False)
+    return quote
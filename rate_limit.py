@@ -0,0 +1,116 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict, Counter
+from common import TTLCache
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv('REDIS_URL')
+
+# (запросов на пользователя в минуту, глобально в секунду)
+LIMITS = {
+    'track': (int(os.getenv('RL_TRACK_PER_MIN', 10)), int(os.getenv('RL_TRACK_GLOBAL_PER_SEC', 50))),
+    'ai': (int(os.getenv('RL_AI_PER_MIN', 5)), int(os.getenv('RL_AI_GLOBAL_PER_SEC', 2))),
+}
+MAX_TRACKED_USERS = 50000
+NEGATIVE_TTL = 120
+NEGATIVE_CACHE_SIZE = 20000
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, n=1):
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    async def take(self):
+        while not self.try_take():
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# --- МЕТРИКИ ---
+STATS = Counter()
+
+_user_buckets = {kind: OrderedDict() for kind in LIMITS}
+_global_buckets = {kind: TokenBucket(per_sec) for kind, (_, per_sec) in LIMITS.items()}
+_redis = None
+
+unknown_tracks = TTLCache(NEGATIVE_CACHE_SIZE, NEGATIVE_TTL)
+_warned = TTLCache(MAX_TRACKED_USERS, 60)
+
+
+def _local_allow(kind, user_id):
+    per_min, _ = LIMITS[kind]
+    buckets = _user_buckets[kind]
+    bucket = buckets.get(user_id)
+    if bucket is None:
+        bucket = buckets[user_id] = TokenBucket(per_min / 60, per_min)
+        if len(buckets) > MAX_TRACKED_USERS: buckets.popitem(last=False)
+    else:
+        buckets.move_to_end(user_id)
+    return bucket.try_take()
+
+
+async def _redis_allow(kind, user_id):
+    """Общий для всех процессов лимит: счетчик в фиксированном минутном окне."""
+    global _redis
+    if _redis is None:
+        import redis.asyncio as aioredis
+        _redis = aioredis.from_url(REDIS_URL)
+    key = f"rl:{kind}:{user_id}:{int(time.time() // 60)}"
+    pipe = _redis.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, 61)
+    count, _ = await pipe.execute()
+    return count <= LIMITS[kind][0]
+
+
+async def allow(kind, user_id):
+    """True, если запрос пользователя вида kind ('track' / 'ai') можно обработать.
+
+    Сначала личный лимит, потом общий: запросы флудера, отбитые личным лимитом,
+    не тратят общие токены остальных пользователей.
+    """
+    if REDIS_URL:
+        try: ok = await _redis_allow(kind, user_id)
+        except Exception as e:
+            logger.warning(f"Redis limiter unavailable, using local: {e}")
+            ok = _local_allow(kind, user_id)
+    else:
+        ok = _local_allow(kind, user_id)
+    if not ok:
+        STATS[f'{kind}_throttled_user'] += 1
+        return False
+    if not _global_buckets[kind].try_take():
+        STATS[f'{kind}_throttled_global'] += 1
+        return False
+    STATS[f'{kind}_allowed'] += 1
+    return True
+
+
+def first_warning(user_id):
+    """Предупреждение о лимите отправляем не чаще раза в минуту, иначе флуд превращается в наши ответы."""
+    if _warned.get(user_id): return False
+    _warned.set(user_id, True)
+    return True
+
+
+def format_stats():
+    lines = [f"{k}: {v}" for k, v in sorted(STATS.items())]
+    lines.append(f"unknown_tracks_cached: {len(unknown_tracks)}")
+    return "\n".join(lines)
@@ -0,0 +1,127 @@
+import os
+import json
+import signal
+import asyncio
+import logging
+from datetime import datetime
+from dotenv import load_dotenv
+from telegram import Update
+import app as client_bot
+import guangzhou_bot as warehouse_bot
+import outbox
+import funnel
+import sender
+import executors
+from common import DATABASE_URL, close_pool
+from notifier import run_status_notifier
+from transit_model import run_transit_model
+from tariff_matrix import get_matrix
+
+# Оба бота в одном процессе и одном event loop: общий пул БД, HTTP-сессия вебхуков,
+# снимок тарифов и кэши (это глобальные объекты модулей, они и так одни на процесс).
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+HEALTH_PORT = int(os.getenv('PORT', 0))     # Render отдает порт веб-сервиса через PORT
+HEALTH_INTERVAL = 60
+HEALTH_TIMEOUT = 10
+
+BOTS = {
+    'client': (client_bot.TOKEN, client_bot.setup_application),
+    'warehouse': (warehouse_bot.TOKEN, warehouse_bot.setup_app),
+}
+health = {}
+
+
+async def start_bot(name, app):
+    """Ручной жизненный цикл вместо run_polling: run_polling блокирует loop одним ботом."""
+    try:
+        await app.initialize()
+        await app.start()
+        await app.updater.start_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+        health[name] = {'ok': True, 'checked_at': None, 'error': None}
+        logger.info(f"Bot '{name}' started")
+    except Exception as e:
+        health[name] = {'ok': False, 'checked_at': None, 'error': str(e)}
+        logger.error(f"Bot '{name}' failed to start: {e}")
+
+
+async def stop_bot(name, app):
+    try:
+        if app.updater.running: await app.updater.stop()
+        if app.running: await app.stop()
+        await app.shutdown()
+    except Exception as e:
+        logger.error(f"Bot '{name}' shutdown error: {e}")
+
+
+async def check_health(apps):
+    """Раз в HEALTH_INTERVAL: getMe отвечает и поллинг жив — отдельно для каждого бота."""
+    while True:
+        for name, app in apps.items():
+            state = health[name]
+            try:
+                await asyncio.wait_for(app.bot.get_me(), HEALTH_TIMEOUT)
+                error = None if app.updater.running else 'polling stopped'
+            except Exception as e:
+                error = str(e) or type(e).__name__
+            if error and state['ok']: logger.warning(f"Bot '{name}' unhealthy: {error}")
+            state.update(ok=error is None, checked_at=datetime.now().isoformat(timespec='seconds'), error=error)
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+
+async def serve_health(reader, writer):
+    """Минимальный HTTP для health check хостинга: 200, если здоровы все боты, иначе 503."""
+    try:
+        await reader.readline()
+        ok = all(s['ok'] for s in health.values())
+        body = json.dumps(health, ensure_ascii=False).encode()
+        writer.write(f"HTTP/1.1 {'200 OK' if ok else '503 Service Unavailable'}\r\n"
+                     f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def main():
+    get_matrix()            # Ошибка в config.json — ConfigError сразу, до запуска ботов
+    apps = {name: setup() for name, (token, setup) in BOTS.items() if token}
+    if not apps:
+        logger.error("NO TOKEN")
+        return
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop.set)
+    executors.install(loop)
+
+    for name, app in apps.items(): await start_bot(name, app)
+
+    # Фоновые задачи — по одной на процесс, а не на каждого бота: post_init/post_stop ботов вызывает только run_polling,
+    # здесь их работу делают main() и блок остановки ниже
+    loop.run_in_executor(None, client_bot.startup_checks)
+    workers = [asyncio.create_task(check_health(apps))]
+    if DATABASE_URL:
+        workers.append(asyncio.create_task(outbox.run_relay(DATABASE_URL)))
+        workers.append(asyncio.create_task(run_transit_model(DATABASE_URL)))
+        if 'client' in apps:
+            workers.append(asyncio.create_task(run_status_notifier(apps['client'].bot, DATABASE_URL)))
+            workers.append(asyncio.create_task(funnel.run_flusher(DATABASE_URL)))
+    server = await asyncio.start_server(serve_health, '0.0.0.0', HEALTH_PORT) if HEALTH_PORT else None
+
+    await stop.wait()
+    logger.info("Shutting down...")
+    if server: server.close()
+    # Сначала перестаем принимать апдейты и дожидаемся текущих хендлеров, потом гасим воркеров и пул
+    for app in apps.values():
+        if app.updater.running: await app.updater.stop()
+    for task in workers: task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    await sender.close_all()        # Досылаем очередь, пока HTTP-клиенты ботов еще открыты
+    for name, app in apps.items(): await stop_bot(name, app)
+    await loop.run_in_executor(None, close_pool)
+    executors.shutdown()
+
+
+if __name__ == '__main__':
+    # Оба бота одним процессом: python run_bots.py (по отдельности по-прежнему: python app.py / python guangzhou_bot.py)
+    asyncio.run(main())
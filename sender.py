@@ -0,0 +1,210 @@
+import time
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict, Counter
+from telegram.error import RetryAfter, Forbidden, BadRequest
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты очереди: меньше — раньше. Ответы операторов не ждут за рассылкой.
+REPLY, ADMIN, PUSH, BROADCAST = range(4)
+
+GLOBAL_RATE = 25              # Bot API: ~30 сообщений/с на бота, оставляем запас
+GLOBAL_BURST = 5              # Без большого всплеска: Telegram считает в скользящем окне
+PRIVATE_INTERVAL = 1.0        # Не чаще 1 сообщения в секунду в личный чат
+GROUP_INTERVAL = 3.0          # Группы: не больше 20 сообщений в минуту
+SEND_CONCURRENCY = 8          # Одновременных запросов к API (keep-alive соединения httpx бота)
+MAX_ATTEMPTS = 3
+MAX_TRACKED_CHATS = 50000
+CLOSE_TIMEOUT = 10
+
+
+class Sender:
+    """Очередь исходящих вызовов Bot API одного бота.
+
+    Глобальный лимит — TokenBucket, лимит на чат — слот «не раньше чем» для каждого чата.
+    Сообщение, чей чат еще занят, откладывается до своего слота и не держит очередь.
+    На 429 (RetryAfter) пауза ставится на всю отправку, сообщение уходит повторно.
+    """
+
+    def __init__(self, bot, rate=GLOBAL_RATE, concurrency=SEND_CONCURRENCY):
+        self.bot = bot
+        self.bucket = TokenBucket(rate, GLOBAL_BURST)
+        self.stats = Counter()
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()         # FIFO внутри одного приоритета
+        self._slots = asyncio.Semaphore(concurrency)
+        self._next_at = OrderedDict()         # chat_id -> monotonic, когда в чат можно снова писать
+        self._paused_until = 0.0
+        self._inflight = set()
+        self._deferred = set()                # Futures сообщений, ждущих слота своего чата
+        self._worker = None
+
+    def submit(self, chat_id, priority=REPLY, method='send_message', **kwargs):
+        """Ставит bot.<method>(chat_id=..., **kwargs) в очередь. Возвращает Future с результатом вызова."""
+        if self._worker is None: self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._seq), chat_id, method, kwargs, future, 1, False))
+        self.stats['queued'] += 1
+        return future
+
+    async def send(self, chat_id, priority=REPLY, method='send_message', **kwargs):
+        return await self.submit(chat_id, priority, method, **kwargs)
+
+    def send_nowait(self, chat_id, priority=ADMIN, method='send_message', **kwargs):
+        """Без ожидания результата; ошибка не теряется молча, а пишется в лог."""
+        self.submit(chat_id, priority, method, **kwargs).add_done_callback(_log_failure)
+
+    def pending(self):
+        return self._queue.qsize() + len(self._inflight) + len(self._deferred)
+
+    def _requeue(self, item):
+        self._deferred.discard(item[5])
+        self._queue.put_nowait(item)
+
+    def _reserve(self, chat_id):
+        """Следующий свободный слот чата; слоты занимаются в порядке выборки из очереди."""
+        now = time.monotonic()
+        at = max(now, self._next_at.pop(chat_id, 0.0))
+        self._next_at[chat_id] = at + (GROUP_INTERVAL if str(chat_id).startswith('-') else PRIVATE_INTERVAL)
+        if len(self._next_at) > MAX_TRACKED_CHATS: self._next_at.popitem(last=False)
+        return at - now
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            priority, seq, chat_id, method, kwargs, future, attempt, reserved = item
+            if future.done(): continue                   # Вызывающий отменил ожидание
+            if not reserved:
+                delay = self._reserve(chat_id)
+                if delay > 0:
+                    self.stats['deferred'] += 1
+                    self._deferred.add(future)
+                    loop.call_later(delay, self._requeue, item[:7] + (True,))
+                    continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0: await asyncio.sleep(pause)
+            await self.bucket.take()
+            await self._slots.acquire()
+            task = asyncio.create_task(self._deliver(item))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _deliver(self, item):
+        priority, seq, chat_id, method, kwargs, future, attempt, _ = item
+        try:
+            result = await getattr(self.bot, method)(chat_id=chat_id, **kwargs)
+        except RetryAfter as e:
+            self.stats['retry_after'] += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            logger.warning(f"Bot API flood control: pause {e.retry_after} s")
+            if attempt < MAX_ATTEMPTS:
+                self._queue.put_nowait((priority, seq, chat_id, method, kwargs, future, attempt + 1, True))
+            elif not future.done():
+                future.set_exception(e)
+        except Exception as e:
+            self.stats['failed'] += 1
+            if not future.done(): future.set_exception(e)
+        else:
+            self.stats['sent'] += 1
+            if not future.done(): future.set_result(result)
+        finally:
+            self._slots.release()
+
+    async def close(self, timeout=CLOSE_TIMEOUT):
+        """Дожидается отправки очереди (не дольше timeout), остальное отменяет."""
+        deadline = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < deadline: await asyncio.sleep(0.1)
+        if self._worker: self._worker.cancel()
+        for task in list(self._inflight): task.cancel()
+        futures = set(self._deferred)
+        while not self._queue.empty(): futures.add(self._queue.get_nowait()[5])
+        for future in futures:
+            if not future.done(): future.cancel()
+        self._deferred.clear()
+        self._worker = None
+
+
+def _log_failure(future):
+    if future.cancelled(): return
+    e = future.exception()
+    if e is None: return
+    if isinstance(e, (Forbidden, BadRequest)): logger.info(f"Message not delivered: {e}")
+    else: logger.warning(f"Message send failed: {e}")
+
+
+_senders = {}
+
+
+def get(bot):
+    """Один Sender на бота в процессе: и хендлеры, и воркеры делят его лимиты."""
+    sender = _senders.get(id(bot))
+    if sender is None: sender = _senders[id(bot)] = Sender(bot)
+    return sender
+
+
+async def close_all(timeout=CLOSE_TIMEOUT):
+    senders = list(_senders.values())
+    _senders.clear()
+    await asyncio.gather(*(s.close(timeout) for s in senders))
+
+
+# --- ПРОВЕРКА НА ФЕЙКОВОМ API ---
+
+class FakeBot:
+    """Имитация Bot API: задержка сети и 429 при превышении тех же лимитов, что у Telegram."""
+
+    def __init__(self, latency=0.05, global_per_sec=30, retry_after=1):
+        self.latency = latency
+        self.global_per_sec = global_per_sec
+        self.retry_after = retry_after
+        self.sent = []              # (monotonic, chat_id, text)
+        self.flood = 0
+        self._last = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        recent = sum(1 for t, _, _ in self.sent[-self.global_per_sec:] if now - t < 1)
+        per_chat = GROUP_INTERVAL if chat_id < 0 else PRIVATE_INTERVAL
+        if recent >= self.global_per_sec or now - self._last.get(chat_id, -per_chat) < per_chat * 0.9:
+            self.flood += 1
+            raise RetryAfter(self.retry_after)
+        self._last[chat_id] = now
+        self.sent.append((now, chat_id, text))
+        return len(self.sent)
+
+
+async def _harness(broadcast, replies):
+    bot = FakeBot()
+    sender = Sender(bot)
+    t0 = time.monotonic()
+    futures = [sender.submit(1000 + i % 400, BROADCAST, text=f"broadcast {i}") for i in range(broadcast)]
+    futures += [sender.submit(-100, PUSH, text=f"group {i}") for i in range(5)]
+    await asyncio.sleep(1)
+    # Ответы операторов приходят посреди рассылки и должны обогнать ее
+    reply_at = {}
+    for i in range(replies):
+        reply_at[f"reply {i}"] = time.monotonic()
+        futures.append(sender.submit(50 + i, REPLY, text=f"reply {i}"))
+    await asyncio.gather(*futures, return_exceptions=True)
+    total = time.monotonic() - t0
+    delivered = {text: t for t, _, text in bot.sent}
+    waits = sorted(delivered[k] - v for k, v in reply_at.items() if k in delivered)
+    group = [t for t, chat, _ in bot.sent if chat == -100]
+    print(f"📤 Отправлено {len(bot.sent)} из {len(futures)} за {total:.1f} c ({len(bot.sent) / total:.1f}/с)")
+    print(f"🚦 429 от API: {bot.flood} | stats: {dict(sender.stats)}")
+    if waits: print(f"⚡ Ответы: медиана {waits[len(waits) // 2]:.2f} c, макс {waits[-1]:.2f} c")
+    if len(group) > 1: print(f"👥 Группа: мин. интервал {min(b - a for a, b in zip(group, group[1:])):.2f} c")
+    await sender.close()
+
+
+if __name__ == '__main__':
+    # python sender.py [рассылка] [ответов] — прогон очереди на фейковом API, без токена и сети
+    import sys
+    logging.basicConfig(level=logging.WARNING)
+    args = [int(a) for a in sys.argv[1:3]]
+    asyncio.run(_harness(*(args + [500, 20][len(args):])))
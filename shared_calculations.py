@@ -1,18 +1,11 @@
-import json
 import os
 import requests
 from dotenv import load_dotenv
+from config_schema import FALLBACK_WAREHOUSE, FALLBACK_CATEGORY, UNZONED_T2_COST, UNZONED_T2_EXTRA_KG_RATE
+from tariff_matrix import DEFAULT_ZONE, REF_RATE_USD, get_matrix
 
 load_dotenv()
 
-# Загружаем конфиг
-try:
-    with open('config.json', 'r', encoding='utf-8') as f:
-        CONFIG = json.load(f)
-except Exception as e:
-    print(f"❌ Ошибка загрузки config.json: {e}")
-    CONFIG = {}
-
 MAKE_CATEGORIZER_WEBHOOK = os.getenv('MAKE_CATEGORIZER_WEBHOOK')
 
 def get_product_category_from_ai(text):
@@ -46,30 +39,17 @@ def universal_t1_calculation(weight, volume, category_key, warehouse="GZ"):
             
         density = weight / volume if volume > 0 else 9999.0
         
-        # Получаем тарифы для склада, если нет - берем GZ
-        rates = CONFIG.get('T1_RATES_DENSITY', {}).get(warehouse, CONFIG.get('T1_RATES_DENSITY', {}).get('GZ', {}))
-        cat_rates = rates.get(category_key, rates.get('obshhie', []))
-        
-        if not cat_rates:
-            return {'cost_usd': 0, 'rate': 0, 'unit': 'kg', 'density': density}
-        
-        base_price = 0
-        unit = 'kg'
+        # Получаем тарифы для склада, если нет - берем GZ (склад и категория obshhie есть по схеме)
+        config = get_matrix().config
+        rates = config.t1.get(warehouse) or config.t1[FALLBACK_WAREHOUSE]
+        cat_rates = rates.get(category_key) or rates[FALLBACK_CATEGORY]
         
-        # Ищем подходящий тариф по плотности
-        for rate in sorted(cat_rates, key=lambda x: x.get('min_density', 0), reverse=True):
-            if density >= rate.get('min_density', 0):
-                base_price = rate.get('price', 0)
-                unit = rate.get('unit', 'kg')
-                break
-        
-        # Если не нашли - берем последний (минимальная плотность)
-        if base_price == 0 and cat_rates:
-            base_price = cat_rates[-1].get('price', 0)
-            unit = cat_rates[-1].get('unit', 'kg')
+        # Полосы уже по убыванию плотности; если не нашли - берем последнюю (минимальная плотность)
+        band = next((b for b in cat_rates if density >= b.min_density), cat_rates[-1])
+        base_price, unit = band.price, band.unit
         
-        # Наценка 30%
-        client_rate = base_price * 1.30
+        # Наценка из конфига (по умолчанию 30%)
+        client_rate = base_price * config.markup
         cost = client_rate * (volume if unit == 'm3' else weight)
         
         return {
@@ -85,13 +65,10 @@ def universal_t1_calculation(weight, volume, category_key, warehouse="GZ"):
 def universal_t2_calculation(weight, city):
     """Универсальный расчет T2 для всех ботов"""
     try:
-        city_key = city.lower().strip()
-        zone = CONFIG.get('DESTINATION_ZONES', {}).get(city_key, "5")
-        zone = str(zone)
-        
-        t2_config = CONFIG.get('T2_RATES_DETAILED', {}).get('large_parcel', {})
-        weight_ranges = t2_config.get('weight_ranges', [])
-        extra_kg_rate = t2_config.get('extra_kg_rate', {}).get(zone, 260)
+        config = get_matrix().config
+        zone = config.zones.get(city.lower().strip(), DEFAULT_ZONE)
+        weight_ranges = config.t2_ranges
+        extra_kg_rate = config.t2_extra_kg_rate.get(zone, UNZONED_T2_EXTRA_KG_RATE)
         
         if weight <= 0:
             return 0, 0.8
@@ -100,19 +77,18 @@ def universal_t2_calculation(weight, city):
         final_cost = 0
         found = False
         for range_data in weight_ranges:
-            if weight <= range_data['max']:
-                final_cost = range_data['zones'].get(zone, 5000)
+            if weight <= range_data.max:
+                final_cost = range_data.zones.get(zone, UNZONED_T2_COST)
                 found = True
                 break
         
         # Если вес больше максимального диапазона
-        if not found and weight_ranges:
+        if not found:
             last_range = weight_ranges[-1]
-            base_cost = last_range['zones'].get(zone, 5000)
-            extra_weight = weight - 20
-            final_cost = base_cost + (extra_weight * extra_kg_rate)
+            extra_weight = weight - last_range.max
+            final_cost = last_range.zones.get(zone, UNZONED_T2_COST) + (extra_weight * extra_kg_rate)
         
-        ref_rate_usd = {"1": 0.4, "2": 0.5, "3": 0.6, "4": 0.7, "5": 0.8}.get(zone, 0.8)
+        ref_rate_usd = REF_RATE_USD.get(zone, REF_RATE_USD[DEFAULT_ZONE])
         
         return int(final_cost), ref_rate_usd
     except Exception as e:
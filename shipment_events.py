@@ -0,0 +1,110 @@
+# --- ЖУРНАЛ СТАТУСОВ (append-only) ---
+# Все смены статуса пишутся в shipment_events в той же транзакции, что и изменение shipments,
+# а shipment_state хранит компактную проекцию "текущий статус + последний event id".
+
+_PROJECT_SQL = """
+INSERT INTO shipment_state (contract_num, status, route_progress, last_event_id, changed_at)
+SELECT contract_num, status, route_progress, id, created_at FROM ev
+ON CONFLICT (contract_num) DO UPDATE
+SET status = EXCLUDED.status, route_progress = EXCLUDED.route_progress,
+    last_event_id = EXCLUDED.last_event_id, changed_at = EXCLUDED.changed_at
+RETURNING contract_num
+"""
+
+
+def update_status_bulk(cur, tracks, status, progress, actor=None, warehouses=None, from_status=None):
+    """Меняет статус сразу у всех треков/контрактов одним запросом. Возвращает список контрактов.
+
+    warehouses — склады оператора: грузы других складов не трогаются (None — без ограничения).
+    from_status — LIKE-шаблон текущего статуса: грузы, ушедшие дальше, не откатываются.
+    """
+    if not tracks: return []
+    wh = None if warehouses is None else list(warehouses)
+    cur.execute("""
+        WITH upd AS (
+            UPDATE shipments SET status = %s, route_progress = %s
+            WHERE (track_number = ANY(%s) OR contract_num = ANY(%s))
+              AND (%s::text[] IS NULL OR warehouse_code = ANY(%s::text[]))
+              AND (%s::text IS NULL OR status LIKE %s)
+            RETURNING contract_num, track_number, warehouse_code, status, route_progress
+        ), ev AS (
+            INSERT INTO shipment_events (contract_num, track_number, warehouse_code, status, route_progress, actor)
+            SELECT contract_num, track_number, warehouse_code, status, route_progress, %s FROM upd
+            RETURNING id, contract_num, status, route_progress, created_at
+        )
+    """ + _PROJECT_SQL, (status, progress, list(tracks), list(tracks), wh, wh, from_status, from_status, actor))
+    return [r[0] for r in cur.fetchall()]
+
+
+def append_event(cur, contract_num, actor=None):
+    """Фиксирует текущий статус контракта (после INSERT/UPDATE в той же транзакции)."""
+    cur.execute("""
+        WITH ev AS (
+            INSERT INTO shipment_events (contract_num, track_number, warehouse_code, status, route_progress, actor)
+            SELECT contract_num, track_number, warehouse_code, status, COALESCE(route_progress, 0), %s
+            FROM shipments WHERE contract_num = %s
+            RETURNING id, contract_num, status, route_progress, created_at
+        )
+    """ + _PROJECT_SQL, (actor, contract_num))
+
+
+# --- КУРСОР ЧИТАТЕЛЕЙ ЖУРНАЛА ---
+# id (BIGSERIAL) выдается при вставке, а не при коммите: транзакция с меньшим id может
+# закоммититься позже, и курсор "id > X" ее навсегда пропустит. Поэтому курсор — (xid, id):
+# читаются только события транзакций старше горизонта pg_snapshot_xmin — все они уже
+# завершены, и новых строк с таким xid не появится. Нужен PostgreSQL 13+ (xid8).
+
+def events_since(cur, cursor=None, limit=500):
+    """Следующая пачка событий после cursor ((xid, id) или None — с начала журнала).
+
+    Возвращает (события, новый курсор). Внутри пачки события упорядочены по id: для одного
+    груза это порядок смены статуса (обновления строки сериализуются блокировкой).
+    """
+    xid, after_id = cursor or (None, 0)
+    cur.execute("""
+        SELECT id, contract_num, track_number, warehouse_code, status, route_progress, actor, created_at, xid::text
+        FROM shipment_events
+        WHERE (%s::xid8 IS NULL OR (xid, id) > (%s::xid8, %s))
+          AND xid < pg_snapshot_xmin(pg_current_snapshot())
+        ORDER BY xid, id LIMIT %s
+    """, (xid, xid, after_id, limit))
+    rows = cur.fetchall()
+    if not rows: return [], cursor
+    last = rows[-1]
+    return sorted((r[:-1] for r in rows), key=lambda r: r[0]), (last[-1], last[0])
+
+
+def read_cursor(cur, name, lock=False):
+    """Курсор читателя из notifier_cursor: (xid, id) или None, если читатель новый.
+
+    Курсор старого формата (только last_event_id) переводится в (xid того события, id).
+    """
+    cur.execute("SELECT last_xid::text, last_event_id FROM notifier_cursor WHERE name = %s" + (" FOR UPDATE" if lock else ""), (name,))
+    row = cur.fetchone()
+    if not row: return None
+    if row[0]: return row[0], row[1]
+    cur.execute("SELECT xid::text, id FROM shipment_events WHERE id <= %s ORDER BY id DESC LIMIT 1", (row[1],))
+    return cur.fetchone()
+
+
+def journal_end(cur):
+    """Курсор на текущий конец журнала: новый читатель не разбирает всю историю."""
+    cur.execute("SELECT xid::text, id FROM shipment_events ORDER BY xid DESC, id DESC LIMIT 1")
+    return cur.fetchone()
+
+
+def write_cursor(cur, name, cursor):
+    xid, last_id = cursor
+    cur.execute("""
+        INSERT INTO notifier_cursor (name, last_event_id, last_xid) VALUES (%s, %s, %s::xid8)
+        ON CONFLICT (name) DO UPDATE SET last_event_id = EXCLUDED.last_event_id, last_xid = EXCLUDED.last_xid
+    """, (name, last_id, xid))
+
+
+def shipment_timeline(cur, contract_num):
+    """История статусов одного груза: [(status, route_progress, created_at)]."""
+    cur.execute("""
+        SELECT status, route_progress, created_at FROM shipment_events
+        WHERE contract_num = %s ORDER BY id
+    """, (contract_num,))
+    return cur.fetchall()
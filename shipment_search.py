@@ -0,0 +1,44 @@
+# --- ПОИСК ГРУЗОВ ---
+# Индексы (create_tables.py): GiST pg_trgm по search_text — KNN по расстоянию word_similarity (<->>)
+# (подстроки, опечатки, хвост телефона); search_tsv (словоформы: "кроссовки" найдет "кроссовок")
+# только переранжирует кандидатов.
+
+MIN_QUERY_LEN = 3
+# Широкий запрос (город, "кроссовки", 3 цифры телефона) совпадает с большой долей таблицы:
+# ранжируем не все совпадения, а CANDIDATES ближайших по индексу
+CANDIDATES = 200
+
+SEARCH_SQL = """
+WITH candidates AS (
+    SELECT contract_num, track_number, fio, phone, product, client_city, status, created_at, search_text, search_tsv,
+           search_text <->> %(q)s AS distance
+    FROM shipments
+    WHERE (%(wh)s::text[] IS NULL OR warehouse_code = ANY(%(wh)s::text[]))
+    ORDER BY search_text <->> %(q)s
+    LIMIT %(candidates)s
+)
+SELECT contract_num, track_number, fio, phone, product, client_city, status,
+       GREATEST(1 - distance, ts_rank(search_tsv, plainto_tsquery('russian', %(q)s))) AS score
+FROM candidates
+WHERE (search_text ILIKE %(like)s
+       OR search_tsv @@ plainto_tsquery('russian', %(q)s)
+       OR %(q)s <%% search_text)
+ORDER BY score DESC, created_at DESC
+LIMIT %(limit)s
+"""
+
+
+def normalize_query(text):
+    """'…0479' -> '0479'; '+7 700 047' -> '7700047' (телефон в search_text хранится цифрами)."""
+    q = (text or '').strip().strip('.…*% ').lower()
+    digits = ''.join(ch for ch in q if ch.isdigit())
+    if digits and len(digits) >= len(q.replace(' ', '').replace('+', '').replace('-', '')): return digits
+    return q
+
+
+def search_shipments(cur, text, limit=10, warehouses=None):
+    q = normalize_query(text)
+    if len(q) < MIN_QUERY_LEN: return []
+    like = '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    cur.execute(SEARCH_SQL, {'q': q, 'like': like, 'limit': limit, 'candidates': max(CANDIDATES, limit), 'wh': None if warehouses is None else list(warehouses)})
+    return cur.fetchall()
@@ -0,0 +1,191 @@
+import os
+import mmap
+import pickle
+import hashlib
+import logging
+from array import array
+from bisect import bisect_right
+import config_schema
+from config_schema import ZONES, CBM_RATE, FALLBACK_WAREHOUSE, FALLBACK_CATEGORY, UNZONED_T2_COST, UNZONED_T2_EXTRA_KG_RATE, ConfigError
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = 'config.json'
+# Готовая матрица в pickle: на старте не нужно парсить и проверять JSON и заново строить массивы.
+# Файл: sha256(CACHE_FORMAT + содержимое config.json), затем pickle
+CACHE_PATH = os.getenv('TARIFF_CACHE_PATH', 'config.cache')
+CACHE_FORMAT = 4            # Менять при изменении полей TariffMatrix/Config: старый pickle тогда не подхватится
+DEFAULT_ZONE = "5"          # Город не из DESTINATION_ZONES — по самой дальней зоне
+REF_RATE_USD = {"1": 0.4, "2": 0.5, "3": 0.6, "4": 0.7, "5": 0.8}
+
+
+class TariffMatrix:
+    """Предрасчитанная матрица тарифов: склад × категория × полоса плотности × зона.
+
+    Пороги плотности и цены всех (склад, категория) лежат подряд в двух
+    плоских array('d'); _index хранит срез и цену-заглушку для каждой пары.
+    """
+
+    def __init__(self, config):
+        """config — проверенный config_schema.Config: все склады, зоны и полосы на месте."""
+        self.config = config
+        self.zones = config.zones
+        self.markup = config.markup
+        self._thresholds = array('d')
+        self._prices = array('d')
+        self._index = {}
+        self._warehouses = set(config.t1)
+
+        for wh, categories in config.t1.items():
+            for cat, bands in categories.items():
+                start = len(self._thresholds)
+                # Схема гарантирует убывание плотности; для bisect — по возрастанию
+                for band in reversed(bands):
+                    self._thresholds.append(band.min_density)
+                    self._prices.append(band.price)
+                self._index[(wh, cat)] = (start, len(self._thresholds), bands[-1].price)
+
+        ranges = config.t2_ranges
+        self._t2_max = array('d', (r.max for r in ranges))
+        # Строка на зону: стоимость по каждому весовому диапазону + ставка за доп. кг
+        self._t2 = {zone: (array('d', (r.zones[zone] for r in ranges)), config.t2_extra_kg_rate[zone]) for zone in ZONES}
+        # Город с зоной не из ZONES (схема о нем предупредила)
+        self._t2_unzoned = (array('d', (UNZONED_T2_COST for _ in ranges)), UNZONED_T2_EXTRA_KG_RATE)
+
+    def _slice(self, warehouse, category_key):
+        key = (warehouse, category_key)
+        if key in self._index: return self._index[key]
+        # Неизвестный склад -> GZ, неизвестная категория -> obshhie (оба есть по схеме)
+        if warehouse not in self._warehouses: warehouse = FALLBACK_WAREHOUSE
+        return self._index.get((warehouse, category_key)) or self._index[(warehouse, FALLBACK_CATEGORY)]
+
+    def base_price(self, warehouse, category_key, density):
+        start, end, fallback = self._slice(warehouse, category_key)
+        i = bisect_right(self._thresholds, density, start, end) - 1
+        price = self._prices[i] if i >= start else 0
+        return price if price else fallback
+
+    def t1_rate(self, weight, volume, category_key, warehouse, agreed_rate_min=0):
+        density = weight / volume if volume > 0 else 9999.0
+        rate = max(self.base_price(warehouse, category_key, density) * self.markup, agreed_rate_min)
+        is_cbm = rate > CBM_RATE
+        cost = (rate * volume) if is_cbm else (rate * weight)
+        return cost, rate, density, is_cbm
+
+    def t1_base_cost(self, weight, volume, category_key, warehouse, is_cbm):
+        """Себестоимость Т1: цена перевозчика из config.json без наценки, в единицах тарифа клиента."""
+        density = weight / volume if volume > 0 else 9999.0
+        return self.base_price(warehouse, category_key, density) * (volume if is_cbm else weight)
+
+    def bands(self, warehouse, category_key):
+        """(пороги плотности, цены, цена-заглушка) пары склад/категория — для пересчета колонками."""
+        start, end, fallback = self._slice(warehouse, category_key)
+        return self._thresholds[start:end], self._prices[start:end], fallback
+
+    def t2_bands(self, zone):
+        """(верхние границы веса, стоимость по диапазонам, ставка за доп. кг) для зоны."""
+        costs, extra_kg_rate = self._t2.get(zone, self._t2_unzoned)
+        return self._t2_max, costs, extra_kg_rate
+
+    def zone_for(self, city_name):
+        return str(self.zones.get(city_name.lower().strip(), DEFAULT_ZONE))
+
+    def t2_cost(self, total_weight, city_name):
+        zone = self.zone_for(city_name)
+        if total_weight <= 0: return 0, 0.8
+        costs, extra_kg_rate = self._t2.get(zone, self._t2_unzoned)
+        i = bisect_right(self._t2_max, total_weight)
+        # Граница диапазона включительна: вес == max попадает в этот диапазон
+        if i > 0 and self._t2_max[i - 1] == total_weight: i -= 1
+        if i < len(costs): cost = costs[i]
+        else: cost = costs[-1] + (total_weight - self._t2_max[-1]) * extra_kg_rate
+        return int(cost), REF_RATE_USD.get(zone, REF_RATE_USD[DEFAULT_ZONE])
+
+
+# --- ГЛОБАЛЬНЫЙ СНИМОК + ПЕРЕСБОРКА ПРИ ИЗМЕНЕНИИ config.json ---
+_matrix = None
+_stamp = None           # (mtime, size) config.json: дешевая проверка на каждом вызове
+_digest = None          # Хэш содержимого, из которого собрана _matrix
+
+
+def _digest_of(data):
+    return hashlib.sha256(CACHE_FORMAT.to_bytes(2, 'big') + data).digest()
+
+
+def _load_cache(digest):
+    """Матрица из кэша, если он собран из того же содержимого config.json.
+
+    Файл отображается в память: заголовок сверяется без чтения файла целиком,
+    pickle разбирается прямо из страниц кэша ОС.
+    """
+    try:
+        with open(CACHE_PATH, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(digest)] != digest: return None
+            mm.seek(len(digest))
+            return pickle.load(mm)
+    except Exception:
+        return None
+
+
+def _save_cache(digest, matrix):
+    tmp = f"{CACHE_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(digest)
+            pickle.dump(matrix, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, CACHE_PATH)
+    except OSError as e:
+        logger.warning(f"Tariff cache not saved: {e}")
+
+
+def _build(data, digest):
+    matrix = _load_cache(digest)
+    if matrix is not None: return matrix
+    matrix = TariffMatrix(config_schema.loads(data))
+    _save_cache(digest, matrix)
+    logger.info("Tariff matrix rebuilt")
+    return matrix
+
+
+def get_matrix():
+    """Текущая матрица тарифов; пересобирается, когда меняется содержимое config.json.
+
+    Ошибка в config.json при первой загрузке — ConfigError: бот не стартует с пустыми
+    тарифами. При горячей перезагрузке — в лог, а считает прежняя матрица.
+    """
+    global _matrix, _stamp, _digest
+    try:
+        st = os.stat(CONFIG_PATH)
+    except OSError:
+        if _matrix is None: raise
+        return _matrix
+    stamp = (st.st_mtime_ns, st.st_size)
+    if stamp == _stamp: return _matrix
+    try:
+        with open(CONFIG_PATH, 'rb') as f: data = f.read()
+        digest = _digest_of(data)
+        # touch или git checkout без правок: содержимое то же — и матрица та же
+        matrix = _matrix if digest == _digest else _build(data, digest)
+    except (OSError, ConfigError) as e:
+        if _matrix is None: raise
+        logger.error(f"Tariff config error, keeping previous tariffs: {e}")
+        _stamp = stamp          # Не перепроверять на каждом расчете до следующей правки файла
+        return _matrix
+    _matrix, _stamp, _digest = matrix, stamp, digest
+    return _matrix
+
+
+if __name__ == '__main__':
+    # Пересобрать кэш заранее (например, в build-шаге деплоя): python tariff_matrix.py
+    # Через import, чтобы в pickle попал tariff_matrix.TariffMatrix, а не __main__.TariffMatrix
+    import time
+    import tariff_matrix
+    logging.basicConfig(level=logging.INFO)
+    if os.path.exists(CACHE_PATH): os.remove(CACHE_PATH)
+    t = time.perf_counter()
+    tariff_matrix.get_matrix()
+    cold = time.perf_counter() - t
+    tariff_matrix._matrix = tariff_matrix._stamp = tariff_matrix._digest = None
+    t = time.perf_counter()
+    tariff_matrix.get_matrix()
+    print(f"config.json -> матрица: {cold * 1000:.1f} мс | из {CACHE_PATH}: {(time.perf_counter() - t) * 1000:.1f} мс")
@@ -0,0 +1,199 @@
+import os
+import time
+import random
+import argparse
+from array import array
+from bisect import bisect_left, bisect_right
+from dotenv import load_dotenv
+import config_schema
+from config_schema import CBM_RATE
+from tariff_matrix import TariffMatrix, get_matrix
+
+load_dotenv()
+DATABASE_URL = os.getenv('DATABASE_URL')
+FETCH_SIZE = 50000
+
+LOAD_SQL = """
+SELECT COALESCE(actual_weight, declared_weight, 0), COALESCE(actual_volume, declared_volume, 0),
+       COALESCE(warehouse_code, 'GZ'), COALESCE(NULLIF(category, 'obshhie'), product, 'obshhie'), COALESCE(client_city, 'Алматы')
+FROM shipments
+WHERE created_at > NOW() - %s * INTERVAL '1 day'
+"""
+
+
+class Columns:
+    """Грузы колонками: вес/объем в array('d'), склад+категория и город — индексами в справочники.
+
+    Строки сразу раскладываются по группам (склад, категория) и по городам: внутри группы
+    тариф один и тот же, и пересчет идет плотным циклом (или numpy) по ее индексам.
+    """
+    __slots__ = ('weight', 'volume', 'groups', 'by_group', 'cities', 'by_city', '_group_idx', '_city_idx')
+
+    def __init__(self):
+        self.weight = array('d')
+        self.volume = array('d')
+        self.groups, self.by_group, self._group_idx = [], [], {}
+        self.cities, self.by_city, self._city_idx = [], [], {}
+
+    def append(self, weight, volume, warehouse, category, city):
+        i = len(self.weight)
+        self.weight.append(weight)
+        self.volume.append(volume)
+        g = self._group_idx.get((warehouse, category))
+        if g is None:
+            g = self._group_idx[(warehouse, category)] = len(self.groups)
+            self.groups.append((warehouse, category))
+            self.by_group.append(array('L'))
+        self.by_group[g].append(i)
+        city = city.lower().strip()
+        c = self._city_idx.get(city)
+        if c is None:
+            c = self._city_idx[city] = len(self.cities)
+            self.cities.append(city)
+            self.by_city.append(array('L'))
+        self.by_city[c].append(i)
+
+    def __len__(self):
+        return len(self.weight)
+
+
+def load_shipments(dsn, days=365):
+    """Грузы за days дней через именованный (серверный) курсор — в памяти только колонки."""
+    import psycopg2
+    cols = Columns()
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor(name='tariff_sim') as cur:
+            cur.itersize = FETCH_SIZE
+            cur.execute(LOAD_SQL, (days,))
+            for w, v, wh, cat, city in cur: cols.append(float(w), float(v), wh, cat, city)
+    finally:
+        conn.close()
+    return cols
+
+
+def synthetic_shipments(n, seed=1):
+    """Синтетическая история для замера скорости без БД."""
+    rnd = random.Random(seed)
+    config = get_matrix().config
+    warehouses = list(config.t1)
+    categories = list(config.t1[warehouses[0]])
+    cities = list(config.zones)
+    cols = Columns()
+    for _ in range(n):
+        w = round(rnd.lognormvariate(4, 1.2), 1)
+        cols.append(w, round(w / rnd.uniform(80, 400), 3), rnd.choice(warehouses), rnd.choice(categories), rnd.choice(cities))
+    return cols
+
+
+# --- ПЕРЕСЧЕТ ---
+
+def _t1_group_python(matrix, weight, volume, idx, warehouse, category):
+    thresholds, prices, fallback = matrix.bands(warehouse, category)
+    markup = matrix.markup
+    total = 0.0
+    for i in idx:
+        w = weight[i]
+        v = volume[i]
+        k = bisect_right(thresholds, w / v if v > 0 else 9999.0) - 1
+        rate = ((prices[k] if k >= 0 else 0) or fallback) * markup
+        total += rate * v if rate > CBM_RATE else rate * w
+    return total
+
+
+def _t1_group_numpy(np, matrix, w, v, warehouse, category):
+    thresholds, prices, fallback = matrix.bands(warehouse, category)
+    if not len(prices): return 0.0
+    density = np.divide(w, v, out=np.full_like(w, 9999.0), where=v > 0)
+    k = np.searchsorted(np.frombuffer(thresholds), density, side='right') - 1
+    price = np.where(k >= 0, np.frombuffer(prices)[np.maximum(k, 0)], 0.0)
+    rate = np.where(price != 0, price, fallback) * matrix.markup
+    return float(np.where(rate > CBM_RATE, rate * v, rate * w).sum())
+
+
+def t1_by_group(matrix, cols):
+    """Сумма Т1 ($) по каждой группе (склад, категория); numpy — если установлен."""
+    try: import numpy as np
+    except ImportError: np = None
+    if np is None:
+        return [_t1_group_python(matrix, cols.weight, cols.volume, idx, wh, cat) for (wh, cat), idx in zip(cols.groups, cols.by_group)]
+    weight, volume = np.frombuffer(cols.weight), np.frombuffer(cols.volume)
+    sums = []
+    for (wh, cat), idx in zip(cols.groups, cols.by_group):
+        ix = np.frombuffer(idx, dtype=np.uint64 if idx.itemsize == 8 else np.uint32)
+        sums.append(_t1_group_numpy(np, matrix, weight[ix], volume[ix], wh, cat))
+    return sums
+
+
+def t2_by_city(matrix, cols):
+    """Сумма Т2 (₸) по каждому городу — та же логика диапазонов, что и TariffMatrix.t2_cost."""
+    sums = []
+    weight = cols.weight
+    for city, idx in zip(cols.cities, cols.by_city):
+        maxes, costs, extra = matrix.t2_bands(matrix.zone_for(city))
+        total = 0
+        last, top = costs[-1], maxes[-1]
+        for i in idx:
+            w = weight[i]
+            if w <= 0: continue
+            k = bisect_left(maxes, w)     # Граница диапазона включительна
+            total += int(costs[k] if k < len(costs) else last + (w - top) * extra)
+        sums.append(total)
+    return sums
+
+
+def simulate(cols, baseline, candidate):
+    t = time.perf_counter()
+    result = {
+        't1': (t1_by_group(baseline, cols), t1_by_group(candidate, cols)),
+        't2': (t2_by_city(baseline, cols), t2_by_city(candidate, cols)),
+    }
+    result['seconds'] = time.perf_counter() - t
+    return result
+
+
+# --- ОТЧЕТ ---
+
+def _delta(old, new):
+    pct = f"{(new - old) / old * 100:+6.1f}%" if old else "     —"
+    return f"{old:>14,.0f} → {new:>14,.0f} | {new - old:>+13,.0f} | {pct}"
+
+
+def report(cols, result):
+    base_t1, cand_t1 = result['t1']
+    base_t2, cand_t2 = result['t2']
+    counts = [len(idx) for idx in cols.by_group]
+    print(f"📦 Грузов: {len(cols)} | пересчет: {result['seconds']:.2f} c")
+    print(f"💵 Т1, $:  {_delta(sum(base_t1), sum(cand_t1))}")
+    print(f"🇰🇿 Т2, ₸:  {_delta(sum(base_t2), sum(cand_t2))}")
+    for pos, title in ((1, 'Категории'), (0, 'Склады')):
+        agg = {}
+        for g, key in enumerate(cols.groups):
+            n, old, new = agg.get(key[pos], (0, 0.0, 0.0))
+            agg[key[pos]] = (n + counts[g], old + base_t1[g], new + cand_t1[g])
+        print(f"\n{title} (Т1, $):")
+        for key, (n, old, new) in sorted(agg.items(), key=lambda kv: kv[1][2] - kv[1][1]):
+            print(f"  {key:22} {n:8} гр. | {_delta(old, new)}")
+
+
+if __name__ == '__main__':
+    # python tariff_sim.py --config candidate.json [--markup 1.35] [--days 365]
+    # python tariff_sim.py --markup 1.35 --synthetic 1000000   (без БД, замер скорости)
+    parser = argparse.ArgumentParser(description="Что будет с выручкой при новых тарифах")
+    parser.add_argument('--config', help="Кандидат config.json (по умолчанию текущий)")
+    parser.add_argument('--markup', type=float, help="Наценка кандидата (по умолчанию из его конфига или 1.30)")
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--synthetic', type=int, help="Вместо БД — N синтетических грузов")
+    args = parser.parse_args()
+
+    baseline = get_matrix()
+    if args.config:
+        candidate = TariffMatrix(config_schema.load(args.config))
+    else:
+        candidate = TariffMatrix(baseline.config)
+    if args.markup: candidate.markup = args.markup
+
+    t = time.perf_counter()
+    cols = synthetic_shipments(args.synthetic) if args.synthetic else load_shipments(DATABASE_URL, args.days)
+    print(f"⏳ Загрузка: {time.perf_counter() - t:.2f} c")
+    report(cols, simulate(cols, baseline, candidate))
@@ -0,0 +1,64 @@
+import pytest
+from packages import MAX_PIECES, parse_weights, check_packages, build_packages, price_packages, insert_packages
+from tariff_matrix import get_matrix
+from volume_parser import parse_boxes
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("12.5 14 13", [12.5, 14.0, 13.0]), ("12,5+14", [12.5, 14.0]), ("10; 0; abc -3", [10.0]), ("", []), (None, []),
+])
+def test_parse_weights(text, expected):
+    assert parse_weights(text) == expected
+
+
+def test_weights_per_box():
+    pieces = build_packages([10, 12, 14], parse_boxes("60*40*50 3 шт"), 0.36)
+    assert [p['weight'] for p in pieces] == [10, 12, 14]
+    assert all(p['volume'] == pytest.approx(0.12) for p in pieces)
+
+
+def test_weights_kept_with_total_volume():
+    pieces = build_packages([10, 30], parse_boxes("0.4"), 0.4)
+    assert [p['weight'] for p in pieces] == [10, 30]
+    assert [p['volume'] for p in pieces] == pytest.approx([0.1, 0.3])
+
+
+def test_single_weight_split_by_volume():
+    pieces = build_packages([30], parse_boxes("60*40*50; 30*40*50"), 0.18)
+    assert [p['weight'] for p in pieces] == pytest.approx([20, 10])
+
+
+def test_weights_mismatch_asks_operator():
+    assert check_packages([10, 12], parse_boxes("60*40*50 x 3 шт"))
+    assert check_packages([10, 12], parse_boxes("0.5")) is None
+    assert check_packages([10], parse_boxes("60*40*50 x 3 шт")) is None
+
+
+@pytest.mark.parametrize('text', ["60*40*50 x 100000 шт", f"0.01 x {MAX_PIECES + 1} шт", "60*40*50 x 2.5 шт"])
+def test_bad_count_rejected(text):
+    boxes = parse_boxes(text)
+    assert check_packages([], boxes)
+    with pytest.raises(ValueError):
+        build_packages([], boxes, 1)
+
+
+def test_price_consignment_and_box():
+    pieces = build_packages([10, 200], parse_boxes("60*40*50; 30*30*30"), 0.147)
+    matrix = get_matrix()
+    cost = price_packages(pieces, 210, 0.147, 'obshhie', 'GZ', mode='consignment')[0]
+    assert cost == round(matrix.t1_rate(210, 0.147, 'obshhie', 'GZ')[0], 2)
+    box_cost = price_packages(pieces, 210, 0.147, 'obshhie', 'GZ', mode='box')[0]
+    assert box_cost == round(sum(matrix.t1_rate(p['weight'], p['volume'], 'obshhie', 'GZ')[0] for p in pieces), 2)
+
+
+def test_insert_packages(monkeypatch):
+    extras = pytest.importorskip('psycopg2.extras')
+    calls = []
+    monkeypatch.setattr(extras, 'execute_values', lambda cur, sql, rows, template=None: calls.append(rows))
+
+    class Cursor:
+        def execute(self, query, params=None): calls.append((query, params))
+
+    insert_packages(Cursor(), 'CN-1', build_packages([10, 12], parse_boxes("60*40*50 2 шт"), 0.24), 'op')
+    assert calls[0] == ("DELETE FROM packages WHERE contract_num = %s", ('CN-1',))
+    assert [(r[1], r[2]) for r in calls[1]] == [(1, 10), (2, 12)]
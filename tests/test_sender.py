@@ -0,0 +1,135 @@
+import time
+import asyncio
+import logging
+import pytest
+
+# Sender построен на исключениях Bot API: без python-telegram-bot проверять нечего
+pytest.importorskip('telegram')
+from telegram.error import RetryAfter, BadRequest
+import sender
+from sender import Sender, REPLY, PUSH, BROADCAST
+
+
+class RecordingBot:
+    """Фейковый Bot API: пишет (время, чат, текст); fail(chat, text) может бросить ошибку API."""
+
+    def __init__(self, fail=None):
+        self.sent = []
+        self.calls = []
+        self.fail = fail
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append((time.monotonic(), chat_id, text))
+        if self.fail: self.fail(chat_id, text)
+        self.sent.append((time.monotonic(), chat_id, text))
+        return len(self.sent)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture(autouse=True)
+def fast_intervals(monkeypatch):
+    monkeypatch.setattr(sender, 'PRIVATE_INTERVAL', 0.2)
+    monkeypatch.setattr(sender, 'GROUP_INTERVAL', 0.4)
+
+
+def test_replies_overtake_broadcast():
+    async def scenario():
+        bot = RecordingBot()
+        s = Sender(bot, rate=20, concurrency=1)
+        futures = [s.submit(1000 + i, BROADCAST, text=f"broadcast {i}") for i in range(20)]
+        futures.append(s.submit(1, PUSH, text="push"))
+        futures.append(s.submit(2, REPLY, text="reply"))
+        await asyncio.gather(*futures)
+        await s.close()
+        return [text for _, _, text in bot.sent]
+
+    order = run(scenario())
+    assert order[:2] == ["reply", "push"]
+    assert order[2:] == [f"broadcast {i}" for i in range(20)]
+
+
+def test_per_chat_spacing():
+    async def scenario():
+        bot = RecordingBot()
+        s = Sender(bot)
+        await asyncio.gather(*(s.submit(42, text=str(i)) for i in range(3)), *(s.submit(-100, text=f"g{i}") for i in range(2)))
+        await s.close()
+        return bot.sent
+
+    sent = run(scenario())
+    private = [t for t, chat, _ in sent if chat == 42]
+    group = [t for t, chat, _ in sent if chat == -100]
+    assert min(b - a for a, b in zip(private, private[1:])) >= 0.2 * 0.95
+    assert group[1] - group[0] >= 0.4 * 0.95
+
+
+def test_global_rate():
+    rate, n = 50, 30
+
+    async def scenario():
+        bot = RecordingBot()
+        s = Sender(bot, rate=rate)
+        await asyncio.gather(*(s.submit(1000 + i, BROADCAST, text=str(i)) for i in range(n)))
+        await s.close()
+        return bot.sent
+
+    sent = run(scenario())
+    assert len(sent) == n
+    # Сверх всплеска GLOBAL_BURST — не быстрее rate в секунду
+    assert sent[-1][0] - sent[0][0] >= (n - sender.GLOBAL_BURST) / rate * 0.9
+
+
+def test_retry_after_pauses_and_resends():
+    def flood_once(chat_id, text):
+        if len(bot.calls) == 1: raise RetryAfter(1)
+
+    bot = RecordingBot(flood_once)
+
+    async def scenario():
+        s = Sender(bot)
+        result = await s.send(7, text="hi")
+        other = await s.send(8, text="after pause")
+        await s.close()
+        return result, other, s.stats
+
+    result, other, stats = run(scenario())
+    assert result == 1 and other == 2
+    assert stats['retry_after'] == 1 and stats['sent'] == 2
+    first_try, retry, after = bot.calls[0][0], bot.calls[1][0], bot.calls[2][0]
+    # Пауза на всю отправку, а не только на чат с 429
+    assert retry - first_try >= 0.95 and after - first_try >= 0.95
+
+
+def test_retry_after_gives_up(monkeypatch):
+    monkeypatch.setattr(sender, 'MAX_ATTEMPTS', 1)
+
+    def always_flood(chat_id, text): raise RetryAfter(0)
+
+    async def scenario():
+        s = Sender(RecordingBot(always_flood))
+        try:
+            with pytest.raises(RetryAfter): await s.send(7, text="hi")
+        finally:
+            await s.close()
+
+    run(scenario())
+
+
+def test_errors_surface(caplog):
+    def not_found(chat_id, text): raise BadRequest("Chat not found")
+
+    async def scenario():
+        s = Sender(RecordingBot(not_found))
+        with pytest.raises(BadRequest): await s.send(7, text="hi")
+        s.send_nowait(8, text="background")
+        await asyncio.sleep(0.3)
+        await s.close()
+        return s.stats
+
+    with caplog.at_level(logging.INFO, logger='sender'):
+        stats = run(scenario())
+    assert stats['failed'] == 2
+    assert "Chat not found" in caplog.text
@@ -0,0 +1,45 @@
+import json
+import pytest
+import config_schema
+from shared_calculations import universal_t2_calculation
+from tariff_matrix import CONFIG_PATH, get_matrix
+
+WEIGHTS = (0.5, 1, 1.5, 2, 10, 20, 25, 100)
+
+# Текущие цены Т2 (₸) по config.json: любое их изменение — отдельное решение с согласованием
+T2_PRICES = {
+    'Алматы':  ((2205, 2205, 2310, 2310, 4200, 4200, 5300, 21800), 0.4),
+    'Шымкент': ((2310, 2310, 2420, 2420, 4400, 4400, 5550, 22800), 0.5),
+    'Астана':  ((2415, 2415, 2530, 2530, 4600, 4600, 5800, 23800), 0.6),
+    'Актобе':  ((2520, 2520, 2640, 2640, 4800, 4800, 6050, 24800), 0.7),
+    'Семей':   ((2625, 2625, 2750, 2750, 5000, 5000, 6300, 25800), 0.8),
+    'Урюпинск': ((2625, 2625, 2750, 2750, 5000, 5000, 6300, 25800), 0.8),  # Город не из DESTINATION_ZONES
+}
+
+# Было -> стало при переводе Алматы из псевдозоны 'алматы' (5000 ₸ + 260 ₸/кг) в зону 1.
+# Доп. кг считаются от границы последнего диапазона вместо 20 кг: пока граница 20 кг, цены это не меняет
+PRICE_DIFF = {
+    'Алматы': ((5000, 5000, 5000, 5000, 5000, 5000, 6300, 25800), 0.8),
+}
+
+
+@pytest.mark.parametrize('city', T2_PRICES)
+def test_t2_prices_unchanged(city):
+    costs, ref_rate = T2_PRICES[city]
+    matrix = get_matrix()
+    assert tuple(matrix.t2_cost(w, city)[0] for w in WEIGHTS) == costs
+    assert tuple(universal_t2_calculation(w, city)[0] for w in WEIGHTS) == costs
+    assert matrix.t2_cost(1, city)[1] == universal_t2_calculation(1, city)[1] == ref_rate
+
+
+def test_price_diff():
+    changed = {city for city in T2_PRICES if T2_PRICES[city] != PRICE_DIFF.get(city, T2_PRICES[city])}
+    assert changed == set(PRICE_DIFF)
+    assert not get_matrix().config.warnings
+
+
+def test_unknown_zone_flagged():
+    with open(CONFIG_PATH, encoding='utf-8') as f: raw = json.load(f)
+    raw['DESTINATION_ZONES']['алматы'] = 'алматы'
+    config = config_schema.parse(raw)
+    assert any('DESTINATION_ZONES.алматы' in w for w in config.warnings)
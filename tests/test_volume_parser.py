@@ -0,0 +1,78 @@
+import math
+import random
+import pytest
+from volume_parser import parse_boxes, parse_volume
+
+SEEDS = range(20)
+CASES = 200
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("0.5", 0.5), ("0,5 куб", 0.5), ("12 м3", 12.0), ("2 м куб", 2.0), ("2 м. куб", 2.0), ("2 куб м", 2.0),
+    ("25", 25.0), ("100", 100.0), ("60*40*50", 0.12), ("60x40x50 см x 10 шт", 1.2), ("10 шт 60*40*50", 1.2),
+    ("1.2м×0.8м×0.5м", 0.48), ("600х400х500 мм", 0.12), ("60x40x50 x2; 30х30х30 5 шт", 0.375),
+    ("коробки 50*50*50 + 40*40*40", 0.189), ("0.5 10", 5.0),
+])
+def test_examples(text, expected):
+    assert parse_volume(text) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize('text', ["", "   ", "нет", "x*х×", ";;;", "шт шт", "м куб"])
+def test_nothing_recognised(text):
+    assert parse_volume(text) == 0
+
+
+def _dims(rnd):
+    return [rnd.randint(1, 300) for _ in range(3)]
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_garbage_never_raises(seed):
+    rnd = random.Random(seed)
+    alphabet = "0123456789.,xх×*;+\n мсmкубштm3³ abcабв-/"
+    for _ in range(CASES):
+        text = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 40)))
+        v = parse_volume(text)
+        assert v >= 0 and math.isfinite(v), text
+        assert all(b.volume > 0 and b.count > 0 for b in parse_boxes(text)), text
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_bare_number_is_cubic_meters(seed):
+    rnd = random.Random(seed)
+    for _ in range(CASES):
+        v = round(rnd.uniform(0.01, 500), rnd.choice((0, 1, 2, 3)))
+        if v <= 0: continue
+        for text in (str(v), str(v).replace('.', ','), f"{v} м3", f"{v} м куб", f"{v} куб"):
+            assert parse_volume(text) == pytest.approx(round(v, 4)), text
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_units_agree(seed):
+    rnd = random.Random(seed)
+    for _ in range(CASES):
+        l, w, h = _dims(rnd)
+        cm = parse_volume(f"{l}*{w}*{h}")
+        assert cm == pytest.approx(l * w * h / 1e6, abs=1e-4)
+        assert parse_volume(f"{l}x{w}x{h} см") == pytest.approx(cm, abs=1e-4)
+        assert parse_volume(f"{l * 10}х{w * 10}х{h * 10} мм") == pytest.approx(cm, abs=1e-4)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_count_scales_volume(seed):
+    rnd = random.Random(seed)
+    for _ in range(CASES):
+        l, w, h = _dims(rnd)
+        n = rnd.randint(1, 50)
+        one = l * w * h / 1e6
+        for text in (f"{l}*{w}*{h} x {n} шт", f"{n} шт {l}*{w}*{h}", f"{l}x{w}x{h} {n} шт"):
+            assert parse_volume(text) == pytest.approx(one * n, abs=2e-4), text
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_separated_boxes_add_up(seed):
+    rnd = random.Random(seed)
+    for _ in range(CASES):
+        parts = [f"{l}*{w}*{h}" for l, w, h in (_dims(rnd) for _ in range(rnd.randint(1, 4)))]
+        sep = rnd.choice(('; ', ' + ', '\n'))
+        assert parse_volume(sep.join(parts)) == pytest.approx(sum(parse_volume(p) for p in parts), abs=1e-3)
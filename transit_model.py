@@ -0,0 +1,233 @@
+import os
+import sys
+import asyncio
+import logging
+import psycopg2
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+from shipment_events import events_since, read_cursor, write_cursor
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+CURSOR_NAME = 'transit_model'
+BATCH_SIZE = 5000
+UPDATE_SECONDS = 300
+BUCKET_HOURS = 6
+MAX_BUCKET = 90 * 24 // BUCKET_HOURS    # Все, что дольше 90 дней, — в последнюю корзину
+ETA_LOW_Q, ETA_HIGH_Q = 0.2, 0.8
+MIN_SAMPLES = 5
+
+# Этапы маршрута в порядке следования; плечо = переход между соседними этапами
+STAGES = ('accepted', 'departed', 'border', 'almaty')
+STAGE_TITLES = {'accepted': 'Склад в Китае', 'departed': 'В пути по Китаю', 'border': 'Хоргос', 'almaty': 'Алматы'}
+
+
+def stage_of(status):
+    status = (status or '').lower()
+    if status.startswith('принят на складе'): return 'accepted'
+    if 'пути (китай)' in status: return 'departed'
+    if 'границе' in status or 'хоргос' in status: return 'border'
+    if 'алматы' in status: return 'almaty'
+    return None
+
+
+def bucket_of(hours):
+    return min(max(int(hours // BUCKET_HOURS), 0), MAX_BUCKET)
+
+
+def quantile(hist, q):
+    """hist: {bucket: n}. Часы по середине корзины, в которую попадает квантиль q."""
+    total = sum(hist.values())
+    if not total: return None
+    target = q * total
+    acc = 0
+    for b in sorted(hist):
+        acc += hist[b]
+        if acc >= target: return (b + 0.5) * BUCKET_HOURS
+    return (max(hist) + 0.5) * BUCKET_HOURS
+
+
+def leg_durations(events, marks):
+    """Плечи из пачки событий.
+
+    events — [(contract_num, warehouse_code, status, created_at)] по возрастанию id;
+    marks — {contract_num: {stage: время}} из прошлых пачек, дополняется на месте.
+    Возвращает [(warehouse_code, leg, часы)], где leg = 'accepted>departed' и т.п.
+    """
+    legs = []
+    for cn, wh, status, at in events:
+        stage = stage_of(status)
+        if not stage: continue
+        seen = marks.setdefault(cn, {})
+        if stage in seen: continue   # Повторная установка того же статуса не начинает плечо заново
+        seen[stage] = at
+        i = STAGES.index(stage)
+        if i and STAGES[i - 1] in seen:
+            hours = (at - seen[STAGES[i - 1]]).total_seconds() / 3600
+            legs.append((wh or 'GZ', f"{STAGES[i - 1]}>{stage}", hours))
+    return legs
+
+
+def eta_table(hists):
+    """hists: {(wh, leg): {bucket: n}} -> {(wh, stage): (low_h, high_h, samples)} — до прибытия в Алматы."""
+    table = {}
+    for wh in {wh for wh, _ in hists}:
+        for i, stage in enumerate(STAGES[:-1]):
+            low = high = 0.0
+            samples = None
+            for j in range(i, len(STAGES) - 1):
+                hist = hists.get((wh, f"{STAGES[j]}>{STAGES[j + 1]}"), {})
+                n = sum(hist.values())
+                if n < MIN_SAMPLES: break
+                low += quantile(hist, ETA_LOW_Q)
+                high += quantile(hist, ETA_HIGH_Q)
+                samples = n if samples is None else min(samples, n)
+            else:
+                table[(wh, stage)] = (low, high, samples)
+    return table
+
+
+# --- БАЗА ---
+
+def update_model(conn):
+    """Добавляет в гистограммы плечи из новых событий и пересчитывает transit_eta. Возвращает число событий."""
+    with conn.cursor() as cur:
+        events, cursor = events_since(cur, read_cursor(cur, CURSOR_NAME, lock=True), BATCH_SIZE)
+        if not events:
+            conn.rollback()
+            return 0
+
+        contracts = list({e[1] for e in events})
+        cur.execute("SELECT contract_num, stage, reached_at FROM transit_marks WHERE contract_num = ANY(%s)", (contracts,))
+        marks = {}
+        for cn, stage, at in cur.fetchall(): marks.setdefault(cn, {})[stage] = at
+        known = {(cn, st) for cn, m in marks.items() for st in m}
+
+        legs = leg_durations([(cn, wh, status, at) for _, cn, _, wh, status, _, _, at in events], marks)
+        new_marks = [(cn, st, at) for cn, m in marks.items() for st, at in m.items() if (cn, st) not in known]
+        if new_marks:
+            execute_values(cur, "INSERT INTO transit_marks (contract_num, stage, reached_at) VALUES %s ON CONFLICT DO NOTHING", new_marks)
+
+        delta = {}
+        for wh, leg, hours in legs:
+            key = (wh, leg, bucket_of(hours))
+            delta[key] = delta.get(key, 0) + 1
+        if delta:
+            execute_values(cur, """
+                INSERT INTO transit_leg_hist (warehouse_code, leg, bucket, n) VALUES %s
+                ON CONFLICT (warehouse_code, leg, bucket) DO UPDATE SET n = transit_leg_hist.n + EXCLUDED.n
+            """, [(wh, leg, b, n) for (wh, leg, b), n in delta.items()])
+
+            # Гистограммы маленькие (склад × плечо × ≤361 корзина), ETA пересчитывается целиком
+            cur.execute("SELECT warehouse_code, leg, bucket, n FROM transit_leg_hist")
+            hists = {}
+            for wh, leg, b, n in cur.fetchall(): hists.setdefault((wh, leg), {})[b] = n
+            cur.execute("DELETE FROM transit_eta")
+            rows = [(wh, stage, low, high, n) for (wh, stage), (low, high, n) in eta_table(hists).items()]
+            if rows: execute_values(cur, "INSERT INTO transit_eta (warehouse_code, stage, low_hours, high_hours, samples) VALUES %s", rows)
+
+        write_cursor(cur, CURSOR_NAME, cursor)
+    conn.commit()
+    return len(events)
+
+
+def get_eta(cur, warehouse_code, status):
+    """(low_hours, high_hours) до Алматы для текущего статуса или None."""
+    stage = stage_of(status)
+    if not stage or stage == 'almaty': return None
+    cur.execute("SELECT low_hours, high_hours FROM transit_eta WHERE warehouse_code = %s AND stage = %s", (warehouse_code or 'GZ', stage))
+    return cur.fetchone()
+
+
+def format_eta(eta):
+    low, high = eta
+    low_d, high_d = max(1, round(low / 24)), max(1, round(high / 24))
+    return f"{low_d}–{high_d} дн." if high_d > low_d else f"~{low_d} дн."
+
+
+async def run_transit_model(dsn):
+    """Фоновое обновление модели сроков для бота склада."""
+    loop = asyncio.get_running_loop()
+    conn = None
+    while True:
+        try:
+            if conn is None or conn.closed:
+                conn = await loop.run_in_executor(None, psycopg2.connect, dsn)
+            while await loop.run_in_executor(None, update_model, conn) >= BATCH_SIZE: pass
+        except asyncio.CancelledError:
+            if conn: conn.close()
+            raise
+        except Exception as e:
+            logger.error(f"Transit model error: {e}")
+            if conn: conn.close()
+            conn = None
+        await asyncio.sleep(UPDATE_SECONDS)
+
+
+def backtest(n_shipments=50000, seed=1):
+    """Синтетические грузы с логнормальными плечами: обучение на 80%, проверка покрытия ETA на 20%."""
+    import random
+    import time
+    from datetime import datetime, timedelta
+
+    rnd = random.Random(seed)
+    # Медиана плеча (часы) и разброс для каждого склада
+    medians = {'GZ': (48, 120, 36), 'FS': (36, 110, 36), 'IW': (72, 150, 40)}
+    events, truth = [], {}
+    start = datetime(2025, 1, 1)
+    for i in range(n_shipments):
+        wh = rnd.choice(list(medians))
+        at = start + timedelta(hours=rnd.uniform(0, 24 * 300))
+        cn = f"CN-{i}"
+        times = [at]
+        for m in medians[wh]:
+            at = at + timedelta(hours=rnd.lognormvariate(0, 0.35) * m)
+            times.append(at)
+        truth[cn] = (wh, times)
+        for stage, t in zip(STAGES, times):
+            events.append((t, cn, wh, {'accepted': f'Принят на складе {wh}', 'departed': 'В пути (Китай)',
+                                       'border': 'На границе (Хоргос)', 'almaty': 'Прибыл в Алматы'}[stage]))
+    events.sort()
+    split = events[int(len(events) * 0.8)][0]
+
+    t0 = time.perf_counter()
+    marks, hists = {}, {}
+    train = [(cn, wh, st, t) for t, cn, wh, st in events if t < split]
+    for i in range(0, len(train), BATCH_SIZE):
+        for wh, leg, hours in leg_durations(train[i:i + BATCH_SIZE], marks):
+            h = hists.setdefault((wh, leg), {})
+            b = bucket_of(hours)
+            h[b] = h.get(b, 0) + 1
+    table = eta_table(hists)
+    elapsed = time.perf_counter() - t0
+
+    hit = total = 0
+    for cn, (wh, times) in truth.items():
+        if times[0] < split: continue
+        eta = table.get((wh, 'accepted'))
+        if not eta: continue
+        actual = (times[-1] - times[0]).total_seconds() / 3600
+        total += 1
+        hit += eta[0] <= actual <= eta[1]
+    print(f"Событий в обучении: {len(train)} | агрегация: {elapsed:.2f} c ({len(train) / elapsed:,.0f} событий/с)")
+    for (wh, stage), (low, high, n) in sorted(table.items(), key=lambda kv: (kv[0][0], STAGES.index(kv[0][1]))):
+        print(f"{wh} {STAGE_TITLES[stage]:16} -> Алматы: {low / 24:5.1f}–{high / 24:5.1f} дн. (n={n})")
+    print(f"Покрытие интервала на отложенных грузах: {hit}/{total} = {hit / max(total, 1):.0%} (цель ≥{ETA_HIGH_Q - ETA_LOW_Q:.0%})")
+
+
+if __name__ == '__main__':
+    # python transit_model.py update | backtest
+    cmd = sys.argv[1] if len(sys.argv) > 1 else 'backtest'
+    if cmd == 'update':
+        conn = psycopg2.connect(DATABASE_URL)
+        total = 0
+        while True:
+            n = update_model(conn)
+            total += n
+            if n < BATCH_SIZE: break
+        conn.close()
+        print(f"✅ Обработано событий: {total}")
+    else:
+        backtest()
@@ -1,7 +1,9 @@
 import os
+import sys
 import psycopg2
 from datetime import datetime
 from dotenv import load_dotenv
+from psycopg2.extras import execute_values
 
 load_dotenv()
 
@@ -25,7 +27,8 @@ ALTER_TABLES_SQL = [
     "ALTER TABLE applications ADD COLUMN IF NOT EXISTS city TEXT;",
     "ALTER TABLE applications ADD COLUMN IF NOT EXISTS total_weight REAL;", 
     "ALTER TABLE applications ADD COLUMN IF NOT EXISTS total_volume REAL;",
-    "ALTER TABLE applications ADD COLUMN IF NOT EXISTS calculated_cost REAL;"
+    "ALTER TABLE applications ADD COLUMN IF NOT EXISTS calculated_cost REAL;",
+    "ALTER TABLE shipments ADD COLUMN IF NOT EXISTS base_cost REAL;"
 ]
 
 # Фиксированные расходы (в месяц)
@@ -108,5 +111,108 @@ def update_stats_db():
         if conn: 
             conn.close()
 
+# --- P&L ---
+
+BACKFILL_BATCH = 5000
+
+REBUILD_ROLLUPS_SQL = """
+TRUNCATE pnl_daily, expenses_daily;
+INSERT INTO pnl_daily (day, warehouse_code, category, source, shipments, revenue, base_cost)
+SELECT COALESCE(created_at::date, DATE '1970-01-01'), COALESCE(warehouse_code, 'GZ'), COALESCE(category, 'obshhie'),
+       COALESCE(source, 'Direct'), COUNT(*), SUM(COALESCE(total_price_final, 0)), SUM(COALESCE(base_cost, 0))
+FROM shipments GROUP BY 1, 2, 3, 4;
+INSERT INTO expenses_daily (day, category, amount)
+SELECT COALESCE(date, DATE '1970-01-01'), COALESCE(category, 'other'), SUM(COALESCE(amount, 0))
+FROM expenses GROUP BY 1, 2;
+"""
+
+
+def backfill_base_cost(conn):
+    """Считает base_cost (и category из product) для старых грузов. Триггер сразу переносит дельту в pnl_daily."""
+    from common import CATEGORY_BUTTONS
+    from tariff_matrix import get_matrix
+    matrix = get_matrix()
+    cur = conn.cursor()
+    total = 0
+    while True:
+        cur.execute("""
+            SELECT contract_num, warehouse_code, category, product,
+                   COALESCE(actual_weight, declared_weight, 0), COALESCE(actual_volume, declared_volume, 0), COALESCE(agreed_rate, 0)
+            FROM shipments WHERE base_cost IS NULL AND total_price_final IS NOT NULL LIMIT %s
+        """, (BACKFILL_BATCH,))
+        rows = cur.fetchall()
+        if not rows: break
+        updates = []
+        for cn, wh, category, product, w, v, agreed in rows:
+            # Боты раньше писали ключ категории только в product
+            if (category or 'obshhie') == 'obshhie' and product in CATEGORY_BUTTONS: category = product
+            category = category or 'obshhie'
+            is_cbm = matrix.t1_rate(w, v, category, wh or 'GZ', agreed)[3]
+            updates.append((cn, category, round(matrix.t1_base_cost(w, v, category, wh or 'GZ', is_cbm), 2)))
+        execute_values(cur, """
+            UPDATE shipments s SET category = u.category, base_cost = u.base_cost
+            FROM (VALUES %s) AS u (contract_num, category, base_cost) WHERE s.contract_num = u.contract_num
+        """, updates)
+        conn.commit()
+        total += len(rows)
+        print(f"✅ base_cost рассчитан: {total}")
+    return total
+
+
+def rebuild_rollups(conn):
+    """Полный пересчет дневных итогов (после бэкфилла или ручной правки данных)."""
+    backfill_base_cost(conn)
+    cur = conn.cursor()
+    cur.execute(REBUILD_ROLLUPS_SQL)
+    conn.commit()
+    print("✅ pnl_daily и expenses_daily пересчитаны")
+
+
+def _margin_pct(revenue, base):
+    return f"{(revenue - base) / revenue * 100:5.1f}%" if revenue else "    —"
+
+
+def pnl_report(conn, days=30):
+    """P&L за последние days дней только по дневным итогам."""
+    cur = conn.cursor()
+    period = "day > CURRENT_DATE - %s"
+    cur.execute(f"SELECT COALESCE(SUM(shipments), 0), COALESCE(SUM(revenue), 0), COALESCE(SUM(base_cost), 0) FROM pnl_daily WHERE {period}", (days,))
+    n, revenue, base = cur.fetchone()
+    cur.execute(f"SELECT category, SUM(amount) FROM expenses_daily WHERE {period} GROUP BY category ORDER BY 2 DESC", (days,))
+    expenses = cur.fetchall()
+    marketing = sum(a for c, a in expenses if c == 'marketing')
+    other = sum(a for c, a in expenses if c != 'marketing')
+
+    print(f"\n📈 P&L за {days} дн.")
+    print(f"📦 Грузов: {n}")
+    print(f"💵 Выручка: ${revenue:,.2f}")
+    print(f"🏭 Себестоимость Т1: ${base:,.2f}")
+    print(f"💰 Маржа: ${revenue - base:,.2f} ({_margin_pct(revenue, base).strip()})")
+    print(f"📣 Маркетинг: ${marketing:,.2f}" + (f" | на груз: ${marketing / n:,.2f}" if n else ""))
+    print(f"🧾 Прочие расходы: ${other:,.2f}")
+    print(f"🏁 Чистыми: ${revenue - base - marketing - other:,.2f}")
+
+    for dim, title in (('warehouse_code', 'Склады'), ('category', 'Категории'), ('source', 'Источники')):
+        cur.execute(f"""
+            SELECT {dim}, SUM(shipments), SUM(revenue), SUM(base_cost) FROM pnl_daily
+            WHERE {period} GROUP BY {dim} ORDER BY SUM(revenue) - SUM(base_cost) DESC
+        """, (days,))
+        print(f"\n{title}:")
+        for key, cnt, rev, cost in cur.fetchall():
+            print(f"  {key:22} {cnt:6} гр. | выручка ${rev:>12,.2f} | маржа ${rev - cost:>11,.2f} | {_margin_pct(rev, cost)}")
+
+
 if __name__ == '__main__':
-    update_stats_db()
\ No newline at end of file
+    # python update_stats.py               — расходы + сводка (как раньше)
+    # python update_stats.py report [дней] — P&L по дневным итогам
+    # python update_stats.py rebuild       — бэкфилл base_cost и пересчет итогов
+    cmd = sys.argv[1] if len(sys.argv) > 1 else 'update'
+    if cmd == 'update' or not DATABASE_URL:
+        update_stats_db()
+    else:
+        conn = psycopg2.connect(DATABASE_URL)
+        try:
+            if cmd == 'rebuild': rebuild_rollups(conn)
+            else: pnl_report(conn, int(sys.argv[2]) if len(sys.argv) > 2 else 30)
+        finally:
+            conn.close()
\ No newline at end of file
@@ -0,0 +1,142 @@
+import re
+from collections import namedtuple
+
+# Одна коробка (или партия одинаковых): габариты в метрах (None, если объем введен сразу), кол-во и объем одной штуки в м³
+Box = namedtuple('Box', 'length width height count volume')
+
+_TOKEN_RE = re.compile(r"""
+    (?P<num>\d+(?:[.,]\d+)?)
+  | (?P<vol>м³|м3|m³|m3|cbm|м\.?\s?куб\w*|куб\w*(?:\.?\s?м(?![^\W\d_]))?)
+  | (?P<len>мм|mm|мил\w*|см|cm|сант\w*|метр\w*|м(?![^\W\d_])|m(?![^\W\d_]))
+  | (?P<pcs>шт\w*|pcs|кор\w*|мест\w*|box\w*|ящ\w*)
+  | (?P<x>[xх×*](?![^\W\d_]))
+  | (?P<sep>[;\n+])
+  | (?P<word>[^\W\d_]+)
+""", re.X | re.I)
+
+_LEN_FACTORS = (('мм', 0.001), ('mm', 0.001), ('мил', 0.001), ('см', 0.01), ('cm', 0.01), ('сант', 0.01))
+# Без единиц габариты считаются в сантиметрах, как и раньше. Одно число без единиц — всегда м³;
+# из двух чисел без единиц первое считается объемом, только если оно меньше порога ("0.5 10" — 0.5 м³ × 10)
+MAX_BARE_VOLUME = 20
+
+
+def _len_factor(unit):
+    if unit is None: return None
+    for prefix, factor in _LEN_FACTORS:
+        if unit.startswith(prefix): return factor
+    return 1.0
+
+
+def _tokenize(text):
+    segment = []
+    for m in _TOKEN_RE.finditer(text.lower()):
+        kind = m.lastgroup
+        if kind == 'sep':
+            if segment: yield segment
+            segment = []
+        elif kind != 'word':
+            segment.append((kind, m.group(kind)))
+    if segment: yield segment
+
+
+def _numbers(tokens):
+    """[значение, (вид единицы, единица) | None, соединено ли с предыдущим через 'x']"""
+    nums = []
+    joined = False
+    for kind, text in tokens:
+        if kind == 'num':
+            nums.append([float(text.replace(',', '.')), None, joined])
+            joined = False
+        elif kind == 'x':
+            joined = True
+        elif nums and nums[-1][1] is None:
+            nums[-1][1] = (kind, text)
+    return nums
+
+
+def _parse_segment(nums):
+    boxes = []
+    pending = None   # кол-во, введенное перед габаритами ("10 шт 60*40*50")
+    counted = True   # у последней коробки уже есть кол-во
+    i = 0
+    while i < len(nums):
+        triple = nums[i:i + 3]
+        if (len(triple) == 3 and triple[1][2] and triple[2][2]
+                and all(n[1] is None or n[1][0] == 'len' for n in triple)):
+            units = [n[1][1] if n[1] else None for n in triple]
+            common = next((u for u in reversed(units) if u), None)
+            dims = [n[0] for n in triple]
+            factors = [_len_factor(u or common) for u in units]
+            if common is None:
+                # "1.2x0.8x0.5" без единиц — это метры, а не сантиметры
+                in_meters = all(d < 5 for d in dims) and any(d != int(d) for d in dims)
+                factors = [1.0 if in_meters else 0.01] * 3
+            dims = [d * f for d, f in zip(dims, factors)]
+            count = pending or 1
+            boxes.append(Box(dims[0], dims[1], dims[2], count, dims[0] * dims[1] * dims[2]))
+            counted = pending is not None
+            pending = None
+            i += 3
+            continue
+
+        value, unit, joined = nums[i]
+        kind = unit[0] if unit else None
+        if kind == 'vol':
+            boxes.append(Box(None, None, None, pending or 1, value))
+            counted = pending is not None
+            pending = None
+        elif kind == 'pcs' or joined or (kind is None and boxes and not counted):
+            if boxes and not counted:
+                boxes[-1] = boxes[-1]._replace(count=value)
+                counted = True
+            else:
+                pending = value
+        elif kind is None and i == 0 and (len(nums) == 1 or (len(nums) == 2 and value < MAX_BARE_VOLUME)):
+            boxes.append(Box(None, None, None, 1, value))
+            counted = False
+        elif kind is None:
+            pending = value
+        i += 1
+    return boxes
+
+
+def parse_boxes(text):
+    """Разбирает ввод объема в список коробок.
+
+    Понимает: "0.5", "0,5 куб", "0.5 м³", "60*40*50", "60x40x50 см x 10 шт",
+    "10 шт 60*40*50", "1.2м×0.8м×0.5м", "600х400х500 мм" и несколько коробок,
+    разделенных ';', '+' или переводом строки.
+    """
+    if not text: return []
+    boxes = []
+    for tokens in _tokenize(text):
+        boxes.extend(b for b in _parse_segment(_numbers(tokens)) if b.volume > 0 and b.count > 0)
+    return boxes
+
+
+def parse_volume(text):
+    """Общий объем в м³ (0.0, если ничего не распознано)."""
+    return round(sum(b.volume * b.count for b in parse_boxes(text)), 4)
+
+
+if __name__ == '__main__':
+    # Бенчмарк пропускной способности: python volume_parser.py
+    import random
+    import time
+
+    samples = ["0.5", "0,5 куб", "12 м3", "60*40*50", "60x40x50 см x 10 шт", "10 шт 60*40*50",
+               "1.2м×0.8м×0.5м", "600х400х500 мм", "60x40x50 x2; 30х30х30 5 шт", "коробки 50*50*50 + 40*40*40"]
+    rnd = random.Random(1)
+    corpus = samples + [
+        f"{rnd.randint(10, 120)}{rnd.choice('x*х×')}{rnd.randint(10, 120)}{rnd.choice('x*х×')}{rnd.randint(10, 120)}"
+        f"{rnd.choice(['', ' см', ' мм'])}{rnd.choice(['', ' x ' + str(rnd.randint(1, 40)) + ' шт'])}"
+        for _ in range(5000)
+    ]
+    for s in samples: print(f"{s!r:35} -> {parse_volume(s)} м³")
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < 2:
+        for s in corpus: parse_volume(s)
+        n += len(corpus)
+    elapsed = time.perf_counter() - start
+    print(f"{n} строк за {elapsed:.2f} c: {n / elapsed:,.0f} строк/с")